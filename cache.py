@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением по времени жизни записей.
+
+    Считает попадания и промахи. Чтобы читатель не положил в кэш значение,
+    прочитанное до параллельной записи, заполнение из базы идет через
+    generation: fill() игнорируется, если с момента begin_fill() кэш
+    успели изменить.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def _store(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def put(self, key, value):
+        """Запись свежего значения после изменения в базе"""
+        with self._lock:
+            self._generation += 1
+            self._store(key, value)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def begin_fill(self):
+        with self._lock:
+            return self._generation
+
+    def fill(self, key, value, generation):
+        """Кладет значение, прочитанное из базы, если кэш не менялся с begin_fill()"""
+        with self._lock:
+            if generation == self._generation:
+                self._store(key, value)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'hits': self.hits, 'misses': self.misses}
@@ -1,7 +1,127 @@
-BOT_TOKEN = "YOUR_BOT_TOKEN"
-ADMIN_IDS = [7164894029, 6408912033, 5634735018]
+"""Настройки бота.
 
-TEST_QUESTIONS = [
+Значения ниже — умолчания. Любую настройку можно переопределить в
+JSON-файле (путь в переменной окружения BOT_SETTINGS, по умолчанию
+settings.json рядом с этим файлом) или переменной окружения с тем же
+именем; окружение важнее файла. Из окружения значение приводится к типу
+умолчания: числа, ADMIN_IDS через запятую, списки и словари — JSON,
+пустая строка — None.
+"""
+import json
+import os
+
+_SETTINGS_FILE = os.environ.get(
+    'BOT_SETTINGS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.json')
+)
+_file_settings = {}
+if os.path.exists(_SETTINGS_FILE):
+    with open(_SETTINGS_FILE, encoding='utf-8') as f:
+        _file_settings = json.load(f)
+
+
+def _from_env(raw, default):
+    if raw == '':
+        return None
+    if isinstance(default, bool):
+        return raw.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(default, int):
+        try:
+            return int(raw)
+        except ValueError:
+            return float(raw)
+    if isinstance(default, float):
+        return float(raw)
+    if isinstance(default, frozenset):
+        return frozenset(int(item) for item in raw.split(',') if item.strip())
+    if isinstance(default, (list, dict)):
+        return json.loads(raw)
+    return raw
+
+
+# Имена, объявленные через _setting; другие ключи в файле настроек — ошибка
+_registered = set()
+
+
+def _setting(name, default):
+    _registered.add(name)
+    if name in os.environ:
+        return _from_env(os.environ[name], default)
+    if name in _file_settings:
+        value = _file_settings[name]
+        return frozenset(value) if isinstance(default, frozenset) else value
+    return default
+
+
+BOT_TOKEN = _setting('BOT_TOKEN', "YOUR_BOT_TOKEN")
+ADMIN_IDS = _setting('ADMIN_IDS', frozenset({7164894029, 6408912033, 5634735018}))
+# Прокси для запросов к Bot API (например, http://proxy.server:3128 на PythonAnywhere);
+# None — без прокси
+BOT_PROXY = _setting('BOT_PROXY', None)
+
+DB_PATH = _setting('DB_PATH', "bot.db")
+DB_READERS = _setting('DB_READERS', 4)
+# Профиль хранилища SQLite, применяется к каждому соединению при старте
+DB_PROFILE = _setting('DB_PROFILE', "tuned")
+DB_PROFILES = {
+    # Настройки SQLite по умолчанию: rollback journal и fsync на каждый коммит
+    "default": {},
+    "tuned": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,  # в KiB
+        "temp_store": "MEMORY",
+        "busy_timeout": 5000,
+    },
+}
+# Кэш партнеров: сколько записей держать и сколько секунд им доверять
+PARTNER_CACHE_SIZE = _setting('PARTNER_CACHE_SIZE', 10000)
+PARTNER_CACHE_TTL = _setting('PARTNER_CACHE_TTL', 60)
+# Как часто (в секундах) переносить WAL в основной файл базы
+DB_CHECKPOINT_INTERVAL = _setting('DB_CHECKPOINT_INTERVAL', 300)
+
+# Рассылка уведомлений: одновременных отправок, сообщений в секунду всего и на один чат
+NOTIFY_CONCURRENCY = _setting('NOTIFY_CONCURRENCY', 8)
+NOTIFY_GLOBAL_RATE = _setting('NOTIFY_GLOBAL_RATE', 25)
+NOTIFY_CHAT_RATE = _setting('NOTIFY_CHAT_RATE', 1)
+NOTIFY_MAX_RETRIES = _setting('NOTIFY_MAX_RETRIES', 3)
+
+# Доставка уведомлений из outbox: размер пачки, пауза при пустой очереди (сек), число попыток
+OUTBOX_BATCH_SIZE = _setting('OUTBOX_BATCH_SIZE', 50)
+OUTBOX_POLL_INTERVAL = _setting('OUTBOX_POLL_INTERVAL', 1.0)
+OUTBOX_MAX_ATTEMPTS = _setting('OUTBOX_MAX_ATTEMPTS', 5)
+
+# FSM-хранилище: через сколько секунд бездействия сессия считается брошенной
+# и как часто (в секундах) сбрасывать изменения в базу
+FSM_STATE_TTL = _setting('FSM_STATE_TTL', 24 * 3600)
+FSM_FLUSH_INTERVAL = _setting('FSM_FLUSH_INTERVAL', 1.0)
+
+# Режим webhook (webhook.py): публичный адрес, путь, секрет и адрес локального сервера
+WEBHOOK_BASE_URL = _setting('WEBHOOK_BASE_URL', "https://example.com")
+WEBHOOK_PATH = _setting('WEBHOOK_PATH', "/webhook")
+# Секрет в заголовке X-Telegram-Bot-Api-Secret-Token; без него webhook.py не запустится
+WEBHOOK_SECRET = _setting('WEBHOOK_SECRET', None)
+WEBAPP_HOST = _setting('WEBAPP_HOST', "0.0.0.0")
+WEBAPP_PORT = _setting('WEBAPP_PORT', 8080)
+
+# Логи в формате JSON: уровень и необязательный файл в дополнение к stdout
+LOG_LEVEL = _setting('LOG_LEVEL', "INFO")
+LOG_FILE = _setting('LOG_FILE', None)
+
+# Локальный HTTP-сервер с метриками Prometheus (/metrics); None — не запускать
+METRICS_HOST = _setting('METRICS_HOST', "127.0.0.1")
+METRICS_PORT = _setting('METRICS_PORT', 9100)
+
+# Автоначисление за заказы (orders.py): каталог с JSONL-событиями, размер пачки,
+# пауза между проверками каталога (сек), вознаграждение за заказ (руб.) и
+# после скольких неудачных попыток файл переносится в failed
+ORDERS_SPOOL_DIR = _setting('ORDERS_SPOOL_DIR', "orders_spool")
+ORDERS_BATCH_SIZE = _setting('ORDERS_BATCH_SIZE', 5000)
+ORDERS_POLL_INTERVAL = _setting('ORDERS_POLL_INTERVAL', 2.0)
+ORDER_REWARD = _setting('ORDER_REWARD', 500)
+ORDERS_MAX_FAILURES = _setting('ORDERS_MAX_FAILURES', 3)
+
+TEST_QUESTIONS = _setting('TEST_QUESTIONS', [
     {
         'question': "Указать свои имя и фамилию(не относится к правильным/не правильным ответам)",
         'type': 'name_input'
@@ -102,9 +222,26 @@ TEST_QUESTIONS = [
         ],
         'correct': 1
     }
-]
+])
+
+# Сколько клавиатур с id партнера или заявки держать в кэше keyboards.py
+KEYBOARD_CACHE_SIZE = _setting('KEYBOARD_CACHE_SIZE', 1024)
+
+# Версии теста: пользователь проходит до конца ту версию, которую начал,
+# новые прохождения идут по QUIZ_CURRENT_VERSION
+QUIZ_VERSIONS = _setting('QUIZ_VERSIONS', {1: TEST_QUESTIONS})
+# В JSON ключи — строки, номера версий нужны числами
+QUIZ_VERSIONS = {int(version): questions for version, questions in QUIZ_VERSIONS.items()}
+QUIZ_CURRENT_VERSION = _setting('QUIZ_CURRENT_VERSION', 1)
+# Сколько разных порядков вариантов ответа заготовить (1 — без перемешивания)
+QUIZ_SHUFFLE_VARIANTS = _setting('QUIZ_SHUFFLE_VARIANTS', 4)
+QUIZ_PASS_PERCENT = _setting('QUIZ_PASS_PERCENT', 80)
+
+MATERIALS_CHANNEL = _setting('MATERIALS_CHANNEL', "https://t.me/+MCIiMB4H1FI2MjVi")
+STARTER_PACK_LINK = _setting('STARTER_PACK_LINK', "https://telegra.ph/STARTER-PAK-NAREZCHIKA-11-14")
+INFO_LINK = _setting('INFO_LINK', "https://telegra.ph/Prikladnaya-infa-po-narezkam-11-14")
+SUPPORT_LINK = _setting('SUPPORT_LINK', "@lexinst_manager")
 
-MATERIALS_CHANNEL = "https://t.me/+MCIiMB4H1FI2MjVi"
-STARTER_PACK_LINK = "https://telegra.ph/STARTER-PAK-NAREZCHIKA-11-14"
-INFO_LINK = "https://telegra.ph/Prikladnaya-infa-po-narezkam-11-14"
-SUPPORT_LINK = "@lexinst_manager"
\ No newline at end of file
+_unknown = set(_file_settings) - _registered
+if _unknown:
+    raise ValueError(f"Unknown settings in {_SETTINGS_FILE}: {', '.join(sorted(_unknown))}")
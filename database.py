@@ -1,63 +1,109 @@
 import sqlite3
 import os
+import logging
+import csv
+import gzip
+import json
+import asyncio
+import functools
+import contextvars
+import queue
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache
+from metrics import track_query
+from migrations import apply_migrations
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты outbox: срочные сообщения уходят раньше массовых уведомлений о начислениях
+OUTBOX_URGENT = 0
+OUTBOX_BULK = 1
+
+
+def to_kopecks(rubles):
+    return int(round((rubles or 0) * 100))
+
+
+def reader(method):
+    """Помечает метод Database как читающий: он выполняется на соединении из пула читателей"""
+    method.is_reader = True
+    return method
+
 
 class Database:
-    def __init__(self):
-        self.connection = sqlite3.connect('bot.db', check_same_thread=False)
-        self.connection.row_factory = sqlite3.Row
-        self.create_tables()
+    STATUS_PRAGMAS = (
+        'journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store', 'busy_timeout'
+    )
 
-    def create_tables(self):
-        with self.connection:
-            self.connection.execute("""
-                CREATE TABLE IF NOT EXISTS partners (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    full_name TEXT,
-                    promo_code TEXT UNIQUE,
-                    referrals INTEGER DEFAULT 0,
-                    balance REAL DEFAULT 0,
-                    is_active BOOLEAN DEFAULT FALSE,
-                    registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            self.connection.execute("""
-                CREATE TABLE IF NOT EXISTS test_results (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER REFERENCES partners(user_id),
-                    score INTEGER,
-                    total_questions INTEGER,
-                    passed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            self.connection.execute("""
-                CREATE TABLE IF NOT EXISTS withdrawal_requests (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER REFERENCES partners(user_id),
-                    amount REAL,
-                    requisites TEXT,
-                    comment TEXT,
-                    status TEXT DEFAULT 'pending',
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    processed_at TIMESTAMP
-                )
-            """)
-            
-            self.connection.execute("""
-                CREATE TABLE IF NOT EXISTS used_promo_codes (
-                    promo_code TEXT PRIMARY KEY,
-                    user_id INTEGER REFERENCES partners(user_id)
-                )
-            """)
+    def __init__(self, path='bot.db', readers=4, profile=None, profile_name='default',
+                 partner_cache_size=10000, partner_cache_ttl=60):
+        self.path = path
+        self.readers = readers
+        self.profile = profile or {}
+        self.profile_name = profile_name
+        # Кэш строк partners; каждая запись в partners обновляет или сбрасывает его
+        self.partner_cache = LRUCache(partner_cache_size, partner_cache_ttl)
+        # Единственное соединение для записи, все изменения идут через него
+        self.connection = self._connect()
+        self.migrate()
+        self._reader_pool = queue.Queue(maxsize=readers)
+        for _ in range(readers):
+            self._reader_pool.put(self._connect())
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.row_factory = sqlite3.Row
+        for name, value in self.profile.items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        return connection
+
+    @contextmanager
+    def _reader(self):
+        connection = self._reader_pool.get()
+        try:
+            yield connection
+        finally:
+            self._reader_pool.put(connection)
+
+    def checkpoint(self):
+        """Переносит WAL в основной файл базы и обрезает его"""
+        row = self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        return {'busy': row[0], 'log_pages': row[1], 'checkpointed_pages': row[2]}
+
+    @reader
+    def storage_status(self):
+        with self._reader() as conn:
+            status = {
+                'profile': self.profile_name,
+                'schema_version': self.schema_version,
+                'partner_cache': self.partner_cache.stats(),
+            }
+            for name in self.STATUS_PRAGMAS:
+                status[name] = conn.execute(f"PRAGMA {name}").fetchone()[0]
+        wal_path = f"{self.path}-wal"
+        status['wal_size'] = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        status['db_size'] = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return status
+
+    def close(self):
+        self.connection.close()
+        while not self._reader_pool.empty():
+            self._reader_pool.get_nowait().close()
+
+    def migrate(self):
+        self.schema_version = apply_migrations(self.connection)
 
     def add_partner(self, user_id, username, full_name):
         with self.connection:
-            self.connection.execute("""
+            cursor = self.connection.execute("""
                 INSERT OR IGNORE INTO partners (user_id, username, full_name) 
                 VALUES (?, ?, ?)
             """, (user_id, username, full_name))
+        if cursor.rowcount:
+            self.partner_cache.invalidate(user_id)
 
     def set_promo_code(self, user_id, promo_code):
         try:
@@ -78,137 +124,834 @@ class Database:
                     "UPDATE partners SET promo_code = ?, is_active = TRUE WHERE user_id = ?", 
                     (promo_code, user_id)
                 )
-                return True
-        except:
+            self.partner_cache.invalidate(user_id)
+            return True
+        except sqlite3.IntegrityError as e:
+            # Промокод уже занят другим партнером (уникальный индекс partners.promo_code)
+            logger.warning("Promo code %r rejected for %s: %s", promo_code, user_id, e)
+            return False
+        except sqlite3.Error:
+            logger.exception("Failed to set promo code %r for %s", promo_code, user_id)
             return False
 
     def get_partner(self, user_id):
-        cursor = self.connection.execute("SELECT * FROM partners WHERE user_id = ?", (user_id,))
-        return cursor.fetchone()
+        partner = self.partner_cache.get(user_id)
+        if partner is None:
+            partner = self.load_partner(user_id)
+        return partner
 
-    def get_all_partners(self):
-        cursor = self.connection.execute("SELECT * FROM partners ORDER BY registered_at DESC")
-        return cursor.fetchall()
+    @reader
+    def load_partner(self, user_id):
+        """Читает партнера из базы в обход кэша и кладет результат в кэш"""
+        generation = self.partner_cache.begin_fill()
+        with self._reader() as conn:
+            cursor = conn.execute("SELECT * FROM partners WHERE user_id = ?", (user_id,))
+            partner = cursor.fetchone()
+        if partner:
+            self.partner_cache.fill(user_id, partner, generation)
+        return partner
 
-    def update_partner_stats(self, user_id, referrals_delta=0, balance_delta=0):
-        with self.connection:
-            self.connection.execute("""
-                UPDATE partners 
-                SET referrals = referrals + ?, balance = balance + ? 
-                WHERE user_id = ?
-            """, (referrals_delta, balance_delta, user_id))
+    def _keyset_page(self, conn, sql_newer, sql_older, sql_first, cursor_id, direction, limit):
+        """Общая логика keyset-пагинации от новых к старым.
+
+        direction 'next' — строки старше cursor_id, 'prev' — новее,
+        без cursor_id — первая страница. Возвращает строки страницы и
+        флаги наличия соседних страниц.
+        """
+        if cursor_id is None:
+            rows = conn.execute(sql_first, (limit + 1,)).fetchall()
+            return {'rows': rows[:limit], 'has_prev': False, 'has_next': len(rows) > limit}
+
+        if direction == 'prev':
+            rows = conn.execute(sql_newer, (cursor_id, limit + 1)).fetchall()
+            return {'rows': rows[:limit][::-1], 'has_prev': len(rows) > limit, 'has_next': True}
+
+        rows = conn.execute(sql_older, (cursor_id, limit + 1)).fetchall()
+        return {'rows': rows[:limit], 'has_prev': True, 'has_next': len(rows) > limit}
+
+    @reader
+    def get_partners_page(self, cursor_id=None, direction='next', limit=10):
+        """Страница партнеров по (registered_at, user_id), cursor_id — user_id крайней строки"""
+        with self._reader() as conn:
+            return self._keyset_page(
+                conn,
+                """
+                SELECT * FROM partners 
+                WHERE (registered_at, user_id) > (SELECT registered_at, user_id FROM partners WHERE user_id = ?) 
+                ORDER BY registered_at ASC, user_id ASC 
+                LIMIT ?
+                """,
+                """
+                SELECT * FROM partners 
+                WHERE (registered_at, user_id) < (SELECT registered_at, user_id FROM partners WHERE user_id = ?) 
+                ORDER BY registered_at DESC, user_id DESC 
+                LIMIT ?
+                """,
+                """
+                SELECT * FROM partners 
+                ORDER BY registered_at DESC, user_id DESC 
+                LIMIT ?
+                """,
+                cursor_id, direction, limit
+            )
+
+    @reader
+    def count_partners(self):
+        with self._reader() as conn:
+            return conn.execute("SELECT partners_total FROM dashboard WHERE id = 1").fetchone()[0]
 
-    def set_partner_stats(self, user_id, referrals, balance):
+    def _enqueue_message(self, chat_id, text, reply_markup=None, withdrawal_id=None):
+        """Кладет сообщение в outbox; вызывается внутри транзакции изменения.
+
+        reply_markup — клавиатура в JSON, withdrawal_id — заявка, копию
+        уведомления о которой нужно запомнить после доставки.
+        """
+        self.connection.execute(
+            "INSERT INTO outbox (chat_id, text, reply_markup, withdrawal_id) VALUES (?, ?, ?, ?)",
+            (chat_id, text, reply_markup, withdrawal_id)
+        )
+
+    def _post_ledger(self, user_id, amount_kopecks, reason, admin_id=None, withdrawal_id=None):
+        """Добавляет проводку в balance_ledger и сдвигает кэшированный partners.balance.
+
+        Вызывается внутри транзакции изменения, поэтому журнал и баланс
+        всегда меняются атомарно.
+        """
+        self.connection.execute("""
+            INSERT INTO balance_ledger (user_id, amount_kopecks, reason, admin_id, withdrawal_id) 
+            VALUES (?, ?, ?, ?, ?)
+        """, (user_id, amount_kopecks, reason, admin_id, withdrawal_id))
+        self.connection.execute("""
+            UPDATE partners 
+            SET balance = (CAST(ROUND(balance * 100) AS INTEGER) + ?) / 100.0 
+            WHERE user_id = ?
+        """, (amount_kopecks, user_id))
+
+    def _update_partner(self, user_id, apply, notify):
+        """Меняет партнера и в той же транзакции ставит уведомление в outbox.
+
+        apply(before) выполняет сами изменения, notify(before, after)
+        возвращает текст уведомления или None.
+        Возвращает строку партнера после изменения.
+        """
         with self.connection:
-            self.connection.execute("""
-                UPDATE partners 
-                SET referrals = ?, balance = ? 
-                WHERE user_id = ?
-            """, (referrals, balance, user_id))
+            before = self.connection.execute(
+                "SELECT * FROM partners WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if not before:
+                return None
+            apply(before)
+            after = self.connection.execute(
+                "SELECT * FROM partners WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            text = notify(before, after) if notify else None
+            if text:
+                self._enqueue_message(user_id, text)
+        self.partner_cache.put(user_id, after)
+        return after
+
+    def update_partner_stats(self, user_id, referrals_delta=0, balance_delta=0, notify=None,
+                             reason='manual_adjustment', admin_id=None):
+        def apply(before):
+            if referrals_delta:
+                self.connection.execute(
+                    "UPDATE partners SET referrals = referrals + ? WHERE user_id = ?",
+                    (referrals_delta, user_id)
+                )
+            if balance_delta:
+                self._post_ledger(user_id, to_kopecks(balance_delta), reason, admin_id)
+
+        return self._update_partner(user_id, apply, notify)
+
+    def set_partner_stats(self, user_id, referrals, balance, notify=None, admin_id=None):
+        def apply(before):
+            self.connection.execute(
+                "UPDATE partners SET referrals = ? WHERE user_id = ?", (referrals, user_id)
+            )
+            # Баланс не перезаписывается, а доводится до нужного значения проводкой
+            delta = to_kopecks(balance) - to_kopecks(before['balance'])
+            if delta:
+                self._post_ledger(user_id, delta, 'manual_adjustment', admin_id)
 
-    def save_test_result(self, user_id, score, total_questions):
+        return self._update_partner(user_id, apply, notify)
+
+    def save_test_result(self, user_id, score, total_questions, passed):
         with self.connection:
             self.connection.execute("""
-                INSERT INTO test_results (user_id, score, total_questions) 
-                VALUES (?, ?, ?)
-            """, (user_id, score, total_questions))
+                INSERT INTO test_results (user_id, score, total_questions, passed) 
+                VALUES (?, ?, ?, ?)
+            """, (user_id, score, total_questions, passed))
+
+    def _available_kopecks(self, conn, user_id):
+        """Баланс за вычетом сумм, удержанных под pending-заявки"""
+        row = conn.execute("""
+            SELECT CAST(ROUND(p.balance * 100) AS INTEGER) - COALESCE((
+                SELECT SUM(CAST(ROUND(w.amount * 100) AS INTEGER)) 
+                FROM withdrawal_requests w 
+                WHERE w.user_id = p.user_id AND w.status = 'pending'
+            ), 0) 
+            FROM partners p 
+            WHERE p.user_id = ?
+        """, (user_id,)).fetchone()
+        return row[0] if row else None
+
+    @reader
+    def get_available_balance(self, user_id):
+        with self._reader() as conn:
+            available = self._available_kopecks(conn, user_id)
+            return available / 100 if available is not None else None
 
-    def create_withdrawal_request(self, user_id, amount, requisites, comment):
+    def create_withdrawal_request(self, user_id, amount, requisites, comment, admin_ids=(), notify=None):
+        """Создает заявку и возвращает ее строку вместе с данными партнера.
+
+        Сумма заявки удерживается из доступного баланса, пока заявка в статусе
+        pending. Если доступных средств не хватает или произошла ошибка,
+        возвращает None. Уведомление notify(заявка) -> (текст, клавиатура в
+        JSON) ставится в outbox каждому из admin_ids в той же транзакции.
+        """
         try:
             with self.connection:
-                self.connection.execute("""
+                available = self._available_kopecks(self.connection, user_id)
+                if available is None or to_kopecks(amount) > available:
+                    return None
+                cursor = self.connection.execute("""
                     INSERT INTO withdrawal_requests (user_id, amount, requisites, comment) 
                     VALUES (?, ?, ?, ?)
                 """, (user_id, amount, requisites, comment))
-                return True
-        except:
-            return False
+                withdrawal = self._get_withdrawal(self.connection, cursor.lastrowid)
+                if notify and admin_ids:
+                    text, reply_markup = notify(withdrawal)
+                    for admin_id in admin_ids:
+                        self._enqueue_message(admin_id, text, reply_markup, withdrawal['id'])
+                return withdrawal
+        except Exception:
+            logger.exception("Error creating withdrawal request for %s", user_id)
+            return None
 
-    def get_pending_withdrawals(self):
-        cursor = self.connection.execute("""
+    @reader
+    def get_pending_withdrawals_page(self, cursor_id=None, direction='next', limit=5):
+        """Страница pending-заявок по (created_at, id), cursor_id — id крайней заявки"""
+        with self._reader() as conn:
+            return self._keyset_page(
+                conn,
+                """
+                SELECT w.*, p.username, p.full_name 
+                FROM withdrawal_requests w 
+                JOIN partners p ON w.user_id = p.user_id 
+                WHERE w.status = 'pending' 
+                  AND (w.created_at, w.id) > (SELECT created_at, id FROM withdrawal_requests WHERE id = ?) 
+                ORDER BY w.created_at ASC, w.id ASC 
+                LIMIT ?
+                """,
+                """
+                SELECT w.*, p.username, p.full_name 
+                FROM withdrawal_requests w 
+                JOIN partners p ON w.user_id = p.user_id 
+                WHERE w.status = 'pending' 
+                  AND (w.created_at, w.id) < (SELECT created_at, id FROM withdrawal_requests WHERE id = ?) 
+                ORDER BY w.created_at DESC, w.id DESC 
+                LIMIT ?
+                """,
+                """
+                SELECT w.*, p.username, p.full_name 
+                FROM withdrawal_requests w 
+                JOIN partners p ON w.user_id = p.user_id 
+                WHERE w.status = 'pending' 
+                ORDER BY w.created_at DESC, w.id DESC 
+                LIMIT ?
+                """,
+                cursor_id, direction, limit
+            )
+
+    @reader
+    def count_pending_withdrawals(self):
+        with self._reader() as conn:
+            return conn.execute(
+                "SELECT pending_withdrawals FROM dashboard WHERE id = 1"
+            ).fetchone()[0]
+
+    def _finish_withdrawal(self, withdrawal_id, status, admin_id, notify, apply=None):
+        """Переводит заявку из pending в status.
+
+        Статус меняется условным UPDATE ... WHERE status = 'pending', поэтому
+        из нескольких одновременных нажатий (у каждого админа своя копия
+        уведомления) срабатывает только первое, а повторы ничего не меняют.
+        apply(withdrawal) и уведомление из notify(withdrawal) выполняются
+        только при успешном переходе, в той же транзакции.
+        Возвращает (строка заявки, applied) или (None, False) при ошибке.
+        """
+        try:
+            with self.connection:
+                cursor = self.connection.execute("""
+                    UPDATE withdrawal_requests 
+                    SET status = ?, processed_at = CURRENT_TIMESTAMP, processed_by = ? 
+                    WHERE id = ? AND status = 'pending'
+                """, (status, admin_id, withdrawal_id))
+                applied = cursor.rowcount == 1
+                
+                withdrawal = self._get_withdrawal(self.connection, withdrawal_id)
+                if applied:
+                    if apply:
+                        apply(withdrawal)
+                        withdrawal = self._get_withdrawal(self.connection, withdrawal_id)
+                    text = notify(withdrawal) if notify else None
+                    if text:
+                        self._enqueue_message(withdrawal['user_id'], text)
+            return withdrawal, applied
+        except Exception:
+            logger.exception("Error processing withdrawal %s", withdrawal_id)
+            return None, False
+
+    def complete_withdrawal(self, withdrawal_id, notify=None, admin_id=None):
+        """Отмечает заявку выполненной и списывает удержанную сумму с баланса.
+
+        notify(withdrawal) возвращает текст уведомления партнеру, которое
+        ставится в outbox в той же транзакции. Возвращает (строка заявки, applied).
+        """
+        def apply(withdrawal):
+            self._post_ledger(
+                withdrawal['user_id'], -to_kopecks(withdrawal['amount']), 'withdrawal',
+                admin_id, withdrawal_id
+            )
+
+        withdrawal, applied = self._finish_withdrawal(
+            withdrawal_id, 'completed', admin_id, notify, apply
+        )
+        if applied:
+            self.partner_cache.invalidate(withdrawal['user_id'])
+        return withdrawal, applied
+
+    def reject_withdrawal(self, withdrawal_id, reject_reason=None, notify=None, admin_id=None):
+        """Отклоняет заявку и снимает удержание; возвращает то же, что complete_withdrawal"""
+        def apply(withdrawal):
+            # Добавляем причину отказа к существующему комментарию
+            new_comment = f"{withdrawal['comment'] or ''}\n\nПричина отказа: {reject_reason}".strip()
+            self.connection.execute(
+                "UPDATE withdrawal_requests SET comment = ? WHERE id = ?",
+                (new_comment, withdrawal_id)
+            )
+
+        return self._finish_withdrawal(
+            withdrawal_id, 'rejected', admin_id, notify, apply if reject_reason else None
+        )
+
+    def pop_withdrawal_messages(self, withdrawal_id):
+        """Возвращает копии заявки у админов и забывает их"""
+        with self.connection:
+            messages = self.connection.execute(
+                "SELECT chat_id, message_id FROM withdrawal_messages WHERE withdrawal_id = ?",
+                (withdrawal_id,)
+            ).fetchall()
+            self.connection.execute(
+                "DELETE FROM withdrawal_messages WHERE withdrawal_id = ?", (withdrawal_id,)
+            )
+        return [(row['chat_id'], row['message_id']) for row in messages]
+
+    def _get_withdrawal(self, conn, withdrawal_id):
+        return conn.execute("""
             SELECT w.*, p.username, p.full_name 
             FROM withdrawal_requests w 
             JOIN partners p ON w.user_id = p.user_id 
+            WHERE w.id = ?
+        """, (withdrawal_id,)).fetchone()
+
+    @reader
+    def get_withdrawal_by_id(self, withdrawal_id):
+        try:
+            with self._reader() as conn:
+                return self._get_withdrawal(conn, withdrawal_id)
+        except Exception:
+            logger.exception("Error getting withdrawal %s", withdrawal_id)
+            return None
+
+    @reader
+    def search_partners(self, search_term, limit=5):
+        """Поиск партнера по ID, username, имени или промокоду.
+
+        Сначала проверяются точные совпадения по первичному ключу, промокоду
+        и username, затем триграммный индекс partners_fts с ранжированием.
+        Триграммам нужно минимум 3 символа, более короткие запросы ищутся LIKE.
+        """
+        term = search_term.strip().lstrip('@')
+        if not term:
+            return []
+
+        with self._reader() as conn:
+            if term.isdigit():
+                exact = conn.execute("SELECT * FROM partners WHERE user_id = ?", (int(term),)).fetchone()
+                if exact:
+                    return [exact]
+
+            exact = conn.execute(
+                "SELECT * FROM partners WHERE promo_code = ? OR username = ? LIMIT 2", (term, term)
+            ).fetchall()
+            if len(exact) == 1:
+                return exact
+
+            if len(term) < 3:
+                cursor = conn.execute("""
+                    SELECT * FROM partners 
+                    WHERE CAST(user_id AS TEXT) LIKE ? OR username LIKE ? OR promo_code LIKE ? 
+                    LIMIT ?
+                """, (f"%{term}%", f"%{term}%", f"%{term}%", limit))
+                return cursor.fetchall()
+
+            phrase = '"' + term.replace('"', '""') + '"'
+            cursor = conn.execute("""
+                SELECT p.* 
+                FROM partners_fts f 
+                JOIN partners p ON p.user_id = f.rowid 
+                WHERE partners_fts MATCH ? 
+                ORDER BY f.rank 
+                LIMIT ?
+            """, (phrase, limit))
+            return cursor.fetchall()
+
+    # Выгрузки для экспорта: заголовки CSV берутся из алиасов колонок
+    EXPORT_QUERIES = {
+        'partners': """
+            SELECT 
+                user_id AS "User ID", 
+                COALESCE(username, '') AS "Username", 
+                full_name AS "Full Name", 
+                COALESCE(promo_code, '') AS "Promo Code", 
+                referrals AS "Referrals", 
+                balance AS "Balance", 
+                CASE WHEN is_active THEN 'Active' ELSE 'Inactive' END AS "Status", 
+                registered_at AS "Registered At" 
+            FROM partners 
+            ORDER BY registered_at DESC
+        """,
+        'withdrawals': """
+            SELECT 
+                w.id AS "ID", 
+                w.user_id AS "User ID", 
+                COALESCE(p.username, '') AS "Username", 
+                p.full_name AS "Full Name", 
+                w.amount AS "Amount", 
+                w.requisites AS "Requisites", 
+                COALESCE(w.comment, '') AS "Comment", 
+                w.created_at AS "Created At" 
+            FROM withdrawal_requests w 
+            JOIN partners p ON w.user_id = p.user_id 
             WHERE w.status = 'pending' 
             ORDER BY w.created_at DESC
-        """)
-        return cursor.fetchall()
+        """,
+    }
 
-    def complete_withdrawal(self, withdrawal_id):
-        try:
-            with self.connection:
-                cursor = self.connection.execute(
-                    "SELECT user_id, amount FROM withdrawal_requests WHERE id = ?", 
-                    (withdrawal_id,)
+    @reader
+    def export_csv(self, kind, path, batch_size=1000):
+        """Пишет выгрузку в gzip-CSV по пути path пачками по batch_size строк.
+
+        В памяти одновременно держится только одна пачка, поэтому расход
+        памяти не зависит от размера таблицы. Возвращает число строк.
+        """
+        rows_written = 0
+        with self._reader() as conn, gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+            cursor = conn.execute(self.EXPORT_QUERIES[kind])
+            writer = csv.writer(f)
+            writer.writerow([column[0] for column in cursor.description])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                rows_written += len(rows)
+        return rows_written
+
+    # Пересчет агрегатов дашборда с нуля, для проверки значений из триггеров
+    DASHBOARD_RECOMPUTE_SQL = """
+        SELECT 
+            (SELECT COUNT(*) FROM partners) AS partners_total, 
+            (SELECT COUNT(*) FROM partners WHERE is_active) AS active_partners, 
+            (SELECT COALESCE(SUM(referrals), 0) FROM partners) AS total_referrals, 
+            (SELECT COALESCE(SUM(balance), 0) FROM partners) AS outstanding_balance, 
+            (SELECT COUNT(*) FROM withdrawal_requests WHERE status = 'pending') AS pending_withdrawals, 
+            (SELECT COALESCE(SUM(amount), 0) FROM withdrawal_requests WHERE status = 'pending') AS pending_withdrawal_sum, 
+            (SELECT COUNT(*) FROM test_results) AS tests_total, 
+            (SELECT COUNT(*) FROM test_results WHERE passed) AS tests_passed
+    """
+
+    @reader
+    def get_dashboard(self):
+        """Агрегаты для админского дашборда, поддерживаются триггерами (O(1))"""
+        with self._reader() as conn:
+            return conn.execute("SELECT * FROM dashboard WHERE id = 1").fetchone()
+
+    def check_dashboard(self, repair=False):
+        """Сравнивает агрегаты дашборда с пересчетом с нуля.
+
+        Возвращает словарь {поле: (значение в дашборде, фактическое)} только
+        для разошедшихся полей. С repair=True записывает фактические значения.
+        """
+        with self.connection:
+            stored = self.connection.execute("SELECT * FROM dashboard WHERE id = 1").fetchone()
+            actual = self.connection.execute(self.DASHBOARD_RECOMPUTE_SQL).fetchone()
+            drift = {
+                name: (stored[name], actual[name])
+                for name in actual.keys()
+                if abs(stored[name] - actual[name]) > 0.005
+            }
+            if drift and repair:
+                self.connection.execute(
+                    "UPDATE dashboard SET " + ", ".join(f"{name} = ?" for name in drift) + " WHERE id = 1",
+                    [actual[name] for name in drift]
                 )
-                withdrawal = cursor.fetchone()
-                
-                if withdrawal:
-                    user_id, amount = withdrawal['user_id'], withdrawal['amount']
-                    
-                    self.connection.execute("""
-                        UPDATE withdrawal_requests 
-                        SET status = 'completed', processed_at = CURRENT_TIMESTAMP 
-                        WHERE id = ?
-                    """, (withdrawal_id,))
-                    
-                    self.connection.execute("""
-                        UPDATE partners 
-                        SET balance = balance - ? 
-                        WHERE user_id = ?
-                    """, (amount, user_id))
-                    
-                    return True
-            return False
-        except Exception as e:
-            print(f"Error completing withdrawal: {e}")
-            return False
+            return drift
 
-    def reject_withdrawal(self, withdrawal_id, reject_reason=None):
-        try:
-            with self.connection:
-                if reject_reason:
-                    # Добавляем причину отказа к существующему комментарию
-                    cursor = self.connection.execute(
-                        "SELECT comment FROM withdrawal_requests WHERE id = ?", 
-                        (withdrawal_id,)
-                    )
-                    current_comment = cursor.fetchone()['comment'] or ''
-                    
-                    new_comment = f"{current_comment}\n\nПричина отказа: {reject_reason}".strip()
-                    
-                    self.connection.execute("""
-                        UPDATE withdrawal_requests 
-                        SET status = 'rejected', processed_at = CURRENT_TIMESTAMP, comment = ?
-                        WHERE id = ?
-                    """, (new_comment, withdrawal_id))
-                else:
-                    self.connection.execute("""
-                        UPDATE withdrawal_requests 
-                        SET status = 'rejected', processed_at = CURRENT_TIMESTAMP 
-                        WHERE id = ?
-                    """, (withdrawal_id,))
-                return True
-        except Exception as e:
-            print(f"Error rejecting withdrawal: {e}")
-            return False
+    @reader
+    def get_balance_history(self, user_id, limit=5):
+        with self._reader() as conn:
+            cursor = conn.execute("""
+                SELECT * FROM balance_ledger 
+                WHERE user_id = ? 
+                ORDER BY created_at DESC, id DESC 
+                LIMIT ?
+            """, (user_id, limit))
+            return cursor.fetchall()
 
-    def get_withdrawal_by_id(self, withdrawal_id):
-        try:
-            cursor = self.connection.execute("""
-                SELECT w.*, p.username, p.full_name 
-                FROM withdrawal_requests w 
-                JOIN partners p ON w.user_id = p.user_id 
-                WHERE w.id = ?
-            """, (withdrawal_id,))
+    def rebuild_balances(self, repair=False):
+        """Сверяет partners.balance с суммой журнала по каждому партнеру.
+
+        Суммы считаются одним GROUP BY по balance_ledger. Возвращает список
+        (user_id, кэшированный баланс в копейках, баланс по журналу);
+        с repair=True расходящиеся балансы перезаписываются из журнала.
+        """
+        with self.connection:
+            mismatches = self.connection.execute("""
+                SELECT p.user_id, 
+                       CAST(ROUND(p.balance * 100) AS INTEGER) AS cached, 
+                       COALESCE(l.total, 0) AS ledger 
+                FROM partners p 
+                LEFT JOIN (
+                    SELECT user_id, SUM(amount_kopecks) AS total 
+                    FROM balance_ledger 
+                    GROUP BY user_id
+                ) l ON l.user_id = p.user_id 
+                WHERE CAST(ROUND(p.balance * 100) AS INTEGER) != COALESCE(l.total, 0)
+            """).fetchall()
+            if repair and mismatches:
+                self.connection.executemany(
+                    "UPDATE partners SET balance = ? / 100.0 WHERE user_id = ?",
+                    [(row['ledger'], row['user_id']) for row in mismatches]
+                )
+        if repair:
+            for row in mismatches:
+                self.partner_cache.invalidate(row['user_id'])
+        return [(row['user_id'], row['cached'], row['ledger']) for row in mismatches]
+
+    def _credit_partners(self, credits, reason, admin_id=None, notify=None):
+        """Пакетно начисляет рефералов и деньги внутри текущей транзакции.
+
+        credits — строки с user_id, orders и amount_kopecks. Баланс меняется
+        вместе с проводками журнала, уведомления из
+        notify(partner, orders, amount_kopecks) ставятся в outbox с
+        приоритетом OUTBOX_BULK. Кэш партнеров вызывающий сбрасывает после коммита.
+        """
+        self.connection.executemany("""
+            UPDATE partners 
+            SET referrals = referrals + ?, 
+                balance = (CAST(ROUND(balance * 100) AS INTEGER) + ?) / 100.0 
+            WHERE user_id = ?
+        """, [(row['orders'], row['amount_kopecks'], row['user_id']) for row in credits])
+        self.connection.executemany("""
+            INSERT INTO balance_ledger (user_id, amount_kopecks, reason, admin_id) 
+            VALUES (?, ?, ?, ?)
+        """, [(row['user_id'], row['amount_kopecks'], reason, admin_id) for row in credits if row['amount_kopecks']])
+        
+        if notify:
+            # Обновленные строки партнеров одним запросом: id передаются JSON-массивом
+            partners = {
+                partner['user_id']: partner
+                for partner in self.connection.execute(
+                    "SELECT * FROM partners WHERE user_id IN (SELECT value FROM json_each(?))",
+                    (json.dumps([row['user_id'] for row in credits]),)
+                )
+            }
+            self.connection.executemany("INSERT INTO outbox (chat_id, text, priority) VALUES (?, ?, ?)", [
+                (row['user_id'], notify(partners[row['user_id']], row['orders'], row['amount_kopecks']), OUTBOX_BULK)
+                for row in credits
+            ])
+
+    def import_report(self, rows, file_hash, filename=None, admin_id=None, notify=None):
+        """Применяет отчет об использовании промокодов одной транзакцией.
+
+        rows — список (promo_code, orders, amount_kopecks). Промокоды
+        сопоставляются с партнерами через уникальный индекс одним JOIN по
+        временной таблице, затем рефералы, проводки журнала и уведомления
+        из notify(partner, orders, amount_kopecks) пишутся через executemany.
+        Возвращает словарь с итогами или None, если файл уже импортировали.
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO report_imports (file_hash, filename, admin_id, rows) VALUES (?, ?, ?, ?)",
+                (file_hash, filename, admin_id, len(rows))
+            )
+            if not cursor.rowcount:
+                return None
+            import_id = cursor.lastrowid
+            
+            self.connection.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS import_rows (
+                    promo_code TEXT PRIMARY KEY,
+                    orders INTEGER,
+                    amount_kopecks INTEGER
+                )
+            """)
+            self.connection.execute("DELETE FROM temp.import_rows")
+            self.connection.executemany(
+                "INSERT INTO temp.import_rows (promo_code, orders, amount_kopecks) VALUES (?, ?, ?)", rows
+            )
+            matched = self.connection.execute("""
+                SELECT p.user_id, i.orders, i.amount_kopecks 
+                FROM temp.import_rows i 
+                JOIN partners p ON p.promo_code = i.promo_code
+            """).fetchall()
+            unknown = self.connection.execute("""
+                SELECT i.promo_code FROM temp.import_rows i 
+                WHERE NOT EXISTS (SELECT 1 FROM partners p WHERE p.promo_code = i.promo_code) 
+                LIMIT 10
+            """).fetchall()
+            
+            self._credit_partners(matched, 'report_import', admin_id, notify)
+            self.connection.execute(
+                "UPDATE report_imports SET matched = ? WHERE id = ?", (len(matched), import_id)
+            )
+            self.connection.execute("DELETE FROM temp.import_rows")
+        
+        for row in matched:
+            self.partner_cache.invalidate(row['user_id'])
+        return {
+            'rows': len(rows),
+            'matched': len(matched),
+            'referrals': sum(row['orders'] for row in matched),
+            'amount_kopecks': sum(row['amount_kopecks'] for row in matched),
+            'unknown': [row['promo_code'] for row in unknown],
+        }
+
+    def ingest_orders(self, events, reward_kopecks):
+        """Записывает события заказов и начисляет партнерам за новые заказы.
+
+        events — список (order_id, promo_code, amount, ordered_at). Повторы
+        по order_id отбрасываются первичным ключом orders. Новые строки
+        находятся по rowid больше максимального до вставки: запись идет
+        только через один поток, поэтому чужих строк в этом диапазоне нет.
+        За каждый новый заказ с известным промокодом партнер получает
+        +1 реферала и reward_kopecks. Начисления суммируются в
+        pending_order_rewards, уведомления из них ставит flush_order_rewards.
+        Все делается одной транзакцией.
+        """
+        with self.connection:
+            last_rowid = self.connection.execute(
+                "SELECT COALESCE(MAX(rowid), 0) FROM orders"
+            ).fetchone()[0]
+            self.connection.executemany("""
+                INSERT OR IGNORE INTO orders (order_id, promo_code, user_id, amount, ordered_at) 
+                VALUES (?, ?, (SELECT user_id FROM partners WHERE promo_code = ?), ?, ?)
+            """, [(order_id, code, code, amount, ordered_at) for order_id, code, amount, ordered_at in events])
+            
+            new_orders = self.connection.execute(
+                "SELECT COUNT(*) FROM orders WHERE rowid > ?", (last_rowid,)
+            ).fetchone()[0]
+            credits = self.connection.execute("""
+                SELECT user_id, COUNT(*) AS orders, COUNT(*) * ? AS amount_kopecks 
+                FROM orders 
+                WHERE rowid > ? AND user_id IS NOT NULL 
+                GROUP BY user_id
+            """, (reward_kopecks, last_rowid)).fetchall()
+            
+            self._credit_partners(credits, 'order_reward')
+            self.connection.executemany("""
+                INSERT INTO pending_order_rewards (user_id, orders, amount_kopecks) 
+                VALUES (?, ?, ?) 
+                ON CONFLICT(user_id) DO UPDATE SET 
+                    orders = orders + excluded.orders, 
+                    amount_kopecks = amount_kopecks + excluded.amount_kopecks
+            """, [(row['user_id'], row['orders'], row['amount_kopecks']) for row in credits])
+        
+        for row in credits:
+            self.partner_cache.invalidate(row['user_id'])
+        return {
+            'received': len(events),
+            'new': new_orders,
+            'duplicates': len(events) - new_orders,
+            'credited': sum(row['orders'] for row in credits),
+            'partners': len(credits),
+        }
+
+    def flush_order_rewards(self, notify):
+        """Ставит в outbox по одному уведомлению на партнера за накопленные начисления.
+
+        notify(partner, orders, amount_kopecks) возвращает текст; сообщения
+        идут с приоритетом OUTBOX_BULK и не задерживают срочные. Очередь
+        начислений очищается в той же транзакции. Возвращает число уведомлений.
+        """
+        with self.connection:
+            rewards = self.connection.execute("SELECT * FROM pending_order_rewards").fetchall()
+            partners = {
+                partner['user_id']: partner
+                for partner in self.connection.execute(
+                    "SELECT * FROM partners WHERE user_id IN (SELECT user_id FROM pending_order_rewards)"
+                )
+            }
+            messages = [
+                (row['user_id'], notify(partners[row['user_id']], row['orders'], row['amount_kopecks']), OUTBOX_BULK)
+                for row in rewards if row['user_id'] in partners
+            ]
+            self.connection.executemany("INSERT INTO outbox (chat_id, text, priority) VALUES (?, ?, ?)", messages)
+            self.connection.execute("DELETE FROM pending_order_rewards")
+        return len(messages)
+
+    @reader
+    def get_outbox_batch(self, limit, now):
+        """Неотправленные сообщения, у которых подошло время следующей попытки; срочные первыми"""
+        with self._reader() as conn:
+            cursor = conn.execute("""
+                SELECT * FROM outbox 
+                WHERE status = 'pending' AND next_attempt_at <= ? 
+                ORDER BY priority, id 
+                LIMIT ?
+            """, (now, limit))
+            return cursor.fetchall()
+
+    def ack_outbox(self, sent, failed, max_attempts):
+        """Удаляет доставленные сообщения и откладывает неудачные.
+
+        sent — список пар (id, message_id) доставленных сообщений; копии
+        уведомлений о еще не обработанных заявках запоминаются в
+        withdrawal_messages. failed — список пар (id, время следующей
+        попытки). После max_attempts попыток сообщение помечается как failed
+        и больше не отправляется.
+        """
+        with self.connection:
+            self.connection.executemany("""
+                INSERT OR IGNORE INTO withdrawal_messages (withdrawal_id, chat_id, message_id) 
+                SELECT o.withdrawal_id, o.chat_id, ? 
+                FROM outbox o 
+                JOIN withdrawal_requests w ON w.id = o.withdrawal_id 
+                WHERE o.id = ? AND w.status = 'pending'
+            """, [(message_id, i) for i, message_id in sent])
+            self.connection.executemany(
+                "DELETE FROM outbox WHERE id = ?", [(i,) for i, _ in sent]
+            )
+            self.connection.executemany("""
+                UPDATE outbox 
+                SET attempts = attempts + 1, 
+                    next_attempt_at = ?, 
+                    status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END 
+                WHERE id = ?
+            """, [(next_attempt_at, max_attempts, i) for i, next_attempt_at in failed])
+
+    @reader
+    def load_fsm_record(self, key):
+        with self._reader() as conn:
+            cursor = conn.execute(
+                "SELECT state, data, updated_at FROM fsm_storage WHERE key = ?", (key,)
+            )
             return cursor.fetchone()
-        except Exception as e:
-            print(f"Error getting withdrawal by id: {e}")
-            return None
 
-    def search_partners(self, search_term):
-        cursor = self.connection.execute("""
-            SELECT * FROM partners 
-            WHERE CAST(user_id AS TEXT) LIKE ? OR username LIKE ? OR promo_code LIKE ?
-        """, (f"%{search_term}%", f"%{search_term}%", f"%{search_term}%"))
-        return cursor.fetchall()
\ No newline at end of file
+    def save_fsm_records(self, records):
+        """Сохраняет пачку записей FSM (key, state, data, updated_at); пустые удаляются"""
+        with self.connection:
+            self.connection.executemany("""
+                INSERT OR REPLACE INTO fsm_storage (key, state, data, updated_at) 
+                VALUES (?, ?, ?, ?)
+            """, [r for r in records if r[1] is not None or r[2] != '{}'])
+            self.connection.executemany(
+                "DELETE FROM fsm_storage WHERE key = ?",
+                [(r[0],) for r in records if r[1] is None and r[2] == '{}']
+            )
+
+    def expire_fsm_records(self, before):
+        with self.connection:
+            self.connection.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (before,))
+
+class AsyncDatabase:
+    """Асинхронная обёртка над Database.
+
+    Все запросы выполняются в отдельных потоках, поэтому медленная запись
+    или fsync не блокирует event loop. Чтения распределяются по пулу
+    соединений-читателей, записи сериализуются в единственном потоке-писателе.
+    Набор методов совпадает с Database, только каждый из них нужно await-ить.
+
+    Сама база (подключения и миграции) создается не в конструкторе, а в
+    open(), который вызывается из startup-хука: импорт и сборка диспетчера
+    не трогают файл базы.
+    """
+
+    def __init__(self, open_database=Database):
+        self._open_database = open_database
+        self._db = None
+        self._read_executor = None
+        self._write_executor = None
+        # Имена методов, обертки которых закэшированы в атрибутах экземпляра
+        self._wrapped = set()
+
+    @property
+    def is_open(self):
+        return self._db is not None
+
+    async def open(self):
+        """Открывает базу в отдельном потоке, чтобы миграции не блокировали event loop"""
+        if self._db is not None:
+            return
+        database = await asyncio.to_thread(self._open_database)
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=database.readers, thread_name_prefix='db-read'
+        )
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+        self._db = database
+
+    def __getattr__(self, name):
+        if self._db is None:
+            raise RuntimeError(f"Database is not open yet, cannot call {name}")
+        method = getattr(self._db, name)
+        if not callable(method):
+            return method
+
+        executor = self._read_executor if getattr(method, 'is_reader', False) else self._write_executor
+
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            started_at = time.perf_counter()
+            try:
+                # Контекст апдейта (для логов) переносится в поток базы
+                return await loop.run_in_executor(
+                    executor, functools.partial(contextvars.copy_context().run, method, *args, **kwargs)
+                )
+            finally:
+                # Время считается вместе с ожиданием свободного потока
+                track_query(name, started_at)
+
+        # Обертка привязана к текущим базе и потокам, close() ее сбрасывает
+        setattr(self, name, wrapper)
+        self._wrapped.add(name)
+        return wrapper
+
+    async def get_partner(self, user_id):
+        # Попадание в кэш отдаем сразу, без перехода в поток
+        partner = self._db.partner_cache.get(user_id) if self._db is not None else None
+        if partner is None:
+            partner = await self.load_partner(user_id)
+        return partner
+
+    async def run_checkpoints(self, interval):
+        """Периодический wal_checkpoint, запускается фоновой задачей"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.checkpoint()
+            except sqlite3.Error:
+                logger.exception("WAL checkpoint failed")
+
+    def close(self):
+        if self._db is None:
+            return
+        for name in self._wrapped:
+            delattr(self, name)
+        self._wrapped.clear()
+        self._read_executor.shutdown(wait=True)
+        self._write_executor.shutdown(wait=True)
+        self._db.close()
+        self._db = None
@@ -0,0 +1,395 @@
+"""Бенчмарки слоя базы данных.
+
+Каждый режим — отдельная подкоманда, база создается во временном каталоге
+и удаляется после прогона:
+
+    python db_bench.py loop --rate 500 --duration 10
+    python db_bench.py profiles --operations 5000
+    python db_bench.py fsm --sessions 20000
+    python db_bench.py search --partners 1000000
+    python db_bench.py keyboards --updates 100000
+
+loop — задержки запросов и лаг event loop при вызовах Database прямо в
+    корутинах (как было до AsyncDatabase) и через AsyncDatabase.
+profiles — пропускная способность записей (update_partner_stats,
+    create_withdrawal_request) для каждого профиля из DB_PROFILES.
+fsm — шаги диалога (get/set state и data) через SQLiteStorage против
+    MemoryStorage: пропускная способность и память по tracemalloc.
+    sqlite-restart — те же сессии после перезапуска, когда кэш пуст и
+    каждая сессия сначала читается из базы.
+search — задержки search_partners по видам запросов на большой базе и,
+    для сравнения, прежнего поиска одним LIKE по трем колонкам.
+keyboards — клавиатуры на апдейт из кэша keyboards и собранные заново:
+    время сборки, память по tracemalloc и model_dump_json ответа с
+    клавиатурой. Кэш экономит только сборку, сериализация ответа остается
+    на каждый апдейт — режим проверяет, что JSON одинаковый.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from database import Database, AsyncDatabase
+from config import DB_PROFILES
+
+
+def percentiles(values):
+    """p50/p95/p99 в миллисекундах"""
+    values = sorted(values)
+    if not values:
+        return {'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0}
+    pick = lambda q: round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+    return {'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)}
+
+
+def seed_partners(db, count, batch_size=10000):
+    """Быстро заводит count партнеров (с промокодами) одной транзакцией на пачку"""
+    for start in range(0, count, batch_size):
+        with db.connection:
+            db.connection.executemany("""
+                INSERT INTO partners (user_id, username, full_name, promo_code, is_active, balance)
+                VALUES (?, ?, ?, ?, TRUE, ?)
+            """, [
+                (user_id, f"user{user_id}", f"Partner {user_id}", f"PROMO{user_id}", 1000)
+                for user_id in range(start + 1, min(start + batch_size, count) + 1)
+            ])
+
+
+async def measure_lag(stop, interval=0.001):
+    """Насколько позже запланированного просыпается корутина — лаг event loop"""
+    lags = []
+    while not stop.is_set():
+        started_at = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started_at - interval)
+    return lags
+
+
+async def run_loop_mode(db, call, rate, duration, partners, write_share):
+    """Открытая нагрузка: запросы приходят по расписанию rate в секунду.
+
+    Задержка считается от запланированного момента прихода, поэтому
+    время, пока запрос ждал занятый event loop, тоже учитывается.
+    """
+    rng = random.Random(1)
+    latencies = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(measure_lag(stop))
+
+    async def request(scheduled_at, user_id, write):
+        if write:
+            await call('update_partner_stats', user_id, referrals_delta=1, balance_delta=1)
+        elif rng.random() < 0.5:
+            await call('load_partner', user_id)
+        else:
+            await call('get_balance_history', user_id)
+        latencies.append(time.perf_counter() - scheduled_at)
+
+    tasks = []
+    started_at = time.perf_counter()
+    for i in range(int(rate * duration)):
+        scheduled_at = started_at + i / rate
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(request(
+            scheduled_at, rng.randint(1, partners), rng.random() < write_share
+        )))
+    await asyncio.gather(*tasks)
+    stop.set()
+    lags = await lag_task
+    return {
+        'requests': len(latencies),
+        'latency': percentiles(latencies),
+        'loop_lag': percentiles(lags),
+    }
+
+
+def loop_benchmark(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for mode in ('sync', 'async'):
+            database = Database(
+                os.path.join(tmp, f'{mode}.db'), profile=DB_PROFILES[args.profile],
+                profile_name=args.profile
+            )
+            seed_partners(database, args.partners)
+
+            if mode == 'sync':
+                # Как до AsyncDatabase: запрос выполняется прямо в корутине
+                async def call(name, *a, **kw):
+                    return getattr(database, name)(*a, **kw)
+                db = None
+            else:
+                db = AsyncDatabase(lambda: database)
+
+                async def call(name, *a, **kw):
+                    return await getattr(db, name)(*a, **kw)
+
+            async def run():
+                if db:
+                    await db.open()
+                return await run_loop_mode(
+                    db, call, args.rate, args.duration, args.partners, args.write_share
+                )
+
+            results[mode] = asyncio.run(run())
+            if db:
+                db.close()
+            else:
+                database.close()
+
+    print(f"Профиль {args.profile}, {args.rate} запр/с, {args.duration} с, "
+          f"доля записей {args.write_share:.0%}")
+    print(f"{'':<8}{'запросов':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}"
+          f"{'лаг p99 мс':>12}")
+    for mode, result in results.items():
+        latency = result['latency']
+        print(f"{mode:<8}{result['requests']:>10}{latency['p50_ms']:>10}{latency['p95_ms']:>10}"
+              f"{latency['p99_ms']:>10}{result['loop_lag']['p99_ms']:>12}")
+
+
+def profiles_benchmark(args):
+    print(f"{args.operations} операций каждого вида, {args.partners} партнеров")
+    print(f"{'профиль':<10}{'операция':<28}{'оп/с':>10}{'p50 мс':>10}{'p99 мс':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, profile in DB_PROFILES.items():
+            database = Database(os.path.join(tmp, f'{name}.db'), profile=profile, profile_name=name)
+            seed_partners(database, args.partners)
+            rng = random.Random(1)
+            operations = {
+                'update_partner_stats': lambda user_id: database.update_partner_stats(
+                    user_id, referrals_delta=1, balance_delta=500, reason='referral_bonus'
+                ),
+                'create_withdrawal_request': lambda user_id: database.create_withdrawal_request(
+                    user_id, 1, '0000 0000 0000 0000', None
+                ),
+            }
+            for operation, call in operations.items():
+                latencies = []
+                started_at = time.perf_counter()
+                for _ in range(args.operations):
+                    op_started_at = time.perf_counter()
+                    call(rng.randint(1, args.partners))
+                    latencies.append(time.perf_counter() - op_started_at)
+                elapsed = time.perf_counter() - started_at
+                stats = percentiles(latencies)
+                print(f"{name:<10}{operation:<28}{args.operations / elapsed:>10.0f}"
+                      f"{stats['p50_ms']:>10}{stats['p99_ms']:>10}")
+            database.close()
+
+
+async def run_fsm_dialogs(storage, sessions, steps, concurrency):
+    """Каждая сессия проходит steps шагов: читает состояние и данные и меняет их"""
+    from aiogram.fsm.storage.base import StorageKey
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def dialog(user_id):
+        key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+        async with semaphore:
+            for step in range(steps):
+                await storage.get_state(key)
+                await storage.set_state(key, f'Dialog:step{step}')
+                data = await storage.get_data(key)
+                await storage.set_data(key, {**data, f'answer_{step}': step, 'name': f'User {user_id}'})
+
+    await asyncio.gather(*(dialog(user_id) for user_id in range(1, sessions + 1)))
+
+
+def fsm_benchmark(args):
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from storage import SQLiteStorage
+
+    operations = args.sessions * args.steps * 4
+    print(f"{args.sessions} сессий по {args.steps} шагов, {operations} операций FSM")
+    print(f"{'хранилище':<16}{'оп/с':>10}{'память МБ':>12}{'пик МБ':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'fsm.db')
+
+        async def run(name, trace):
+            db = AsyncDatabase(lambda: Database(db_path))
+            await db.open()
+            if name == 'memory':
+                storage = MemoryStorage()
+            else:
+                if name == 'sqlite':
+                    await db.expire_fsm_records(float('inf'))
+                storage = SQLiteStorage(db, flush_interval=args.flush_interval)
+            flusher = asyncio.create_task(storage.run()) if name != 'memory' else None
+            if trace:
+                tracemalloc.start()
+            started_at = time.perf_counter()
+            await run_fsm_dialogs(storage, args.sessions, args.steps, args.concurrency)
+            elapsed = time.perf_counter() - started_at
+            memory = tracemalloc.get_traced_memory() if trace else None
+            tracemalloc.stop()
+            if flusher:
+                flusher.cancel()
+            await storage.close()
+            db.close()
+            return elapsed, memory
+
+        # sqlite — новые сессии, sqlite-restart — те же сессии после перезапуска:
+        # кэш пуст, и каждая сессия сначала читается из базы
+        for name in ('memory', 'sqlite', 'sqlite-restart'):
+            # Скорость без tracemalloc, память отдельным таким же прогоном
+            elapsed, _ = asyncio.run(run(name, trace=False))
+            _, (current, peak) = asyncio.run(run(name, trace=True))
+            print(f"{name:<16}{operations / elapsed:>10.0f}"
+                  f"{current / 2 ** 20:>12.1f}{peak / 2 ** 20:>10.1f}")
+
+
+# Прежний поиск: LIKE с % с обеих сторон, без индексов и без LIMIT
+LIKE_SEARCH_SQL = """
+    SELECT * FROM partners 
+    WHERE CAST(user_id AS TEXT) LIKE ? OR username LIKE ? OR promo_code LIKE ?
+"""
+
+SEARCH_TERMS = {
+    'id': lambda user_id: str(user_id),
+    'username': lambda user_id: f"@user{user_id}",
+    'promo': lambda user_id: f"PROMO{user_id}",
+    'name': lambda user_id: f"tner {user_id}",
+    'short': lambda user_id: f"r{user_id % 10}",
+    'miss': lambda user_id: f"nobody{user_id}",
+}
+
+
+def search_benchmark(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(os.path.join(tmp, 'search.db'))
+        started_at = time.perf_counter()
+        seed_partners(database, args.partners)
+        print(f"{args.partners} партнеров заведено за {time.perf_counter() - started_at:.1f} с, "
+              f"{args.queries} запросов каждого вида")
+        print(f"{'запрос':<12}{'p50 мс':>10}{'p99 мс':>10}{'LIKE p50 мс':>14}{'LIKE p99 мс':>14}")
+
+        rng = random.Random(1)
+        for kind, make_term in SEARCH_TERMS.items():
+            terms = [make_term(rng.randint(1, args.partners)) for _ in range(args.queries)]
+            latencies = []
+            for term in terms:
+                started_at = time.perf_counter()
+                database.search_partners(term)
+                latencies.append(time.perf_counter() - started_at)
+            like_latencies = []
+            for term in terms[:args.like_queries]:
+                pattern = f"%{term.lstrip('@')}%"
+                started_at = time.perf_counter()
+                database.connection.execute(LIKE_SEARCH_SQL, (pattern, pattern, pattern)).fetchall()
+                like_latencies.append(time.perf_counter() - started_at)
+            stats, like_stats = percentiles(latencies), percentiles(like_latencies)
+            like = (f"{like_stats['p50_ms']:>14}{like_stats['p99_ms']:>14}"
+                    if like_latencies else f"{'-':>14}{'-':>14}")
+            print(f"{kind:<12}{stats['p50_ms']:>10}{stats['p99_ms']:>10}{like}")
+        database.close()
+
+
+# Клавиатуры, которые бот отдает на апдейт: (функция, аргументы от id из базы)
+KEYBOARD_CALLS = [
+    ('get_main_keyboard', lambda item_id: (item_id % 10 == 0,)),
+    ('get_lk_keyboard', lambda item_id: ()),
+    ('get_cooperation_registered_keyboard', lambda item_id: ()),
+    ('get_back_inline_keyboard', lambda item_id: ()),
+    ('get_admin_keyboard', lambda item_id: ()),
+    ('get_partner_actions_keyboard', lambda item_id: (item_id,)),
+    ('get_withdrawal_actions_keyboard', lambda item_id: (item_id,)),
+    ('get_pagination_keyboard', lambda item_id: ('partners', item_id, item_id + 10, True, True)),
+]
+
+
+def keyboards_benchmark(args):
+    import keyboards
+
+    rng = random.Random(1)
+    calls = []
+    for _ in range(args.updates):
+        name, make_args = rng.choice(KEYBOARD_CALLS)
+        calls.append((getattr(keyboards, name), make_args(rng.randint(1, args.ids))))
+
+    def build(cached):
+        return [(function if cached else function.__wrapped__)(*a) for function, a in calls]
+
+    def serialize(markups):
+        # Как reply_markup уходит в Bot API и в outbox: объект сериализуется заново на каждый ответ
+        return [markup.model_dump_json(exclude_none=True) for markup in markups]
+
+    def cache_hits():
+        return sum(getattr(keyboards, name).cache_info().hits for name, _ in KEYBOARD_CALLS)
+
+    print(f"{args.updates} апдейтов, {args.ids} разных id, KEYBOARD_CACHE_SIZE={keyboards.KEYBOARD_CACHE_SIZE}")
+    print(f"{'клавиатуры':<12}{'сборка мкс':>12}{'json мкс':>10}{'КБ/апдейт':>11}{'пик МБ':>9}")
+    keyboards.warm_up()
+    dumps = {}
+    hits = cache_hits()
+    for name, cached in (('cache', True), ('no-cache', False)):
+        started_at = time.perf_counter()
+        markups = build(cached)
+        build_time = time.perf_counter() - started_at
+        if cached:
+            hits = cache_hits() - hits
+        started_at = time.perf_counter()
+        dumps[name] = serialize(markups)
+        dump_time = time.perf_counter() - started_at
+        del markups
+
+        # Память отдельным таким же прогоном: клавиатуры живы, пока апдейты в обработке
+        tracemalloc.start()
+        markups = build(cached)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del markups
+        print(f"{name:<12}{build_time / args.updates * 1e6:>12.2f}{dump_time / args.updates * 1e6:>10.2f}"
+              f"{current / args.updates / 1024:>11.2f}{peak / 2 ** 20:>9.1f}")
+
+    print(f"Попаданий в кэш: {hits / args.updates:.1%}")
+    print(f"JSON ответов совпадает: {'да' if dumps['cache'] == dumps['no-cache'] else 'НЕТ'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    modes = parser.add_subparsers(dest='mode', required=True)
+
+    loop = modes.add_parser('loop', help='задержки и лаг event loop: sync против AsyncDatabase')
+    loop.add_argument('--rate', type=int, default=500, help='запросов в секунду')
+    loop.add_argument('--duration', type=float, default=10, help='длительность, с')
+    loop.add_argument('--partners', type=int, default=10000)
+    loop.add_argument('--write-share', type=float, default=0.2, help='доля запросов на запись')
+    loop.add_argument('--profile', default='default', choices=sorted(DB_PROFILES))
+    loop.set_defaults(run=loop_benchmark)
+
+    profiles = modes.add_parser('profiles', help='пропускная способность записей по профилям')
+    profiles.add_argument('--operations', type=int, default=5000, help='операций каждого вида')
+    profiles.add_argument('--partners', type=int, default=10000)
+    profiles.set_defaults(run=profiles_benchmark)
+
+    fsm = modes.add_parser('fsm', help='SQLiteStorage против MemoryStorage: скорость и память')
+    fsm.add_argument('--sessions', type=int, default=20000)
+    fsm.add_argument('--steps', type=int, default=5, help='шагов диалога на сессию')
+    fsm.add_argument('--concurrency', type=int, default=200, help='сессий одновременно')
+    fsm.add_argument('--flush-interval', type=float, default=1.0, help='интервал сброса SQLiteStorage, с')
+    fsm.set_defaults(run=fsm_benchmark)
+
+    search = modes.add_parser('search', help='задержки поиска партнеров на большой базе')
+    search.add_argument('--partners', type=int, default=1000000)
+    search.add_argument('--queries', type=int, default=500, help='запросов каждого вида')
+    search.add_argument('--like-queries', type=int, default=20,
+                        help='запросов каждого вида прежним LIKE (0 — не сравнивать)')
+    search.set_defaults(run=search_benchmark)
+
+    keyboards = modes.add_parser('keyboards', help='клавиатуры из кэша против сборки на каждый апдейт')
+    keyboards.add_argument('--updates', type=int, default=100000)
+    keyboards.add_argument('--ids', type=int, default=10000,
+                           help='разных id партнеров и заявок в клавиатурах')
+    keyboards.set_defaults(run=keyboards_benchmark)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,47 @@
-import csv
-import io
-from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, BufferedInputFile
+import os
+import asyncio
+import hashlib
+import tempfile
+from aiogram import Bot, Router, F
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import Message, CallbackQuery, FSInputFile
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from config import ADMIN_IDS
-from database import Database
+from database import AsyncDatabase
+from notifications import Notifier
+from middlewares import IsAdmin
+import metrics
+from reports import parse_report, ReportError
 from keyboards import *
 
+# Все хендлеры модуля только для админов: роль проверяется один раз на роутере
 router = Router()
-db = Database()
+router.message.filter(IsAdmin())
+router.callback_query.filter(IsAdmin())
+
+# Подключается после router: отвечает не-админам на админские команды и кнопки
+denied_router = Router()
+
+# callback_data админских кнопок: точные значения и префиксы
+ADMIN_CALLBACKS = (
+    "dashboard", "partners_table", "search_partner", "withdrawal_log",
+    "export_data", "import_report", "cancel_reject", "back_to_admin",
+)
+ADMIN_CALLBACK_PREFIXES = (
+    "partners_next_", "partners_prev_", "withdrawals_next_", "withdrawals_prev_",
+    "add_ref_", "add_balance_", "edit_manual_", "complete_withdrawal_", "reject_withdrawal_",
+)
+
+# Bot API отдает боту файлы не больше 20 МБ
+MAX_REPORT_SIZE = 20 * 1024 * 1024
+
+# Сколько партнеров показывать в результатах поиска
+SEARCH_RESULTS_LIMIT = 5
+# Размеры страниц таблицы партнеров и лога выплат
+PARTNERS_PAGE_SIZE = 10
+WITHDRAWALS_PAGE_SIZE = 5
 
 class SearchStates(StatesGroup):
     waiting_for_search = State()
@@ -23,19 +53,11 @@ class EditStates(StatesGroup):
 class RejectWithdrawalStates(StatesGroup):
     waiting_for_reason = State()
 
-async def notify_partner(bot, user_id, message_text):
-    """Функция для уведомления партнера"""
-    try:
-        await bot.send_message(user_id, message_text)
-    except Exception as e:
-        print(f"Failed to notify partner {user_id}: {e}")
+class ImportStates(StatesGroup):
+    waiting_for_file = State()
 
 @router.message(F.text == "👑 Админ панель")
 async def admin_panel(message: Message):
-    if message.from_user.id not in ADMIN_IDS:
-        await message.answer("Доступ запрещен")
-        return
-    
     await message.answer(
         "👑 Админ панель\n\n"
         "Выберите действие:",
@@ -44,30 +66,136 @@ async def admin_panel(message: Message):
 
 @router.message(Command("admin"))
 async def admin_command(message: Message):
-    if message.from_user.id not in ADMIN_IDS:
-        await message.answer("Доступ запрещен")
-        return
-    
     await message.answer(
         "👑 Админ панель\n\n"
         "Выберите действие:",
         reply_markup=get_admin_keyboard()
     )
 
-@router.callback_query(F.data == "partners_table")
-async def show_partners_table(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
+@router.message(Command("db_status"))
+async def db_status(message: Message, db: AsyncDatabase):
+    status = await db.storage_status()
+
+    text = "🗄 Состояние базы данных:\n\n"
+    text += f"Профиль: {status['profile']}\n"
+    text += f"Версия схемы: {status['schema_version']}\n"
+    for name in ('journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store', 'busy_timeout'):
+        text += f"{name}: {status[name]}\n"
+    text += f"\nРазмер базы: {status['db_size'] / 1024:.1f} KB\n"
+    text += f"Размер WAL: {status['wal_size'] / 1024:.1f} KB\n"
+    cache = status['partner_cache']
+    text += f"\nКэш партнеров: {cache['size']} записей, попаданий {cache['hits']}, промахов {cache['misses']}"
+
+    await message.answer(text)
+
+def parse_page_callback(data):
+    """Разбирает callback_data вида {prefix}_{next|prev}_{id}; для первой страницы (None, 'next')"""
+    parts = data.rsplit("_", 2)
+    if len(parts) == 3 and parts[1] in ('next', 'prev') and parts[2].isdigit():
+        return int(parts[2]), parts[1]
+    return None, 'next'
+
+def format_dashboard(stats):
+    pass_rate = stats['tests_passed'] / stats['tests_total'] * 100 if stats['tests_total'] else 0
+    return (
+        "📈 Дашборд\n\n"
+        f"👥 Партнеров: {stats['partners_total']} (активных: {stats['active_partners']})\n"
+        f"🤝 Всего рефералов: {stats['total_referrals']}\n"
+        f"💰 Баланс к выплате: {stats['outstanding_balance']:.2f} руб.\n"
+        f"⏳ Заявок на вывод: {stats['pending_withdrawals']} на {stats['pending_withdrawal_sum']:.2f} руб.\n"
+        f"📝 Тестов пройдено: {stats['tests_passed']}/{stats['tests_total']} ({pass_rate:.1f}%)"
+    )
+
+@router.message(Command("dashboard"))
+async def dashboard_command(message: Message, db: AsyncDatabase):
+    stats = await db.get_dashboard()
+    await message.answer(format_dashboard(stats), reply_markup=get_admin_keyboard())
+
+@router.callback_query(F.data == "dashboard")
+async def show_dashboard(callback: CallbackQuery, db: AsyncDatabase):
+    stats = await db.get_dashboard()
+    await callback.message.edit_text(format_dashboard(stats), reply_markup=get_admin_keyboard())
+    await callback.answer()
+
+@router.message(Command("dashboard_check"))
+async def dashboard_check(message: Message, db: AsyncDatabase):
+    # /dashboard_check fix — исправить найденные расхождения
+    repair = message.text.strip().endswith("fix")
+    drift = await db.check_dashboard(repair=repair)
+    
+    if not drift:
+        await message.answer("✅ Агрегаты дашборда совпадают с данными")
         return
     
-    partners = db.get_all_partners()
+    text = "⚠️ Расхождения в дашборде:\n\n"
+    for name, (stored, actual) in drift.items():
+        text += f"{name}: в дашборде {stored}, фактически {actual}\n"
+    text += "\n✅ Исправлено" if repair else "\nЧтобы исправить: /dashboard_check fix"
+    await message.answer(text)
+
+@router.message(Command("rebuild_balances"))
+async def rebuild_balances(message: Message, db: AsyncDatabase):
+    # /rebuild_balances fix — пересчитать расходящиеся балансы по журналу
+    repair = message.text.strip().endswith("fix")
+    mismatches = await db.rebuild_balances(repair=repair)
+    
+    if not mismatches:
+        await message.answer("✅ Балансы всех партнеров совпадают с журналом операций")
+        return
+    
+    text = f"⚠️ Расхождения с журналом: {len(mismatches)}\n\n"
+    for user_id, cached, ledger in mismatches[:20]:
+        text += f"ID {user_id}: в профиле {cached / 100:.2f}, по журналу {ledger / 100:.2f} руб.\n"
+    if len(mismatches) > 20:
+        text += f"... и еще {len(mismatches) - 20}\n"
+    text += "\n✅ Исправлено" if repair else "\nЧтобы исправить: /rebuild_balances fix"
+    await message.answer(text)
+
+@router.message(Command("stats_internal"))
+async def stats_internal(message: Message):
+    # Самые тяжелые хендлеры и методы базы по суммарному времени
+    def top(histogram, limit=8):
+        rows = sorted(histogram.samples().items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        lines = []
+        for (name,), (counts, total_sum, count) in rows:
+            p95 = histogram.quantile(0.95, counts, count)
+            lines.append(f"{name}: {count} шт., сред. {total_sum / count * 1000:.1f} мс, p95 ≤ {p95 * 1000:.0f} мс")
+        return lines or ["нет данных"]
+    
+    text = "📟 Внутренняя статистика\n\n⏱ Хендлеры:\n"
+    text += "\n".join(top(metrics.HANDLER_LATENCY))
+    text += "\n\n🗄 Запросы к базе:\n"
+    text += "\n".join(top(metrics.DB_QUERY_LATENCY))
+    
+    per_update = metrics.DB_QUERIES_PER_UPDATE.samples().get(())
+    if per_update:
+        text += f"\nВ среднем на апдейт: {per_update[1] / per_update[2]:.2f}"
+    
+    requests = metrics.TELEGRAM_REQUESTS.samples()
+    ok = sum(v for (_, result), v in requests.items() if result == 'ok')
+    failed = sum(v for (_, result), v in requests.items() if result != 'ok')
+    retries = sum(metrics.TELEGRAM_RETRIES.samples().values())
+    errors = sum(metrics.HANDLER_ERRORS.samples().values())
+    text += f"\n\n📡 Telegram API: {ok} успешно, {failed} ошибок, {retries} повторов"
+    text += f"\n💥 Исключений в хендлерах: {errors}"
+    await message.answer(text)
+
+@router.callback_query(F.data == "partners_table")
+@router.callback_query(F.data.startswith("partners_next_") | F.data.startswith("partners_prev_"))
+async def show_partners_table(callback: CallbackQuery, db: AsyncDatabase):
+    cursor_id, direction = parse_page_callback(callback.data)
+    page = await db.get_partners_page(cursor_id, direction, limit=PARTNERS_PAGE_SIZE)
+    partners = page['rows']
     
     if not partners:
         await callback.message.edit_text("Партнеры не найдены", reply_markup=get_admin_keyboard())
+        await callback.answer()
         return
     
-    text = "📋 Таблица партнеров:\n\n"
-    for partner in partners[:10]:
+    total = await db.count_partners()
+    
+    text = f"📋 Таблица партнеров (всего {total}):\n\n"
+    for partner in partners:
         text += f"👤 {partner['full_name']}\n"
         text += f"ID: {partner['user_id']} | @{partner['username'] or 'нет'}\n"
         text += f"🎁 Промокод: {partner['promo_code'] or 'нет'}\n"
@@ -76,18 +204,16 @@ async def show_partners_table(callback: CallbackQuery):
         text += f"📅 {registered_date}\n"
         text += "─" * 30 + "\n"
     
-    if len(partners) > 10:
-        text += f"\n... и еще {len(partners) - 10} партнеров"
-    
-    await callback.message.edit_text(text, reply_markup=get_admin_keyboard())
+    await callback.message.edit_text(
+        text,
+        reply_markup=get_pagination_keyboard(
+            "partners", partners[0]['user_id'], partners[-1]['user_id'], page['has_prev'], page['has_next']
+        )
+    )
     await callback.answer()
 
 @router.callback_query(F.data == "search_partner")
 async def search_partner_start(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
-        return
-    
     await state.set_state(SearchStates.waiting_for_search)
     await callback.message.edit_text(
         "🔍 Поиск партнера\n\n"
@@ -97,9 +223,10 @@ async def search_partner_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(SearchStates.waiting_for_search)
-async def process_search(message: Message, state: FSMContext):
+async def process_search(message: Message, state: FSMContext, db: AsyncDatabase):
     search_term = message.text.strip()
-    partners = db.search_partners(search_term)
+    # Берем на одного больше, чтобы понять, что есть еще результаты
+    partners = await db.search_partners(search_term, limit=SEARCH_RESULTS_LIMIT + 1)
     
     if not partners:
         await message.answer("Партнеры не найдены", reply_markup=get_admin_keyboard())
@@ -128,46 +255,35 @@ async def process_search(message: Message, state: FSMContext):
         await message.answer(text, reply_markup=get_partner_actions_keyboard(partner['user_id']))
     else:
         text = "🔍 Найдено несколько партнеров:\n\n"
-        for partner in partners[:5]:
+        for partner in partners[:SEARCH_RESULTS_LIMIT]:
             text += f"👤 {partner['full_name']} (ID: {partner['user_id']})\n"
             text += f"   @{partner['username'] or 'нет'} | 🎁 {partner['promo_code'] or 'нет'}\n"
             text += f"   👥 {partner['referrals']} | 💰 {partner['balance']} руб.\n\n"
         
-        if len(partners) > 5:
-            text += f"... и еще {len(partners) - 5} партнеров"
+        if len(partners) > SEARCH_RESULTS_LIMIT:
+            text += "... найдено больше, уточните запрос"
         
         await message.answer(text, reply_markup=get_admin_keyboard())
     
     await state.clear()
 
 @router.callback_query(F.data.startswith("add_ref_"))
-async def add_referral(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
-        return
-    
+async def add_referral(callback: CallbackQuery, db: AsyncDatabase):
     user_id = int(callback.data.split("_")[2])
     
-    # Получаем текущие данные до изменения
-    partner_before = db.get_partner(user_id)
-    old_referrals = partner_before['referrals'] if partner_before else 0
-    
-    db.update_partner_stats(user_id, referrals_delta=1)
-    
-    partner = db.get_partner(user_id)
-    if partner:
-        # Уведомляем партнера
-        await notify_partner(
-            callback.bot,
-            user_id,
+    # Уведомление партнеру попадает в outbox в одной транзакции с начислением
+    def notification(before, after):
+        return (
             f"🎉 Вам начислен +1 реферал!\n\n"
             f"📊 Ваша статистика обновлена:\n"
-            f"👥 Было: {old_referrals} рефералов\n"
-            f"👥 Стало: {partner['referrals']} рефералов\n"
-            f"💰 Текущий баланс: {partner['balance']} руб.\n\n"
+            f"👥 Было: {before['referrals']} рефералов\n"
+            f"👥 Стало: {after['referrals']} рефералов\n"
+            f"💰 Текущий баланс: {after['balance']} руб.\n\n"
             f"Продолжайте в том же духе! 💪"
         )
-        
+    
+    partner = await db.update_partner_stats(user_id, referrals_delta=1, notify=notification)
+    if partner:
         await callback.message.edit_text(
             f"✅ +1 реферал добавлен!\n\n"
             f"👤 {partner['full_name']}\n"
@@ -179,33 +295,25 @@ async def add_referral(callback: CallbackQuery):
     await callback.answer()
 
 @router.callback_query(F.data.startswith("add_balance_"))
-async def add_balance(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
-        return
-    
+async def add_balance(callback: CallbackQuery, db: AsyncDatabase):
     user_id = int(callback.data.split("_")[2])
     
-    # Получаем текущие данные до изменения
-    partner_before = db.get_partner(user_id)
-    old_balance = partner_before['balance'] if partner_before else 0
-    
-    db.update_partner_stats(user_id, balance_delta=500)
-    
-    partner = db.get_partner(user_id)
-    if partner:
-        # Уведомляем партнера
-        await notify_partner(
-            callback.bot,
-            user_id,
+    # Уведомление партнеру попадает в outbox в одной транзакции с начислением
+    def notification(before, after):
+        return (
             f"💰 Вам начислено +500 рублей!\n\n"
             f"📊 Ваша статистика обновлена:\n"
-            f"💰 Было: {old_balance} руб.\n"
-            f"💰 Стало: {partner['balance']} руб.\n"
-            f"👥 Текущие рефералы: {partner['referrals']}\n\n"
+            f"💰 Было: {before['balance']} руб.\n"
+            f"💰 Стало: {after['balance']} руб.\n"
+            f"👥 Текущие рефералы: {after['referrals']}\n\n"
             f"Спасибо за вашу работу! 🚀"
         )
-        
+    
+    partner = await db.update_partner_stats(
+        user_id, balance_delta=500, notify=notification,
+        reason='referral_bonus', admin_id=callback.from_user.id
+    )
+    if partner:
         await callback.message.edit_text(
             f"✅ +500 руб. добавлено!\n\n"
             f"👤 {partner['full_name']}\n"
@@ -218,19 +326,9 @@ async def add_balance(callback: CallbackQuery):
 
 @router.callback_query(F.data.startswith("edit_manual_"))
 async def edit_manual_start(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
-        return
-    
     user_id = int(callback.data.split("_")[2])
     
-    # Получаем текущие данные до изменения
-    partner_before = db.get_partner(user_id)
-    await state.update_data(
-        editing_user_id=user_id,
-        old_referrals=partner_before['referrals'] if partner_before else 0,
-        old_balance=partner_before['balance'] if partner_before else 0
-    )
+    await state.update_data(editing_user_id=user_id)
     
     await state.set_state(EditStates.waiting_for_referrals)
     
@@ -256,20 +354,16 @@ async def process_referrals_edit(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, введите корректное число:")
 
 @router.message(EditStates.waiting_for_balance)
-async def process_balance_edit(message: Message, state: FSMContext):
+async def process_balance_edit(message: Message, state: FSMContext, db: AsyncDatabase):
     try:
         balance = float(message.text)
         data = await state.get_data()
         user_id = data['editing_user_id']
         referrals = data['new_referrals']
-        old_referrals = data['old_referrals']
-        old_balance = data['old_balance']
-        
-        db.set_partner_stats(user_id, referrals, balance)
         
-        partner = db.get_partner(user_id)
-        if partner:
-            # Уведомляем партнера об изменениях
+        # Уведомляем партнера об изменениях (через outbox, в той же транзакции)
+        def notification(before, after):
+            old_referrals, old_balance = before['referrals'], before['balance']
             notification_text = "📊 Ваша статистика была обновлена администратором:\n\n"
             
             if old_referrals != referrals:
@@ -285,9 +379,12 @@ async def process_balance_edit(message: Message, state: FSMContext):
                 notification_text += f"   Изменение: {balance - old_balance:+.2f} руб.\n\n"
             
             notification_text += "Если у вас есть вопросы, обращайтесь в поддержку."
-            
-            await notify_partner(message.bot, user_id, notification_text)
-            
+            return notification_text
+        
+        partner = await db.set_partner_stats(
+            user_id, referrals, balance, notify=notification, admin_id=message.from_user.id
+        )
+        if partner:
             await message.answer(
                 f"✅ Данные обновлены!\n\n"
                 f"👤 {partner['full_name']}\n"
@@ -301,19 +398,21 @@ async def process_balance_edit(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, введите корректную сумму:")
 
 @router.callback_query(F.data == "withdrawal_log")
-async def show_withdrawal_log(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
-        return
-    
-    withdrawals = db.get_pending_withdrawals()
+@router.callback_query(F.data.startswith("withdrawals_next_") | F.data.startswith("withdrawals_prev_"))
+async def show_withdrawal_log(callback: CallbackQuery, db: AsyncDatabase):
+    cursor_id, direction = parse_page_callback(callback.data)
+    page = await db.get_pending_withdrawals_page(cursor_id, direction, limit=WITHDRAWALS_PAGE_SIZE)
+    withdrawals = page['rows']
     
     if not withdrawals:
         await callback.message.edit_text("Нет pending заявок на вывод", reply_markup=get_admin_keyboard())
+        await callback.answer()
         return
     
-    text = "📊 Лог выплат (pending):\n\n"
-    for withdrawal in withdrawals[:5]:
+    total = await db.count_pending_withdrawals()
+    
+    text = f"📊 Лог выплат (pending, всего {total}):\n\n"
+    for withdrawal in withdrawals:
         text += f"🆔 Заявка #{withdrawal['id']}\n"
         text += f"👤 {withdrawal['full_name']} (@{withdrawal['username'] or 'нет'})\n"
         text += f"💰 Сумма: {withdrawal['amount']} руб.\n"
@@ -329,57 +428,87 @@ async def show_withdrawal_log(callback: CallbackQuery):
         
         text += "─" * 30 + "\n"
     
-    await callback.message.edit_text(text, reply_markup=get_admin_keyboard())
+    await callback.message.edit_text(
+        text,
+        reply_markup=get_pagination_keyboard(
+            "withdrawals", withdrawals[0]['id'], withdrawals[-1]['id'], page['has_prev'], page['has_next']
+        )
+    )
     await callback.answer()
 
+def format_withdrawal_outcome(withdrawal):
+    """Итог обработки заявки для копий уведомления у админов"""
+    if withdrawal['status'] == 'completed':
+        text = f"✅ Заявка #{withdrawal['id']} выполнена"
+    else:
+        text = f"❌ Заявка #{withdrawal['id']} отклонена"
+    text += f"\n💰 Сумма: {withdrawal['amount']} руб.\n👤 Партнер: {withdrawal['full_name']}"
+    if withdrawal['processed_by']:
+        text += f"\n👑 Обработал админ ID {withdrawal['processed_by']}"
+    return text
+
+async def update_admin_copies(db, notifier, withdrawal, skip=None):
+    """Заменяет кнопки на всех копиях заявки у админов итогом обработки"""
+    text = format_withdrawal_outcome(withdrawal)
+    for chat_id, message_id in await db.pop_withdrawal_messages(withdrawal['id']):
+        if (chat_id, message_id) != skip:
+            notifier.edit(chat_id, message_id, text)
+
 @router.callback_query(F.data.startswith("complete_withdrawal_"))
-async def complete_withdrawal(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
-        return
-    
+async def complete_withdrawal(callback: CallbackQuery, db: AsyncDatabase, notifier: Notifier):
     withdrawal_id = int(callback.data.split("_")[2])
-    success = db.complete_withdrawal(withdrawal_id)
     
-    if success:
-        # Получаем информацию о заявке для уведомления партнеру
-        withdrawal_info = db.get_withdrawal_by_id(withdrawal_id)
-        
-        if withdrawal_info:
-            # Уведомляем партнера
-            try:
-                await callback.bot.send_message(
-                    withdrawal_info['user_id'],
-                    f"✅ Ваша заявка на вывод #{withdrawal_id} выполнена!\n\n"
-                    f"💸 Сумма: {withdrawal_info['amount']} руб.\n"
-                    f"📋 Реквизиты: {withdrawal_info['requisites']}\n"
-                    f"⏰ Дата выполнения: {withdrawal_info['processed_at'] or 'только что'}\n\n"
-                    f"Средства были переведены на указанные реквизиты.\n"
-                    f"Если у вас есть вопросы, обращайтесь в поддержку."
-                )
-            except Exception as e:
-                print(f"Failed to notify partner {withdrawal_info['user_id']}: {e}")
-        
+    # Уведомление партнеру попадает в outbox в одной транзакции со списанием
+    def notification(withdrawal_info):
+        return (
+            f"✅ Ваша заявка на вывод #{withdrawal_id} выполнена!\n\n"
+            f"💸 Сумма: {withdrawal_info['amount']} руб.\n"
+            f"📋 Реквизиты: {withdrawal_info['requisites']}\n"
+            f"⏰ Дата выполнения: {withdrawal_info['processed_at'] or 'только что'}\n\n"
+            f"Средства были переведены на указанные реквизиты.\n"
+            f"Если у вас есть вопросы, обращайтесь в поддержку."
+        )
+    
+    # Повторное нажатие (свое или другого админа) ничего не списывает
+    withdrawal_info, applied = await db.complete_withdrawal(
+        withdrawal_id, notify=notification, admin_id=callback.from_user.id
+    )
+    
+    if not withdrawal_info:
+        await callback.message.edit_text(
+            "❌ Ошибка при выполнении выплаты",
+            reply_markup=get_admin_keyboard()
+        )
+    elif applied:
         await callback.message.edit_text(
             f"✅ Выплата #{withdrawal_id} выполнена! Партнер уведомлен.",
             reply_markup=get_admin_keyboard()
         )
+        await update_admin_copies(
+            db, notifier, withdrawal_info,
+            skip=(callback.message.chat.id, callback.message.message_id)
+        )
     else:
         await callback.message.edit_text(
-            "❌ Ошибка при выполнении выплаты",
+            f"⚠️ Заявка уже обработана\n\n{format_withdrawal_outcome(withdrawal_info)}",
             reply_markup=get_admin_keyboard()
         )
     
     await callback.answer()
 
 @router.callback_query(F.data.startswith("reject_withdrawal_"))
-async def reject_withdrawal_start(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
-        return
-    
+async def reject_withdrawal_start(callback: CallbackQuery, state: FSMContext, db: AsyncDatabase):
     withdrawal_id = int(callback.data.split("_")[2])
     
+    withdrawal = await db.get_withdrawal_by_id(withdrawal_id)
+    if withdrawal and withdrawal['status'] != 'pending':
+        await callback.message.edit_text(
+            f"⚠️ Заявка уже обработана\n\n{format_withdrawal_outcome(withdrawal)}",
+            reply_markup=get_admin_keyboard()
+        )
+        await callback.answer()
+        return
+    
     await state.set_state(RejectWithdrawalStates.waiting_for_reason)
     await state.update_data(withdrawal_id=withdrawal_id)
     
@@ -391,39 +520,40 @@ async def reject_withdrawal_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(RejectWithdrawalStates.waiting_for_reason)
-async def process_reject_reason(message: Message, state: FSMContext):
+async def process_reject_reason(message: Message, state: FSMContext, db: AsyncDatabase, notifier: Notifier):
     data = await state.get_data()
     withdrawal_id = data['withdrawal_id']
     reject_reason = message.text
     
-    # Обновляем статус заявки в базе
-    success = db.reject_withdrawal(withdrawal_id, reject_reason)
+    # Уведомление об отказе попадает в outbox в одной транзакции со сменой статуса
+    def notification(withdrawal_info):
+        return (
+            f"❌ Ваша заявка на вывод #{withdrawal_id} отклонена.\n\n"
+            f"💸 Сумма: {withdrawal_info['amount']} руб.\n"
+            f"📋 Реквизиты: {withdrawal_info['requisites']}\n"
+            f"📝 Причина отказа: {reject_reason}\n\n"
+            f"Если у вас есть вопросы, обращайтесь в поддержку."
+        )
     
-    if success:
-        # Получаем информацию о заявке
-        withdrawal_info = db.get_withdrawal_by_id(withdrawal_id)
-        
-        if withdrawal_info:
-            # Уведомляем партнера об отказе
-            try:
-                await message.bot.send_message(
-                    withdrawal_info['user_id'],
-                    f"❌ Ваша заявка на вывод #{withdrawal_id} отклонена.\n\n"
-                    f"💸 Сумма: {withdrawal_info['amount']} руб.\n"
-                    f"📋 Реквизиты: {withdrawal_info['requisites']}\n"
-                    f"📝 Причина отказа: {reject_reason}\n\n"
-                    f"Если у вас есть вопросы, обращайтесь в поддержку."
-                )
-            except Exception as e:
-                print(f"Failed to notify partner {withdrawal_info['user_id']}: {e}")
-        
+    # Пока админ писал причину, заявку мог обработать другой админ
+    withdrawal_info, applied = await db.reject_withdrawal(
+        withdrawal_id, reject_reason, notify=notification, admin_id=message.from_user.id
+    )
+    
+    if not withdrawal_info:
+        await message.answer(
+            "❌ Ошибка при отклонении заявки",
+            reply_markup=get_admin_keyboard()
+        )
+    elif applied:
         await message.answer(
             f"❌ Заявка #{withdrawal_id} отклонена! Партнер уведомлен о причине.",
             reply_markup=get_admin_keyboard()
         )
+        await update_admin_copies(db, notifier, withdrawal_info)
     else:
         await message.answer(
-            "❌ Ошибка при отклонении заявки",
+            f"⚠️ Заявка уже обработана\n\n{format_withdrawal_outcome(withdrawal_info)}",
             reply_markup=get_admin_keyboard()
         )
     
@@ -439,64 +569,32 @@ async def cancel_reject(callback: CallbackQuery, state: FSMContext):
     )
     await callback.answer()
 
+async def send_export(message, db, kind, filename, caption):
+    """Готовит выгрузку во временном файле в потоке базы и отправляет ее документом"""
+    fd, path = tempfile.mkstemp(suffix='.csv.gz')
+    os.close(fd)
+    try:
+        rows = await db.export_csv(kind, path)
+        if rows:
+            await message.answer_document(
+                document=FSInputFile(path, filename=filename),
+                caption=caption
+            )
+        return rows
+    finally:
+        os.remove(path)
+
 @router.callback_query(F.data == "export_data")
-async def export_data(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
-        return
+async def export_data(callback: CallbackQuery, db: AsyncDatabase):
+    # Отвечаем сразу: на большой базе выгрузка может занять время
+    await callback.answer("⏳ Готовим экспорт...")
     
-    partners = db.get_all_partners()
-    withdrawals = db.get_pending_withdrawals()
-    
-    if partners:
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['User ID', 'Username', 'Full Name', 'Promo Code', 'Referrals', 'Balance', 'Status', 'Registered At'])
-        
-        for partner in partners:
-            writer.writerow([
-                partner['user_id'],
-                partner['username'] or '',
-                partner['full_name'],
-                partner['promo_code'] or '',
-                partner['referrals'],
-                partner['balance'],
-                'Active' if partner['is_active'] else 'Inactive',
-                partner['registered_at']
-            ])
-        
-        csv_data = output.getvalue()
-        csv_file = BufferedInputFile(csv_data.encode(), filename="partners.csv")
-        
-        await callback.message.answer_document(
-            document=csv_file,
-            caption="📊 Экспорт данных партнеров"
-        )
-    
-    if withdrawals:
-        output = io.StringIO()
-        writer = csv.writer(output)
-        writer.writerow(['ID', 'User ID', 'Username', 'Full Name', 'Amount', 'Requisites', 'Comment', 'Created At'])
-        
-        for withdrawal in withdrawals:
-            writer.writerow([
-                withdrawal['id'],
-                withdrawal['user_id'],
-                withdrawal['username'] or '',
-                withdrawal['full_name'],
-                withdrawal['amount'],
-                withdrawal['requisites'],
-                withdrawal['comment'] or '',
-                withdrawal['created_at']
-            ])
-        
-        csv_data = output.getvalue()
-        csv_file = BufferedInputFile(csv_data.encode(), filename="withdrawals.csv")
-        
-        await callback.message.answer_document(
-            document=csv_file,
-            caption="📊 Экспорт заявок на вывод"
-        )
+    partners = await send_export(
+        callback.message, db, 'partners', "partners.csv.gz", "📊 Экспорт данных партнеров"
+    )
+    withdrawals = await send_export(
+        callback.message, db, 'withdrawals', "withdrawals.csv.gz", "📊 Экспорт заявок на вывод"
+    )
     
     if not partners and not withdrawals:
         await callback.message.edit_text(
@@ -508,18 +606,108 @@ async def export_data(callback: CallbackQuery):
             "✅ Экспорт данных завершен!",
             reply_markup=get_admin_keyboard()
         )
-    
+
+@router.callback_query(F.data == "import_report")
+async def import_report_start(callback: CallbackQuery, state: FSMContext):
+    await state.set_state(ImportStates.waiting_for_file)
+    await callback.message.edit_text(
+        "📤 Импорт отчета по промокодам\n\n"
+        "Отправьте файл .csv или .json с полями promo_code, orders, amount.\n"
+        "orders добавляется к рефералам партнера, amount (руб.) — к балансу.",
+        reply_markup=get_back_inline_keyboard()
+    )
     await callback.answer()
 
-@router.callback_query(F.data == "back_to_admin")
-async def back_to_admin(callback: CallbackQuery):
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("Доступ запрещен")
+@router.message(ImportStates.waiting_for_file, F.document)
+async def process_report_file(message: Message, state: FSMContext, db: AsyncDatabase, bot: Bot):
+    document = message.document
+    filename = document.file_name or ''
+    if not filename.lower().endswith(('.csv', '.json')):
+        await message.answer("Нужен файл .csv или .json. Отправьте отчет еще раз:")
         return
     
+    if document.file_size and document.file_size > MAX_REPORT_SIZE:
+        await state.clear()
+        await message.answer(
+            "❌ Файл больше 20 МБ, бот не может его скачать. Разбейте отчет на части.",
+            reply_markup=get_admin_keyboard()
+        )
+        return
+    
+    # Одно сообщение с прогрессом, которое редактируется по ходу импорта
+    progress = await message.answer("⏳ Загружаю файл...")
+    try:
+        content = (await bot.download(document)).read()
+    except TelegramAPIError as e:
+        await state.clear()
+        await progress.edit_text(f"❌ Не удалось скачать файл: {e}", reply_markup=get_admin_keyboard())
+        return
+    
+    await progress.edit_text("⏳ Разбираю отчет...")
+    try:
+        rows, skipped = await asyncio.to_thread(parse_report, content, filename)
+    except (ReportError, UnicodeDecodeError) as e:
+        await state.clear()
+        await progress.edit_text(f"❌ Не удалось разобрать отчет: {e}", reply_markup=get_admin_keyboard())
+        return
+    
+    await progress.edit_text(f"⏳ Применяю начисления по {len(rows)} промокодам...")
+    
+    def notification(partner, orders, amount_kopecks):
+        text = "📈 Начисления по отчету партнерской платформы:\n\n"
+        if orders:
+            text += f"👥 Новых рефералов: +{orders}\n"
+        if amount_kopecks:
+            text += f"💰 Начислено: {amount_kopecks / 100:+.2f} руб.\n"
+        text += f"\n📊 Рефералов: {partner['referrals']}\n💰 Баланс: {partner['balance']} руб."
+        return text
+    
+    result = await db.import_report(
+        rows, hashlib.sha256(content).hexdigest(), filename,
+        admin_id=message.from_user.id, notify=notification
+    )
+    await state.clear()
+    
+    if result is None:
+        await progress.edit_text("⚠️ Этот файл уже был импортирован, начисления не повторены")
+        return
+    
+    text = (
+        f"✅ Отчет импортирован\n\n"
+        f"Промокодов в отчете: {result['rows']}\n"
+        f"Найдено партнеров: {result['matched']}\n"
+        f"Рефералов начислено: {result['referrals']}\n"
+        f"Сумма начислений: {result['amount_kopecks'] / 100:.2f} руб.\n"
+    )
+    if skipped:
+        text += f"Пропущено некорректных строк: {skipped}\n"
+    if result['unknown']:
+        text += f"Неизвестные промокоды: {', '.join(result['unknown'])}"
+        if result['rows'] - result['matched'] > len(result['unknown']):
+            text += " ..."
+        text += "\n"
+    text += "\nПартнеры получат уведомления в фоне."
+    await progress.edit_text(text, reply_markup=get_admin_keyboard())
+
+@router.message(ImportStates.waiting_for_file)
+async def process_report_not_file(message: Message):
+    await message.answer("Отправьте отчет файлом .csv или .json:")
+
+@router.callback_query(F.data == "back_to_admin")
+async def back_to_admin(callback: CallbackQuery):
     await callback.message.edit_text(
         "👑 Админ панель\n\n"
         "Выберите действие:",
         reply_markup=get_admin_keyboard()
     )
-    await callback.answer()
\ No newline at end of file
+    await callback.answer()
+
+@denied_router.message(F.text == "👑 Админ панель")
+@denied_router.message(Command("admin", "db_status", "dashboard", "dashboard_check", "rebuild_balances", "stats_internal"))
+async def access_denied(message: Message):
+    await message.answer("Доступ запрещен")
+
+@denied_router.callback_query(F.data.in_(ADMIN_CALLBACKS) | F.data.startswith(ADMIN_CALLBACK_PREFIXES))
+async def access_denied_callback(callback: CallbackQuery):
+    # Кнопка могла остаться у бывшего админа в старом сообщении
+    await callback.answer("Доступ запрещен")
@@ -1,15 +1,28 @@
+from sqlite3 import Row
+from typing import Optional
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from config import TEST_QUESTIONS, MATERIALS_CHANNEL, ADMIN_IDS, STARTER_PACK_LINK, INFO_LINK, SUPPORT_LINK
-from database import Database
+from config import MATERIALS_CHANNEL, ADMIN_IDS, STARTER_PACK_LINK, INFO_LINK, SUPPORT_LINK
+from database import AsyncDatabase
+from middlewares import is_registered
+from quiz import get_quiz
 from keyboards import *
 
 router = Router()
-db = Database()
+
+# Подписи причин проводок в истории баланса
+LEDGER_REASONS = {
+    'opening': 'начальный баланс',
+    'referral_bonus': 'бонус за реферала',
+    'manual_adjustment': 'корректировка администратором',
+    'withdrawal': 'вывод средств',
+    'report_import': 'начисление по отчету',
+    'order_reward': 'заказы по промокоду',
+}
 
 class TestStates(StatesGroup):
     name = State()
@@ -23,29 +36,15 @@ class WithdrawalStates(StatesGroup):
 class PromoCodeStates(StatesGroup):
     waiting_for_promo = State()
 
-def check_registration(user_id):
-    partner = db.get_partner(user_id)
-    return partner and partner['is_active']
-
-async def notify_admins(bot, message_text):
-    for admin_id in ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, message_text)
-        except Exception as e:
-            print(f"Failed to notify admin {admin_id}: {e}")
-
 @router.message(Command("start"))
-async def start_command(message: Message):
+async def start_command(message: Message, db: AsyncDatabase, partner: Optional[Row], is_admin: bool):
     user_id = message.from_user.id
     username = message.from_user.username
     full_name = f"{message.from_user.first_name} {message.from_user.last_name or ''}".strip()
     
-    db.add_partner(user_id, username, full_name)
-    
-    is_admin = user_id in ADMIN_IDS
-    is_registered = check_registration(user_id)
+    await db.add_partner(user_id, username, full_name)
     
-    if is_registered:
+    if is_registered(partner):
         await message.answer(
             "👋 С возвращением в партнерскую программу LEXINST!\n\n"
             "Выберите раздел в меню ниже:",
@@ -60,8 +59,8 @@ async def start_command(message: Message):
         )
 
 @router.message(F.text == "👤 Личный кабинет")
-async def personal_cabinet(message: Message):
-    if not check_registration(message.from_user.id):
+async def personal_cabinet(message: Message, partner: Optional[Row]):
+    if not is_registered(partner):
         await message.answer("❌ Доступно только после регистрации. Пройдите тест и создайте промокод в разделе '🤝 Сотрудничество'")
         return
     
@@ -72,15 +71,12 @@ async def personal_cabinet(message: Message):
     )
 
 @router.message(F.text == "🤝 Сотрудничество")
-async def cooperation(message: Message):
-    partner = db.get_partner(message.from_user.id)
+async def cooperation(message: Message, partner: Optional[Row]):
     if not partner:
         await message.answer("Сначала зарегистрируйтесь через /start")
         return
     
-    is_registered = partner['is_active']
-    
-    if is_registered:
+    if partner['is_active']:
         await message.answer(
             "🤝 Сотрудничество\n\n"
             "Выберите действие:",
@@ -94,8 +90,8 @@ async def cooperation(message: Message):
         )
 
 @router.message(F.text == "💬 Связь с поддержкой")
-async def support(message: Message):
-    if not check_registration(message.from_user.id):
+async def support(message: Message, partner: Optional[Row]):
+    if not is_registered(partner):
         await message.answer("❌ Доступно только после регистрации. Пройдите тест и создайте промокод в разделе '🤝 Сотрудничество'")
         return
     
@@ -106,31 +102,39 @@ async def support(message: Message):
     )
 
 @router.callback_query(F.data == "stats")
-async def show_stats(callback: CallbackQuery):
-    if not check_registration(callback.from_user.id):
+async def show_stats(callback: CallbackQuery, db: AsyncDatabase, partner: Optional[Row]):
+    if not is_registered(partner):
         await callback.answer("❌ Доступно только после регистрации", show_alert=True)
         return
     
-    partner = db.get_partner(callback.from_user.id)
     if partner:
         registered_date = partner['registered_at']
         if isinstance(registered_date, str):
             registered_date = registered_date.split(' ')[0]
         
-        await callback.message.edit_text(
+        text = (
             f"📊 Ваша статистика:\n\n"
             f"👤 Имя: {partner['full_name']}\n"
             f"🎁 Промокод: {partner['promo_code'] or 'не создан'}\n"
             f"👥 Рефералов: {partner['referrals']}\n"
             f"💰 Баланс: {partner['balance']} руб.\n"
-            f"📅 Регистрация: {registered_date}",
-            reply_markup=get_lk_keyboard()
+            f"📅 Регистрация: {registered_date}"
         )
+        
+        history = await db.get_balance_history(callback.from_user.id)
+        if history:
+            text += "\n\n🧾 Последние операции:\n"
+            for entry in history:
+                date = str(entry['created_at']).split(' ')[0]
+                reason = LEDGER_REASONS.get(entry['reason'], entry['reason'])
+                text += f"{date}: {entry['amount_kopecks'] / 100:+.2f} руб. — {reason}\n"
+        
+        await callback.message.edit_text(text, reply_markup=get_lk_keyboard())
     await callback.answer()
 
 @router.callback_query(F.data == "article")
-async def show_article(callback: CallbackQuery):
-    if not check_registration(callback.from_user.id):
+async def show_article(callback: CallbackQuery, partner: Optional[Row]):
+    if not is_registered(partner):
         await callback.answer("❌ Доступно только после регистрации", show_alert=True)
         return
     
@@ -142,8 +146,8 @@ async def show_article(callback: CallbackQuery):
     await callback.answer()
 
 @router.callback_query(F.data == "materials")
-async def show_materials(callback: CallbackQuery):
-    if not check_registration(callback.from_user.id):
+async def show_materials(callback: CallbackQuery, partner: Optional[Row]):
+    if not is_registered(partner):
         await callback.answer("❌ Доступно только после регистрации", show_alert=True)
         return
     
@@ -154,73 +158,78 @@ async def show_materials(callback: CallbackQuery):
     await callback.answer()
 
 @router.callback_query(F.data == "start_test")
-async def start_test(callback: CallbackQuery, state: FSMContext):
-    partner = db.get_partner(callback.from_user.id)
-    if partner and partner['is_active']:
+async def start_test(callback: CallbackQuery, state: FSMContext, partner: Optional[Row]):
+    if is_registered(partner):
         await callback.answer("Вы уже прошли регистрацию!", show_alert=True)
         return
     
+    quiz = get_quiz()
     await state.set_state(TestStates.name)
-    await state.update_data(answers=[], current_question=0)
+    await state.update_data(**quiz.start(callback.from_user.id))
     
     await callback.message.edit_text(
-        TEST_QUESTIONS[0]['question'],
+        quiz.intro,
         reply_markup=None
     )
     await callback.answer()
 
+async def restart_stale_test(message, state):
+    """Прохождение, начатое до обновления бота, хранит прогресс в старом формате"""
+    await state.clear()
+    await message.answer(
+        "Тест был обновлен, пожалуйста, начните его заново.",
+        reply_markup=get_cooperation_unregistered_keyboard()
+    )
+
 @router.message(TestStates.name)
 async def process_name(message: Message, state: FSMContext):
-    await state.update_data(user_name=message.text, current_question=1)
-    await state.set_state(TestStates.answering)
+    data = await state.get_data()
+    if 'quiz_version' not in data:
+        await restart_stale_test(message, state)
+        return
+    quiz = get_quiz(data['quiz_version'])
     
-    question_data = TEST_QUESTIONS[1]
-    keyboard = get_test_keyboard(1, question_data)
+    await state.update_data(user_name=message.text)
+    await state.set_state(TestStates.answering)
     
-    await message.answer(
-        f"Вопрос 1/10:\n\n{question_data['question']}",
-        reply_markup=keyboard
-    )
+    text, keyboard = quiz.render(data)
+    await message.answer(text, reply_markup=keyboard)
 
 @router.callback_query(TestStates.answering, F.data.startswith("answer_"))
-async def process_test_answer(callback: CallbackQuery, state: FSMContext):
+async def process_test_answer(callback: CallbackQuery, state: FSMContext, db: AsyncDatabase):
     data = await state.get_data()
-    current_question = data['current_question']
-    answers = data['answers']
-    
-    answer_index = int(callback.data.split("_")[1])
-    answers.append(answer_index)
+    if 'quiz_version' not in data:
+        await restart_stale_test(callback.message, state)
+        await callback.answer()
+        return
+    quiz = get_quiz(data['quiz_version'])
     
-    current_question += 1
+    progress = quiz.answer(data, callback.data)
+    if progress is None:
+        # Кнопка от уже отвеченного вопроса
+        await callback.answer()
+        return
     
-    if current_question < len(TEST_QUESTIONS):
-        await state.update_data(answers=answers, current_question=current_question)
-        
-        question_data = TEST_QUESTIONS[current_question]
-        keyboard = get_test_keyboard(current_question, question_data)
+    if not quiz.finished(progress):
+        await state.update_data(quiz_index=progress['quiz_index'], quiz_mask=progress['quiz_mask'])
         
-        await callback.message.edit_text(
-            f"Вопрос {current_question}/10:\n\n{question_data['question']}",
-            reply_markup=keyboard
-        )
+        text, keyboard = quiz.render(progress)
+        await callback.message.edit_text(text, reply_markup=keyboard)
     else:
-        await finish_test(callback, state, answers)
+        await finish_test(callback, state, db, quiz, progress)
     
     await callback.answer()
 
-async def finish_test(callback: CallbackQuery, state: FSMContext, answers):
-    correct_answers = 0
-    total_questions = len(TEST_QUESTIONS) - 1
-    
-    for i in range(1, len(TEST_QUESTIONS)):
-        if answers[i-1] == TEST_QUESTIONS[i]['correct']:
-            correct_answers += 1
+async def finish_test(callback: CallbackQuery, state: FSMContext, db: AsyncDatabase, quiz, progress):
+    correct_answers = quiz.score(progress)
+    total_questions = quiz.total
     
     score_percentage = (correct_answers / total_questions) * 100
+    passed = quiz.passed(progress)
     
-    db.save_test_result(callback.from_user.id, correct_answers, total_questions)
+    await db.save_test_result(callback.from_user.id, correct_answers, total_questions, passed)
     
-    if score_percentage >= 80:
+    if passed:
         await callback.message.edit_text(
             f"🎉 Поздравляем! Тест пройден успешно!\n\n"
             f"Ваш результат: {correct_answers}/{total_questions} ({score_percentage:.1f}%)\n\n"
@@ -231,7 +240,7 @@ async def finish_test(callback: CallbackQuery, state: FSMContext, answers):
         await callback.message.edit_text(
             f"❌ Тест не пройден\n\n"
             f"Ваш результат: {correct_answers}/{total_questions} ({score_percentage:.1f}%)\n"
-            f"Необходимо набрать не менее 80% правильных ответов.\n\n"
+            f"Необходимо набрать не менее {quiz.pass_percent}% правильных ответов.\n\n"
             f"Попробуйте еще раз!",
             reply_markup=get_cooperation_unregistered_keyboard()
         )
@@ -239,8 +248,7 @@ async def finish_test(callback: CallbackQuery, state: FSMContext, answers):
     await state.clear()
 
 @router.callback_query(F.data == "create_promo")
-async def create_promo_start(callback: CallbackQuery, state: FSMContext):
-    partner = db.get_partner(callback.from_user.id)
+async def create_promo_start(callback: CallbackQuery, state: FSMContext, partner: Optional[Row]):
     if not partner:
         await callback.answer("Сначала зарегистрируйтесь!", show_alert=True)
         return
@@ -258,14 +266,14 @@ async def create_promo_start(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(PromoCodeStates.waiting_for_promo)
-async def process_promo_code(message: Message, state: FSMContext):
+async def process_promo_code(message: Message, state: FSMContext, db: AsyncDatabase, is_admin: bool):
     promo_code = message.text.strip()
     
     if not promo_code.isalnum():
         await message.answer("Промокод должен содержать только латинские буквы и цифры. Попробуйте еще раз:")
         return
     
-    success = db.set_promo_code(message.from_user.id, promo_code)
+    success = await db.set_promo_code(message.from_user.id, promo_code)
     
     if success:
         await message.answer(
@@ -273,7 +281,8 @@ async def process_promo_code(message: Message, state: FSMContext):
             f"Ваш промокод: <code>{promo_code}</code>\n\n"
             f"Теперь у вас есть доступ ко всем функциям бота.\n"
             f"Используйте меню для навигации.",
-            reply_markup=get_main_keyboard(message.from_user.id in ADMIN_IDS)
+            reply_markup=get_main_keyboard(is_admin),
+            parse_mode="HTML"
         )
     else:
         await message.answer(
@@ -284,28 +293,27 @@ async def process_promo_code(message: Message, state: FSMContext):
     await state.clear()
 
 @router.callback_query(F.data == "withdraw")
-async def start_withdrawal(callback: CallbackQuery, state: FSMContext):
-    if not check_registration(callback.from_user.id):
+async def start_withdrawal(callback: CallbackQuery, state: FSMContext, db: AsyncDatabase, partner: Optional[Row]):
+    if not is_registered(partner):
         await callback.answer("❌ Доступно только после регистрации", show_alert=True)
         return
     
-    partner = db.get_partner(callback.from_user.id)
     if partner:
-        balance = partner['balance']
+        # Суммы заявок, которые еще ждут обработки, уже удержаны
+        balance = await db.get_available_balance(callback.from_user.id)
         
         if balance < 1500:
             await callback.answer(
-                f"Минимальная сумма для вывода - 1500 руб. Ваш баланс: {balance} руб.", 
+                f"Минимальная сумма для вывода - 1500 руб. Доступно для вывода: {balance} руб.", 
                 show_alert=True
             )
             return
         
         await state.set_state(WithdrawalStates.amount)
-        await state.update_data(balance=balance)
         
         await callback.message.edit_text(
             f"💸 Запрос на вывод средств\n\n"
-            f"Ваш баланс: {balance} руб.\n"
+            f"Доступно для вывода: {balance} руб.\n"
             f"Минимальная сумма вывода: 1500 руб.\n\n"
             f"Введите сумму для вывода:",
             reply_markup=get_back_inline_keyboard()
@@ -313,18 +321,17 @@ async def start_withdrawal(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.message(WithdrawalStates.amount)
-async def process_withdrawal_amount(message: Message, state: FSMContext):
+async def process_withdrawal_amount(message: Message, state: FSMContext, db: AsyncDatabase):
     try:
         amount = float(message.text)
-        data = await state.get_data()
-        balance = data['balance']
+        balance = await db.get_available_balance(message.from_user.id) or 0
         
         if amount < 1500:
             await message.answer("Минимальная сумма вывода - 1500 руб. Введите сумму еще раз:")
             return
         
         if amount > balance:
-            await message.answer(f"Недостаточно средств. Ваш баланс: {balance} руб. Введите сумму еще раз:")
+            await message.answer(f"Недостаточно средств. Доступно для вывода: {balance} руб. Введите сумму еще раз:")
             return
         
         await state.update_data(amount=amount)
@@ -348,70 +355,50 @@ async def process_withdrawal_requisites(message: Message, state: FSMContext):
     )
 
 @router.message(WithdrawalStates.comment)
-async def process_withdrawal_comment(message: Message, state: FSMContext):
+async def process_withdrawal_comment(message: Message, state: FSMContext, db: AsyncDatabase, is_admin: bool):
     data = await state.get_data()
     amount = data['amount']
     requisites = data['requisites']
     comment = message.text
     
-    success = db.create_withdrawal_request(
-        message.from_user.id, amount, requisites, comment
+    # Копии заявки админам попадают в outbox в одной транзакции с ее созданием
+    def notification(withdrawal):
+        text = (
+            "🚨 НОВАЯ ЗАЯВКА НА ВЫВОД\n\n"
+            f"🆔 ID заявки: #{withdrawal['id']}\n"
+            f"👤 Партнер: {withdrawal['full_name']}\n"
+            f"📱 ID: {message.from_user.id}\n"
+            f"💰 Сумма: {amount} руб.\n"
+            f"💳 Реквизиты: {requisites}\n"
+        )
+        if comment:
+            text += f"💬 Комментарий: {comment}\n"
+        keyboard = get_withdrawal_actions_keyboard(withdrawal['id'])
+        return text, keyboard.model_dump_json(exclude_none=True)
+    
+    withdrawal = await db.create_withdrawal_request(
+        message.from_user.id, amount, requisites, comment,
+        admin_ids=ADMIN_IDS, notify=notification
     )
     
-    if success:
-        partner = db.get_partner(message.from_user.id)
-        
-        withdrawals = db.get_pending_withdrawals()
-        if withdrawals:
-            our_withdrawal = None
-            for w in withdrawals:
-                if w['user_id'] == message.from_user.id and float(w['amount']) == float(amount):
-                    our_withdrawal = w
-                    break
-            
-            if our_withdrawal:
-                withdrawal_id = our_withdrawal['id']
-                
-                withdrawal_notification = (
-                    "🚨 НОВАЯ ЗАЯВКА НА ВЫВОД\n\n"
-                    f"🆔 ID заявки: #{withdrawal_id}\n"
-                    f"👤 Партнер: {partner['full_name']}\n"
-                    f"📱 ID: {message.from_user.id}\n"
-                    f"💰 Сумма: {amount} руб.\n"
-                    f"💳 Реквизиты: {requisites}\n"
-                )
-                
-                if comment:
-                    withdrawal_notification += f"💬 Комментарий: {comment}\n"
-                
-                for admin_id in ADMIN_IDS:
-                    try:
-                        await message.bot.send_message(
-                            admin_id, 
-                            withdrawal_notification,
-                            reply_markup=get_withdrawal_actions_keyboard(withdrawal_id)
-                        )
-                    except Exception as e:
-                        print(f"Failed to notify admin {admin_id}: {e}")
-        
+    if withdrawal:
         await message.answer(
             "✅ Ваша заявка на вывод успешно отправлена!\n\n"
             "Перевод придёт в течение суток(зависит от банка). "
             "Если возникли какие-то вопросы или трудности пишите в поддержку.",
-            reply_markup=get_main_keyboard(message.from_user.id in ADMIN_IDS)
+            reply_markup=get_main_keyboard(is_admin)
         )
     else:
         await message.answer(
-            "❌ Произошла ошибка при создании заявки. Попробуйте позже.",
-            reply_markup=get_main_keyboard(message.from_user.id in ADMIN_IDS)
+            "❌ Не удалось создать заявку: недостаточно доступных средств или произошла ошибка. Попробуйте позже.",
+            reply_markup=get_main_keyboard(is_admin)
         )
     
     await state.clear()
 
 @router.callback_query(F.data == "back_to_main")
-async def back_to_main(callback: CallbackQuery, state: FSMContext):
+async def back_to_main(callback: CallbackQuery, state: FSMContext, is_admin: bool):
     await state.clear()
-    is_admin = callback.from_user.id in ADMIN_IDS
     
     await callback.message.answer(
         "👋 Добро пожаловать в партнерскую программу LEXINST!\n\n"
@@ -421,11 +408,8 @@ async def back_to_main(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 @router.callback_query(F.data == "back_to_cooperation")
-async def back_to_cooperation(callback: CallbackQuery):
-    partner = db.get_partner(callback.from_user.id)
-    is_registered = partner and partner['is_active']
-    
-    if is_registered:
+async def back_to_cooperation(callback: CallbackQuery, partner: Optional[Row]):
+    if is_registered(partner):
         await callback.message.edit_text(
             "🤝 Сотрудничество\n\n"
             "Выберите действие:",
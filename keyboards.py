@@ -1,21 +1,32 @@
+"""Клавиатуры бота.
+
+Разметка зависит только от аргументов, поэтому каждая функция кэширована:
+постоянные клавиатуры собираются один раз (warm_up() при старте), а
+клавиатуры с id партнера или заявки хранятся в ограниченном LRU.
+Возвращаемые объекты общие для всех апдейтов — их нельзя изменять.
+"""
+from functools import lru_cache
+
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from config import MATERIALS_CHANNEL, STARTER_PACK_LINK, INFO_LINK, SUPPORT_LINK
+from config import MATERIALS_CHANNEL, STARTER_PACK_LINK, INFO_LINK, SUPPORT_LINK, KEYBOARD_CACHE_SIZE
 
+_static = lru_cache(maxsize=None)
+_parameterized = lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+
+@_static
 def get_main_keyboard(is_admin=False):
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="👤 Личный кабинет")],
-            [KeyboardButton(text="🤝 Сотрудничество")],
-            [KeyboardButton(text="💬 Связь с поддержкой")]
-        ],
-        resize_keyboard=True
-    )
+    rows = [
+        [KeyboardButton(text="👤 Личный кабинет")],
+        [KeyboardButton(text="🤝 Сотрудничество")],
+        [KeyboardButton(text="💬 Связь с поддержкой")]
+    ]
     
     if is_admin:
-        keyboard.keyboard.append([KeyboardButton(text="👑 Админ панель")])
+        rows.append([KeyboardButton(text="👑 Админ панель")])
     
-    return keyboard
+    return ReplyKeyboardMarkup(keyboard=rows, resize_keyboard=True)
 
+@_static
 def get_lk_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -25,6 +36,7 @@ def get_lk_keyboard():
         ]
     )
 
+@_static
 def get_cooperation_unregistered_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -33,6 +45,7 @@ def get_cooperation_unregistered_keyboard():
         ]
     )
 
+@_static
 def get_cooperation_after_test_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -41,6 +54,7 @@ def get_cooperation_after_test_keyboard():
         ]
     )
 
+@_static
 def get_cooperation_registered_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -50,27 +64,21 @@ def get_cooperation_registered_keyboard():
         ]
     )
 
-def get_test_keyboard(question_num, question_data):
-    if question_num == 0:
-        return None
-    
-    buttons = []
-    for i in range(len(question_data['options'])):
-        buttons.append([InlineKeyboardButton(text=question_data['options'][i], callback_data=f"answer_{i}")])
-    
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
+@_static
 def get_admin_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
+            [InlineKeyboardButton(text="📈 Дашборд", callback_data="dashboard")],
             [InlineKeyboardButton(text="📋 Таблица партнеров", callback_data="partners_table")],
             [InlineKeyboardButton(text="🔍 Поиск партнера", callback_data="search_partner")],
             [InlineKeyboardButton(text="📊 Лог выплат", callback_data="withdrawal_log")],
             [InlineKeyboardButton(text="📥 Экспорт данных", callback_data="export_data")],
+            [InlineKeyboardButton(text="📤 Импорт отчета", callback_data="import_report")],
             [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
         ]
     )
 
+@_parameterized
 def get_partner_actions_keyboard(user_id):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -81,6 +89,7 @@ def get_partner_actions_keyboard(user_id):
         ]
     )
 
+@_parameterized
 def get_withdrawal_actions_keyboard(withdrawal_id):
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -90,6 +99,20 @@ def get_withdrawal_actions_keyboard(withdrawal_id):
         ]
     )
 
+@_parameterized
+def get_pagination_keyboard(prefix, first_id, last_id, has_prev, has_next):
+    """Кнопки листания: callback_data вида {prefix}_prev_{id} / {prefix}_next_{id}"""
+    navigation = []
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="⬅️", callback_data=f"{prefix}_prev_{first_id}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="➡️", callback_data=f"{prefix}_next_{last_id}"))
+    
+    buttons = [navigation] if navigation else []
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@_static
 def get_cancel_reject_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -97,6 +120,7 @@ def get_cancel_reject_keyboard():
         ]
     )
 
+@_static
 def get_article_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -107,6 +131,7 @@ def get_article_keyboard():
         ]
     )
 
+@_static
 def get_materials_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
@@ -115,9 +140,21 @@ def get_materials_keyboard():
         ]
     )
 
+@_static
 def get_back_inline_keyboard():
     return InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
         ]
-    )
\ No newline at end of file
+    )
+
+def warm_up():
+    """Собирает все постоянные клавиатуры заранее, до первого апдейта"""
+    for is_admin in (False, True):
+        get_main_keyboard(is_admin)
+    for build in (
+        get_lk_keyboard, get_cooperation_unregistered_keyboard, get_cooperation_after_test_keyboard,
+        get_cooperation_registered_keyboard, get_admin_keyboard, get_cancel_reject_keyboard,
+        get_article_keyboard, get_materials_keyboard, get_back_inline_keyboard
+    ):
+        build()
@@ -0,0 +1,452 @@
+"""Нагрузочный прогон бота без Telegram.
+
+Собирает настоящий диспетчер через main.build_dispatcher (роутеры,
+middleware, SQLite-хранилище FSM, Notifier, outbox), подменяет сессию бота
+на FakeSession, которая отвечает на запросы Bot API локально, и прогоняет
+через feed_update синтетических пользователей по полному сценарию:
+/start, тест, создание промокода, начисление админом, личный кабинет и
+статистика, заявка на вывод.
+
+С --transport webhook апдейты вместо feed_update отправляются POST-ом
+в aiohttp-приложение webhook.create_app на локальном порту, как их
+присылает Telegram. Апдейт там обрабатывается в фоне, поэтому задержка
+считается до конца его обработки диспетчером, а не до ответа 200, и
+результаты двух транспортов можно сравнивать напрямую.
+
+В конце печатает пропускную способность, p50/p95/p99 по шагам, число
+запросов к базе на апдейт, запросы к Bot API и пиковый RSS. С --json
+сохраняет то же самое в файл для сравнения между версиями.
+
+С --orders вместо сценария пользователей заводится --users партнеров с
+промокодами, в spool-каталог пишется заданное число событий заказов
+(с повторами order_id, неизвестными промокодами и битыми строками), и
+OrderSpoolWorker разбирает его так же, как в работающем боте.
+
+    python loadtest.py --users 2000 --concurrency 200 --json result.json
+    python loadtest.py --users 2000 --concurrency 200 --transport webhook
+    python loadtest.py --users 100000 --orders 3000000
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import os
+import resource
+import tempfile
+import time
+from collections import defaultdict
+
+import config
+
+# Первый id синтетических пользователей, чтобы не пересечься с ADMIN_IDS
+FIRST_USER_ID = 10 ** 12
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=1000, help='сколько пользователей прогнать')
+    parser.add_argument('--concurrency', type=int, default=100, help='сколько пользователей одновременно')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='задержка ответа фейкового Bot API, мс')
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='оставить лимиты Notifier из config (иначе сняты, иначе остановка '
+                             'будет ждать рассылку админам по 1 сообщению в секунду)')
+    parser.add_argument('--transport', choices=('polling', 'webhook'), default='polling',
+                        help='как апдейты попадают в диспетчер: feed_update или POST в webhook')
+    parser.add_argument('--orders', type=int, help='прогнать столько событий заказов через spool')
+    parser.add_argument('--orders-per-file', type=int, default=100000, help='событий в одном spool-файле')
+    parser.add_argument('--db', help='файл базы (по умолчанию временный, удаляется после прогона)')
+    parser.add_argument('--json', help='сохранить результат в файл')
+    return parser.parse_args()
+
+
+def configure(args, db_path):
+    """Подменяет настройки до импорта main, который читает их при импорте"""
+    config.DB_PATH = db_path
+    config.METRICS_PORT = None
+    config.ORDERS_SPOOL_DIR = os.path.join(os.path.dirname(db_path), 'orders_spool')
+    config.WEBHOOK_SECRET = 'loadtest-secret'
+    if not args.telegram_limits:
+        config.NOTIFY_GLOBAL_RATE = 10 ** 6
+        config.NOTIFY_CHAT_RATE = 10 ** 6
+
+
+def make_session_class():
+    from aiogram.client.session.base import BaseSession
+    from aiogram.methods import SendMessage, SendDocument
+    from aiogram.types import Chat, Message
+
+    class FakeSession(BaseSession):
+        """Сессия бота, которая отвечает на методы Bot API без сети"""
+
+        def __init__(self, latency=0.0):
+            super().__init__()
+            self.latency = latency
+            self.message_ids = itertools.count(1)
+
+        async def make_request(self, bot, method, timeout=None):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if isinstance(method, (SendMessage, SendDocument)):
+                return Message(
+                    message_id=next(self.message_ids),
+                    date=datetime.datetime.now(),
+                    chat=Chat(id=method.chat_id, type='private'),
+                    text=getattr(method, 'text', None)
+                )
+            return True
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            yield b''
+
+        async def close(self):
+            pass
+
+    return FakeSession
+
+
+class VirtualUser:
+    """Один синтетический партнер; каждый шаг — один апдейт через диспетчер"""
+
+    update_ids = itertools.count(1)
+    message_ids = itertools.count(1)
+
+    def __init__(self, runner, user_id):
+        self.runner = runner
+        self.user_id = user_id
+
+    def _user(self, user_id):
+        from aiogram.types import User
+        return User(id=user_id, is_bot=False, first_name=f'Load{user_id}', username=f'load{user_id}')
+
+    def _message(self, user_id, text):
+        from aiogram.types import Chat, Message
+        return Message(
+            message_id=next(self.message_ids),
+            date=datetime.datetime.now(),
+            chat=Chat(id=user_id, type='private'),
+            from_user=self._user(user_id),
+            text=text
+        )
+
+    async def send(self, step, text, user_id=None):
+        from aiogram.types import Update
+        user_id = user_id or self.user_id
+        update = Update(update_id=next(self.update_ids), message=self._message(user_id, text))
+        await self.runner.feed(step, update)
+
+    async def press(self, step, data, user_id=None):
+        from aiogram.types import CallbackQuery, Update
+        user_id = user_id or self.user_id
+        update = Update(update_id=next(self.update_ids), callback_query=CallbackQuery(
+            id=str(next(self.message_ids)),
+            from_user=self._user(user_id),
+            chat_instance=str(user_id),
+            message=self._message(user_id, 'x'),
+            data=data
+        ))
+        await self.runner.feed(step, update)
+
+    async def run(self):
+        from quiz import get_quiz
+
+        await self.send('start', '/start')
+        await self.send('cooperation', '🤝 Сотрудничество')
+
+        quiz = get_quiz()
+        progress = quiz.start(self.user_id)
+        await self.press('quiz_start', 'start_test')
+        await self.send('quiz_name', f'Load {self.user_id}')
+        for question in quiz.questions:
+            _, order = question.variants[progress['quiz_variant']]
+            await self.press('quiz_answer', f'answer_{question.number}_{order.index(question.correct)}')
+
+        await self.press('promo_start', 'create_promo')
+        await self.send('promo_code', f'LOAD{self.user_id}')
+
+        # Баланс для вывода начисляет админ кнопкой из карточки партнера
+        for _ in range(3):
+            await self.press('admin_add_balance', f'add_balance_{self.user_id}', user_id=self.runner.admin_id)
+
+        await self.send('cabinet', '👤 Личный кабинет')
+        await self.press('stats', 'stats')
+
+        await self.press('withdraw_start', 'withdraw')
+        await self.send('withdraw_amount', '1500')
+        await self.send('withdraw_requisites', '0000 0000 0000 0000')
+        await self.send('withdraw_comment', 'load test')
+
+
+class LoadRunner:
+    def __init__(self, args):
+        self.args = args
+        self.admin_id = min(config.ADMIN_IDS)
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bot = None
+        self.dp = None
+        # webhook: адрес приложения, HTTP-клиент и апдейты, которые еще обрабатываются
+        self.webhook_url = None
+        self.http = None
+        self.processing = {}
+
+    async def feed(self, step, update):
+        started_at = time.perf_counter()
+        try:
+            if self.webhook_url:
+                await self.post(update)
+            else:
+                await self.dp.feed_update(self.bot, update)
+        except Exception:
+            self.errors[step] += 1
+        self.latencies[step].append(time.perf_counter() - started_at)
+
+    async def post(self, update):
+        """Отправляет апдейт как Telegram и ждет, пока диспетчер его обработает"""
+        done = asyncio.get_running_loop().create_future()
+        self.processing[update.update_id] = done
+        try:
+            async with self.http.post(
+                self.webhook_url,
+                data=update.model_dump_json(by_alias=True, exclude_none=True),
+                headers={
+                    'Content-Type': 'application/json',
+                    'X-Telegram-Bot-Api-Secret-Token': config.WEBHOOK_SECRET,
+                }
+            ) as response:
+                response.raise_for_status()
+            await done
+        finally:
+            self.processing.pop(update.update_id, None)
+
+    async def track_processing(self, handler, update, data):
+        """Внешний middleware: отмечает конец обработки апдейта, пришедшего в webhook"""
+        done = self.processing.get(update.update_id)
+        try:
+            result = await handler(update, data)
+        except Exception as e:
+            if done and not done.done():
+                done.set_exception(e)
+            raise
+        if done and not done.done():
+            done.set_result(None)
+        return result
+
+    async def start_webhook(self):
+        from aiohttp import ClientSession
+        from aiohttp.test_utils import TestServer
+        import webhook
+
+        self.dp.update.outer_middleware(self.track_processing)
+        server = TestServer(webhook.create_app(self.bot, self.dp), host='127.0.0.1')
+        # Запуск сервера вызывает startup-хуки диспетчера
+        await server.start_server()
+        self.webhook_url = str(server.make_url(config.WEBHOOK_PATH))
+        self.http = ClientSession()
+        return server
+
+    async def run(self):
+        from aiogram import Bot
+        import main
+
+        session = make_session_class()(latency=self.args.api_latency / 1000)
+        self.bot = Bot('42:LOADTEST', session=session)
+        self.dp = main.build_dispatcher(self.bot)
+        server = None
+        if self.args.transport == 'webhook':
+            server = await self.start_webhook()
+        else:
+            await self.dp.emit_startup(bot=self.bot, **self.dp.workflow_data)
+
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def run_user(user_id):
+            async with semaphore:
+                await VirtualUser(self, user_id).run()
+
+        started_at = time.perf_counter()
+        try:
+            await asyncio.gather(*(
+                run_user(FIRST_USER_ID + i) for i in range(self.args.users)
+            ))
+            elapsed = time.perf_counter() - started_at
+        finally:
+            # Дожидается фоновых уведомлений и сбрасывает FSM в базу
+            if server:
+                await self.http.close()
+                await server.close()
+            else:
+                await self.dp.emit_shutdown(bot=self.bot, **self.dp.workflow_data)
+        drained = time.perf_counter() - started_at
+        return elapsed, drained
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(runner, elapsed, drained):
+    from metrics import DB_QUERY_LATENCY, DB_QUERIES_PER_UPDATE, TELEGRAM_REQUESTS
+
+    def latency_stats(values):
+        values = sorted(values)
+        return {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 2),
+        }
+
+    all_latencies = [v for values in runner.latencies.values() for v in values]
+    per_update = DB_QUERIES_PER_UPDATE.samples().get((), ([], 0.0, 0))
+    queries = {name[0]: count for name, (_, _, count) in DB_QUERY_LATENCY.samples().items()}
+    telegram = defaultdict(int)
+    for (method, result), count in TELEGRAM_REQUESTS.samples().items():
+        telegram[result] += count
+
+    return {
+        'transport': runner.args.transport,
+        'users': runner.args.users,
+        'concurrency': runner.args.concurrency,
+        'api_latency_ms': runner.args.api_latency,
+        'elapsed_s': round(elapsed, 3),
+        'drain_s': round(drained - elapsed, 3),
+        'updates': len(all_latencies),
+        'updates_per_s': round(len(all_latencies) / elapsed, 1) if elapsed else 0.0,
+        'users_per_s': round(runner.args.users / elapsed, 1) if elapsed else 0.0,
+        'errors': dict(runner.errors),
+        'latency': latency_stats(all_latencies),
+        'steps': {step: latency_stats(values) for step, values in runner.latencies.items()},
+        'db_queries_total': sum(queries.values()),
+        'db_queries_per_update': round(per_update[1] / per_update[2], 2) if per_update[2] else 0.0,
+        'db_queries': dict(sorted(queries.items(), key=lambda item: -item[1])),
+        'telegram_requests': dict(telegram),
+        # ru_maxrss в Linux в килобайтах
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def print_report(result):
+    print(f"Транспорт: {result['transport']}, пользователей: {result['users']}, одновременно: {result['concurrency']}, "
+          f"задержка API: {result['api_latency_ms']} мс")
+    print(f"Время: {result['elapsed_s']} с (+{result['drain_s']} с на остановку), "
+          f"апдейтов: {result['updates']}, {result['updates_per_s']} апд/с, "
+          f"{result['users_per_s']} польз/с")
+    latency = result['latency']
+    print(f"Задержка апдейта: p50 {latency['p50_ms']} мс, p95 {latency['p95_ms']} мс, "
+          f"p99 {latency['p99_ms']} мс")
+    print()
+    print(f"{'шаг':<22}{'апдейтов':>10}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'ошибок':>8}")
+    for step, stats in result['steps'].items():
+        print(f"{step:<22}{stats['count']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{result['errors'].get(step, 0):>8}")
+    print()
+    print(f"Запросов к базе: {result['db_queries_total']}, "
+          f"в среднем на апдейт: {result['db_queries_per_update']}")
+    for name, count in list(result['db_queries'].items())[:10]:
+        print(f"  {name:<30}{count:>10}")
+    print(f"Запросов к Bot API: {result['telegram_requests']}")
+    print(f"Пиковый RSS: {result['peak_rss_mb']} МБ")
+
+
+def write_order_spool(spool_dir, orders, per_file, partners, seed=1):
+    """Пишет orders событий в JSONL-файлы, как выгрузчик платформы.
+
+    Примерно 10% событий повторяют уже выданный order_id, 5% идут с
+    неизвестным промокодом и 0.1% — битые строки.
+    """
+    import random
+
+    rng = random.Random(seed)
+    os.makedirs(spool_dir, exist_ok=True)
+    for file_number, start in enumerate(range(0, orders, per_file)):
+        path = os.path.join(spool_dir, f'orders-{file_number:05d}.jsonl')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            for i in range(start, min(start + per_file, orders)):
+                roll = rng.random()
+                if roll < 0.001:
+                    f.write('{"order_id": "broken", "amount": {"rub": 5}}\n')
+                    continue
+                order_id = f'load-{rng.randrange(i)}' if roll < 0.1 and i else f'load-{i}'
+                promo_code = f'UNKNOWN{i}' if roll > 0.95 else f'PROMO{rng.randint(1, partners)}'
+                f.write(json.dumps({
+                    'order_id': order_id, 'promo_code': promo_code,
+                    'amount': round(rng.uniform(100, 5000), 2), 'created_at': '2024-01-01 12:00:00',
+                }) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+async def replay_orders(args):
+    """Разбирает spool-каталог OrderSpoolWorker-ом, возвращает сводку"""
+    from database import Database, AsyncDatabase
+    from db_bench import seed_partners, percentiles
+    from orders import OrderSpoolWorker, order_notification
+
+    database = Database(
+        config.DB_PATH, readers=config.DB_READERS,
+        profile=config.DB_PROFILES[config.DB_PROFILE], profile_name=config.DB_PROFILE
+    )
+    seed_partners(database, args.users)
+    write_order_spool(config.ORDERS_SPOOL_DIR, args.orders, args.orders_per_file, args.users)
+
+    db = AsyncDatabase(lambda: database)
+    await db.open()
+    worker = OrderSpoolWorker(
+        db, config.ORDERS_SPOOL_DIR, config.ORDER_REWARD, batch_size=config.ORDERS_BATCH_SIZE
+    )
+    totals = defaultdict(int)
+    file_latencies = []
+    started_at = time.perf_counter()
+    for path in worker._pending_files():
+        file_started_at = time.perf_counter()
+        for key, value in (await worker.process_file(path)).items():
+            totals[key] += value
+        file_latencies.append(time.perf_counter() - file_started_at)
+    await db.flush_order_rewards(order_notification)
+    elapsed = time.perf_counter() - started_at
+
+    outbox = database.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+    db.close()
+    return {
+        'orders': args.orders,
+        'partners': args.users,
+        'files': len(file_latencies),
+        'elapsed_s': round(elapsed, 3),
+        'orders_per_s': round(args.orders / elapsed, 1) if elapsed else 0.0,
+        'file': percentiles(file_latencies),
+        **totals,
+        'outbox_messages': outbox,
+        'db_size_mb': round(os.path.getsize(config.DB_PATH) / 2 ** 20, 1),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def print_orders_report(result):
+    print(f"Заказов: {result['orders']} в {result['files']} файлах, партнеров: {result['partners']}")
+    print(f"Время: {result['elapsed_s']} с, {result['orders_per_s']} заказов/с, "
+          f"файл: p50 {result['file']['p50_ms']} мс, p99 {result['file']['p99_ms']} мс")
+    print(f"Новых: {result['new']}, повторов: {result['duplicates']}, начислено: {result['credited']}, "
+          f"пропущено строк: {result['skipped']}, уведомлений в outbox: {result['outbox_messages']}")
+    print(f"Размер базы: {result['db_size_mb']} МБ, пиковый RSS: {result['peak_rss_mb']} МБ")
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        configure(args, args.db or os.path.join(tmp, 'loadtest.db'))
+        if args.orders:
+            result = asyncio.run(replay_orders(args))
+        else:
+            runner = LoadRunner(args)
+            result = summarize(runner, *asyncio.run(runner.run()))
+    (print_orders_report if args.orders else print_report)(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Структурированные JSON-логи.
+
+Хендлеры и потоки базы только кладут записи в очередь (QueueHandler), а
+форматирование и запись в stdout/файл делает отдельный поток
+QueueListener, поэтому вывод логов не блокирует event loop. Каждая запись
+получает update_id, user_id и имя хендлера текущего апдейта из contextvar,
+который выставляет LoggingMiddleware.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Контекст текущего апдейта: update_id, user_id, handler
+log_context = ContextVar('log_context', default={})
+
+CONTEXT_FIELDS = ('update_id', 'user_id', 'handler', 'duration_ms')
+
+
+class ContextFilter(logging.Filter):
+    """Дописывает в запись контекст апдейта; работает в потоке, где вызван логгер"""
+
+    def filter(self, record):
+        for key, value in log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не склеивает traceback с текстом сообщения.
+
+    Стандартный prepare() подставляет в msg уже отформатированную строку
+    вместе с исключением; здесь исключение сохраняется отдельно в exc_text,
+    чтобы JsonFormatter положил его в свое поле.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in CONTEXT_FIELDS:
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level='INFO', path=None):
+    """Перенаправляет корневой логгер в очередь и запускает QueueListener.
+
+    Возвращает listener; его нужно остановить при выходе, чтобы дописать
+    оставшиеся записи.
+    """
+    formatter = JsonFormatter()
+    handlers = [logging.StreamHandler(sys.stdout)]
+    if path:
+        handlers.append(logging.FileHandler(path, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class LoggingMiddleware(BaseMiddleware):
+    """Inner-middleware: выставляет контекст апдейта и пишет итог обработки"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        update = data.get('event_update')
+        user = data.get('event_from_user')
+        context = {
+            'update_id': update.update_id if update else None,
+            'user_id': user.id if user else None,
+            'handler': handler_object.callback.__name__ if handler_object else None,
+        }
+        token = log_context.set(context)
+        started_at = time.perf_counter()
+        try:
+            result = await handler(event, data)
+        except Exception:
+            logger.exception("Handler failed", extra={
+                'duration_ms': round((time.perf_counter() - started_at) * 1000, 2)
+            })
+            raise
+        else:
+            logger.info("Update handled", extra={
+                'duration_ms': round((time.perf_counter() - started_at) * 1000, 2)
+            })
+            return result
+        finally:
+            log_context.reset(token)
@@ -1,21 +1,141 @@
 import asyncio
+import functools
+import logging
+import time
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
 
-from config import BOT_TOKEN
+from config import (
+    BOT_TOKEN, BOT_PROXY, DB_PATH, DB_READERS, DB_PROFILE, DB_PROFILES, DB_CHECKPOINT_INTERVAL,
+    PARTNER_CACHE_SIZE, PARTNER_CACHE_TTL,
+    NOTIFY_CONCURRENCY, NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE, NOTIFY_MAX_RETRIES,
+    OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+    FSM_STATE_TTL, FSM_FLUSH_INTERVAL,
+    ORDERS_SPOOL_DIR, ORDERS_BATCH_SIZE, ORDERS_POLL_INTERVAL, ORDER_REWARD, ORDERS_MAX_FAILURES,
+    METRICS_HOST, METRICS_PORT, LOG_LEVEL, LOG_FILE
+)
+from database import Database, AsyncDatabase
+from notifications import Notifier, OutboxWorker
+from orders import OrderSpoolWorker
+from middlewares import PartnerMiddleware
+from metrics import (
+    UpdateMetricsMiddleware, HandlerMetricsMiddleware, TelegramMetricsMiddleware, HEALTH, start_metrics_server
+)
+from logs import LoggingMiddleware, setup_logging
+from storage import SQLiteStorage
 from handlers import user_handlers, admin_handlers
+import keyboards
+import quiz
+
+logger = logging.getLogger(__name__)
+
+def create_bot(proxy=BOT_PROXY):
+    """Бот с сессией через прокси, если он задан в настройках"""
+    session = AiohttpSession(proxy=proxy) if proxy else None
+    return Bot(token=BOT_TOKEN, session=session)
+
+def build_dispatcher(bot):
+    """Собирает диспетчер со всеми зависимостями; общий для polling и webhook.
+
+    Ничего не открывает и не запускает: база, прогрев и фоновые задачи
+    поднимаются в startup-хуке, после чего /health начинает отвечать 200.
+    """
+    # Один экземпляр базы на весь процесс, попадает в хендлеры через workflow data
+    db = AsyncDatabase(functools.partial(
+        Database,
+        DB_PATH,
+        readers=DB_READERS,
+        profile=DB_PROFILES[DB_PROFILE],
+        profile_name=DB_PROFILE,
+        partner_cache_size=PARTNER_CACHE_SIZE,
+        partner_cache_ttl=PARTNER_CACHE_TTL
+    ))
+    storage = SQLiteStorage(db, ttl=FSM_STATE_TTL, flush_interval=FSM_FLUSH_INTERVAL)
+    notifier = Notifier(
+        bot,
+        concurrency=NOTIFY_CONCURRENCY,
+        global_rate=NOTIFY_GLOBAL_RATE,
+        chat_rate=NOTIFY_CHAT_RATE,
+        max_retries=NOTIFY_MAX_RETRIES
+    )
+    dp = Dispatcher(storage=storage, db=db, notifier=notifier)
+
+    # Счетчик запросов к базе ставится раньше FSM-middleware Dispatcher,
+    # который читает состояние из базы, чтобы учитывать весь апдейт
+    dp.update.outer_middleware.unregister(dp.fsm)
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.update.outer_middleware(dp.fsm)
+    # Партнер и роль определяются один раз на апдейт для всех роутеров
+    dp.update.outer_middleware(PartnerMiddleware(db))
+    # Время хендлеров и запросы к Telegram API для /metrics
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    dp.message.middleware(LoggingMiddleware())
+    dp.callback_query.middleware(LoggingMiddleware())
+    bot.session.middleware(TelegramMetricsMiddleware())
 
-async def main():
-    bot = Bot(token=BOT_TOKEN)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-    
     # Register routers
     dp.include_router(user_handlers.router)
     dp.include_router(admin_handlers.router)
-    
-    print("Bot started!")
+    dp.include_router(admin_handlers.denied_router)
+
+    outbox = OutboxWorker(
+        db, notifier,
+        batch_size=OUTBOX_BATCH_SIZE,
+        interval=OUTBOX_POLL_INTERVAL,
+        max_attempts=OUTBOX_MAX_ATTEMPTS
+    )
+    orders = OrderSpoolWorker(
+        db, ORDERS_SPOOL_DIR, ORDER_REWARD,
+        batch_size=ORDERS_BATCH_SIZE,
+        interval=ORDERS_POLL_INTERVAL,
+        max_failures=ORDERS_MAX_FAILURES
+    )
+    background = []
+    servers = []
+
+    async def on_startup():
+        started_at = time.perf_counter()
+        # Сервер метрик первым, чтобы /health отвечал 503 все время прогрева
+        if METRICS_PORT:
+            servers.append(await start_metrics_server(METRICS_HOST, METRICS_PORT))
+        await db.open()
+        db_opened_at = time.perf_counter()
+        keyboards.warm_up()
+        quiz.warm_up()
+        background.append(asyncio.create_task(db.run_checkpoints(DB_CHECKPOINT_INTERVAL)))
+        background.append(asyncio.create_task(outbox.run()))
+        background.append(asyncio.create_task(storage.run()))
+        background.append(asyncio.create_task(orders.run()))
+        finished_at = time.perf_counter()
+        HEALTH.mark_ready(finished_at - started_at)
+        logger.info("Startup finished in %.3fs (database %.3fs, warm-up %.3fs)",
+                    finished_at - started_at, db_opened_at - started_at, finished_at - db_opened_at)
+
+    async def on_shutdown():
+        HEALTH.mark_stopping()
+        for task in background:
+            task.cancel()
+        for runner in servers:
+            await runner.cleanup()
+        await storage.close()
+        await notifier.close()
+        db.close()
+
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    return dp
+
+async def main():
+    bot = create_bot()
+    dp = build_dispatcher(bot)
+
+    logger.info("Bot started%s!", " with proxy" if BOT_PROXY else "")
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    listener = setup_logging(LOG_LEVEL, LOG_FILE)
+    try:
+        asyncio.run(main())
+    finally:
+        listener.stop()
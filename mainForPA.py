@@ -1,35 +1,20 @@
+"""Запуск на PythonAnywhere: бесплатный аккаунт ходит в Telegram только
+через их прокси, поэтому он включен по умолчанию. Переопределяется
+настройкой BOT_PROXY, в остальном это тот же main.py.
+"""
 import asyncio
-import aiohttp
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.client.default import DefaultBotProperties
-from aiogram.client.session.aiohttp import AiohttpSession
+import os
 
-from config import BOT_TOKEN
-from handlers import user_handlers, admin_handlers
+# До импорта config, который читает окружение
+os.environ.setdefault('BOT_PROXY', 'http://proxy.server:3128/')
 
-async def create_bot():
-    session = AiohttpSession(
-        proxy='http://proxy.server:3128/'
-    )
-    
-    bot = Bot(
-        token=BOT_TOKEN,
-        session=session,
-        default=DefaultBotProperties(parse_mode='HTML')
-    )
-    return bot
-
-async def main():
-    bot = await create_bot()
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-    
-    dp.include_router(user_handlers.router)
-    dp.include_router(admin_handlers.router)
-    
-    print("Bot started with proxy!")
-    await dp.start_polling(bot)
+import main
+from config import LOG_LEVEL, LOG_FILE
+from logs import setup_logging
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    listener = setup_logging(LOG_LEVEL, LOG_FILE)
+    try:
+        asyncio.run(main.main())
+    finally:
+        listener.stop()
@@ -0,0 +1,232 @@
+"""Метрики бота в формате Prometheus.
+
+Счетчики и гистограммы хранятся в памяти процесса и отдаются текстом на
+локальном /metrics (start_metrics_server) и в команде /stats_internal.
+Там же /health — готовность бота после прогрева.
+Запросы к базе выполняются в потоках, поэтому все изменения под локом.
+"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, values)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.samples().items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label_values -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        """label_values -> (счетчики по корзинам, сумма, количество)"""
+        with self._lock:
+            return {k: (list(v[0]), v[1], v[2]) for k, v in self._values.items()}
+
+    def quantile(self, q, counts, total):
+        """Оценка квантиля по корзинам: верхняя граница корзины, где он попадает"""
+        rank = q * total
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ('le',)
+        for label_values, (counts, total_sum, count) in sorted(self.samples().items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                labels = _format_labels(bucket_labels, label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total_sum}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+HANDLER_LATENCY = Histogram(
+    'bot_handler_duration_seconds', 'Время обработки апдейта хендлером', ['handler']
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Исключения в хендлерах', ['handler']
+)
+DB_QUERY_LATENCY = Histogram(
+    'bot_db_query_duration_seconds', 'Время выполнения метода Database', ['query']
+)
+DB_QUERIES_PER_UPDATE = Histogram(
+    'bot_db_queries_per_update', 'Сколько обращений к базе делает один апдейт', [],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21)
+)
+TELEGRAM_REQUESTS = Counter(
+    'bot_telegram_requests_total', 'Запросы к Telegram Bot API', ['method', 'result']
+)
+TELEGRAM_RETRIES = Counter(
+    'bot_telegram_retries_total', 'Повторы отправки уведомлений', ['reason']
+)
+
+METRICS = (
+    HANDLER_LATENCY, HANDLER_ERRORS, DB_QUERY_LATENCY, DB_QUERIES_PER_UPDATE,
+    TELEGRAM_REQUESTS, TELEGRAM_RETRIES
+)
+
+# Счетчик обращений к базе в рамках текущего апдейта (None вне апдейта)
+_update_queries = ContextVar('update_queries', default=None)
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def track_query(name, started_at):
+    """Вызывается AsyncDatabase после каждого метода базы"""
+    DB_QUERY_LATENCY.observe(time.perf_counter() - started_at, name)
+    queries = _update_queries.get()
+    if queries is not None:
+        queries[0] += 1
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: число запросов к базе за весь апдейт.
+
+    Должен стоять раньше middleware, которые сами ходят в базу (FSM,
+    PartnerMiddleware), иначе их запросы не попадут в счетчик.
+    """
+
+    async def __call__(self, handler, event, data):
+        queries = [0]
+        token = _update_queries.set(queries)
+        try:
+            return await handler(event, data)
+        finally:
+            DB_QUERIES_PER_UPDATE.observe(queries[0])
+            _update_queries.reset(token)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: время работы и ошибки каждого хендлера"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started_at, name)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: считает все запросы к API и их исход"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        try:
+            response = await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_REQUESTS.inc(name, type(e).__name__)
+            raise
+        TELEGRAM_REQUESTS.inc(name, 'ok')
+        return response
+
+
+class Health:
+    """Готовность бота для /health.
+
+    До конца startup-хука (база открыта, клавиатуры и тест собраны, фоновые
+    задачи запущены) и во время остановки отвечает 503, после — 200.
+    """
+
+    def __init__(self):
+        self.status = 'starting'
+        self.startup_seconds = None
+
+    @property
+    def ready(self):
+        return self.status == 'ready'
+
+    def mark_ready(self, startup_seconds):
+        self.startup_seconds = startup_seconds
+        self.status = 'ready'
+
+    def mark_stopping(self):
+        self.status = 'stopping'
+
+    async def handle(self, request):
+        body = {'status': self.status}
+        if self.startup_seconds is not None:
+            body['startup_s'] = round(self.startup_seconds, 3)
+        return web.json_response(body, status=200 if self.ready else 503)
+
+
+HEALTH = Health()
+
+
+async def start_metrics_server(host, port):
+    """Поднимает локальный HTTP-сервер с /metrics и /health, возвращает runner для остановки"""
+    async def handle_metrics(request):
+        return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/health', HEALTH.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,39 @@
+from aiogram import BaseMiddleware
+from aiogram.filters import Filter
+
+from config import ADMIN_IDS
+
+
+class PartnerMiddleware(BaseMiddleware):
+    """Один раз на апдейт находит партнера и роль пользователя.
+
+    Подключается как outer-middleware на апдейты диспетчера, поэтому
+    данные доступны и фильтрам, и хендлерам: partner — строка из
+    partners (из кэша базы) или None, is_admin — есть ли id в ADMIN_IDS.
+    """
+
+    def __init__(self, db, admin_ids=ADMIN_IDS):
+        self.db = db
+        self.admin_ids = frozenset(admin_ids)
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is not None:
+            data['partner'] = await self.db.get_partner(user.id)
+            data['is_admin'] = user.id in self.admin_ids
+        else:
+            data['partner'] = None
+            data['is_admin'] = False
+        return await handler(event, data)
+
+
+class IsAdmin(Filter):
+    """Пропускает только админов; вешается на роутер целиком"""
+
+    async def __call__(self, event, is_admin=False):
+        return is_admin
+
+
+def is_registered(partner):
+    """Прошел ли партнер регистрацию (тест и промокод)"""
+    return bool(partner and partner['is_active'])
@@ -0,0 +1,369 @@
+"""Версионированные миграции схемы bot.db.
+
+Каждая миграция — это номер версии, описание и список SQL-выражений.
+Миграции применяются по порядку, каждая в своей транзакции, а номер
+применённой версии записывается в таблицу schema_version. Выражения
+пишутся идемпотентными (IF NOT EXISTS), чтобы старые базы, созданные
+до появления миграций, обновлялись без ошибок.
+"""
+
+MIGRATIONS = [
+    (1, "initial schema", [
+        """
+        CREATE TABLE IF NOT EXISTS partners (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            promo_code TEXT UNIQUE,
+            referrals INTEGER DEFAULT 0,
+            balance REAL DEFAULT 0,
+            is_active BOOLEAN DEFAULT FALSE,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS test_results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER REFERENCES partners(user_id),
+            score INTEGER,
+            total_questions INTEGER,
+            passed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS withdrawal_requests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER REFERENCES partners(user_id),
+            amount REAL,
+            requisites TEXT,
+            comment TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            processed_at TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS used_promo_codes (
+            promo_code TEXT PRIMARY KEY,
+            user_id INTEGER REFERENCES partners(user_id)
+        )
+        """,
+    ]),
+    (2, "indexes for hot queries", [
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_status_created ON withdrawal_requests(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_withdrawals_user ON withdrawal_requests(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_test_results_user ON test_results(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_partners_username ON partners(username)",
+        "CREATE INDEX IF NOT EXISTS idx_partners_registered ON partners(registered_at)",
+    ]),
+    (3, "outbox for partner notifications", [
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, next_attempt_at)",
+    ]),
+    (4, "persistent FSM storage", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage(updated_at)",
+    ]),
+    (5, "trigram search index over partners", [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS partners_fts USING fts5(
+            user_id, username, full_name, promo_code,
+            content='partners', content_rowid='user_id', tokenize='trigram'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS partners_fts_insert AFTER INSERT ON partners BEGIN
+            INSERT INTO partners_fts (rowid, user_id, username, full_name, promo_code)
+            VALUES (new.user_id, new.user_id, new.username, new.full_name, new.promo_code);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS partners_fts_delete AFTER DELETE ON partners BEGIN
+            INSERT INTO partners_fts (partners_fts, rowid, user_id, username, full_name, promo_code)
+            VALUES ('delete', old.user_id, old.user_id, old.username, old.full_name, old.promo_code);
+        END
+        """,
+        # Срабатывает только на изменение полей поиска, начисления баланса индекс не трогают
+        """
+        CREATE TRIGGER IF NOT EXISTS partners_fts_update
+        AFTER UPDATE OF user_id, username, full_name, promo_code ON partners BEGIN
+            INSERT INTO partners_fts (partners_fts, rowid, user_id, username, full_name, promo_code)
+            VALUES ('delete', old.user_id, old.user_id, old.username, old.full_name, old.promo_code);
+            INSERT INTO partners_fts (rowid, user_id, username, full_name, promo_code)
+            VALUES (new.user_id, new.user_id, new.username, new.full_name, new.promo_code);
+        END
+        """,
+        "INSERT INTO partners_fts (partners_fts) VALUES ('rebuild')",
+    ]),
+    (6, "materialized dashboard aggregates", [
+        """
+        CREATE TABLE IF NOT EXISTS dashboard (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            partners_total INTEGER NOT NULL DEFAULT 0,
+            active_partners INTEGER NOT NULL DEFAULT 0,
+            total_referrals INTEGER NOT NULL DEFAULT 0,
+            outstanding_balance REAL NOT NULL DEFAULT 0,
+            pending_withdrawals INTEGER NOT NULL DEFAULT 0,
+            pending_withdrawal_sum REAL NOT NULL DEFAULT 0,
+            tests_total INTEGER NOT NULL DEFAULT 0,
+            tests_passed INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT OR REPLACE INTO dashboard 
+        SELECT 
+            1,
+            (SELECT COUNT(*) FROM partners),
+            (SELECT COUNT(*) FROM partners WHERE is_active),
+            (SELECT COALESCE(SUM(referrals), 0) FROM partners),
+            (SELECT COALESCE(SUM(balance), 0) FROM partners),
+            (SELECT COUNT(*) FROM withdrawal_requests WHERE status = 'pending'),
+            (SELECT COALESCE(SUM(amount), 0) FROM withdrawal_requests WHERE status = 'pending'),
+            (SELECT COUNT(*) FROM test_results),
+            (SELECT COUNT(*) FROM test_results WHERE total_questions > 0 AND score * 100 >= total_questions * 80)
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_partners_insert AFTER INSERT ON partners BEGIN
+            UPDATE dashboard SET 
+                partners_total = partners_total + 1,
+                active_partners = active_partners + (COALESCE(new.is_active, 0) != 0),
+                total_referrals = total_referrals + COALESCE(new.referrals, 0),
+                outstanding_balance = outstanding_balance + COALESCE(new.balance, 0)
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_partners_update 
+        AFTER UPDATE OF is_active, referrals, balance ON partners BEGIN
+            UPDATE dashboard SET 
+                active_partners = active_partners 
+                    + (COALESCE(new.is_active, 0) != 0) - (COALESCE(old.is_active, 0) != 0),
+                total_referrals = total_referrals 
+                    + COALESCE(new.referrals, 0) - COALESCE(old.referrals, 0),
+                outstanding_balance = outstanding_balance 
+                    + COALESCE(new.balance, 0) - COALESCE(old.balance, 0)
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_partners_delete AFTER DELETE ON partners BEGIN
+            UPDATE dashboard SET 
+                partners_total = partners_total - 1,
+                active_partners = active_partners - (COALESCE(old.is_active, 0) != 0),
+                total_referrals = total_referrals - COALESCE(old.referrals, 0),
+                outstanding_balance = outstanding_balance - COALESCE(old.balance, 0)
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_withdrawals_insert AFTER INSERT ON withdrawal_requests BEGIN
+            UPDATE dashboard SET 
+                pending_withdrawals = pending_withdrawals + (new.status = 'pending'),
+                pending_withdrawal_sum = pending_withdrawal_sum 
+                    + CASE WHEN new.status = 'pending' THEN COALESCE(new.amount, 0) ELSE 0 END
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_withdrawals_update 
+        AFTER UPDATE OF status, amount ON withdrawal_requests BEGIN
+            UPDATE dashboard SET 
+                pending_withdrawals = pending_withdrawals 
+                    + (new.status = 'pending') - (old.status = 'pending'),
+                pending_withdrawal_sum = pending_withdrawal_sum 
+                    + CASE WHEN new.status = 'pending' THEN COALESCE(new.amount, 0) ELSE 0 END 
+                    - CASE WHEN old.status = 'pending' THEN COALESCE(old.amount, 0) ELSE 0 END
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_withdrawals_delete AFTER DELETE ON withdrawal_requests BEGIN
+            UPDATE dashboard SET 
+                pending_withdrawals = pending_withdrawals - (old.status = 'pending'),
+                pending_withdrawal_sum = pending_withdrawal_sum 
+                    - CASE WHEN old.status = 'pending' THEN COALESCE(old.amount, 0) ELSE 0 END
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_tests_insert AFTER INSERT ON test_results BEGIN
+            UPDATE dashboard SET 
+                tests_total = tests_total + 1,
+                tests_passed = tests_passed 
+                    + (new.total_questions > 0 AND new.score * 100 >= new.total_questions * 80)
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_tests_delete AFTER DELETE ON test_results BEGIN
+            UPDATE dashboard SET 
+                tests_total = tests_total - 1,
+                tests_passed = tests_passed 
+                    - (old.total_questions > 0 AND old.score * 100 >= old.total_questions * 80)
+            WHERE id = 1;
+        END
+        """,
+    ]),
+    (7, "balance ledger", [
+        """
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL REFERENCES partners(user_id),
+            amount_kopecks INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            admin_id INTEGER,
+            withdrawal_id INTEGER REFERENCES withdrawal_requests(id),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ledger_user_created ON balance_ledger(user_id, created_at)",
+        # Текущие балансы становятся начальными проводками журнала
+        """
+        INSERT INTO balance_ledger (user_id, amount_kopecks, reason) 
+        SELECT user_id, CAST(ROUND(balance * 100) AS INTEGER), 'opening' 
+        FROM partners 
+        WHERE balance != 0
+        """,
+    ]),
+    (8, "withdrawal processing", [
+        "ALTER TABLE withdrawal_requests ADD COLUMN processed_by INTEGER",
+        # Копии уведомления о заявке у админов, чтобы после обработки обновить их все
+        """
+        CREATE TABLE IF NOT EXISTS withdrawal_messages (
+            withdrawal_id INTEGER NOT NULL REFERENCES withdrawal_requests(id),
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (withdrawal_id, chat_id, message_id)
+        )
+        """,
+    ]),
+    (9, "report imports", [
+        # Хэш файла не дает применить один и тот же отчет дважды
+        """
+        CREATE TABLE IF NOT EXISTS report_imports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_hash TEXT NOT NULL UNIQUE,
+            filename TEXT,
+            admin_id INTEGER,
+            rows INTEGER,
+            matched INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (10, "order events", [
+        # order_id — ключ дедупликации событий от платформы
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id TEXT PRIMARY KEY,
+            promo_code TEXT NOT NULL,
+            user_id INTEGER REFERENCES partners(user_id),
+            amount REAL,
+            ordered_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id)",
+    ]),
+    (11, "admin withdrawal alerts in outbox", [
+        # Клавиатура сообщения в JSON и заявка, к которой относится копия у админа
+        "ALTER TABLE outbox ADD COLUMN reply_markup TEXT",
+        "ALTER TABLE outbox ADD COLUMN withdrawal_id INTEGER",
+    ]),
+    (12, "test pass flag", [
+        # Порог прохождения берется из настроек теста, а не зашивается в SQL;
+        # старые результаты размечаются по порогу, который действовал при их записи
+        "ALTER TABLE test_results ADD COLUMN passed INTEGER NOT NULL DEFAULT 0",
+        "UPDATE test_results SET passed = (total_questions > 0 AND score * 100 >= total_questions * 80)",
+        "DROP TRIGGER IF EXISTS dashboard_tests_insert",
+        "DROP TRIGGER IF EXISTS dashboard_tests_delete",
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_tests_insert AFTER INSERT ON test_results BEGIN
+            UPDATE dashboard SET 
+                tests_total = tests_total + 1,
+                tests_passed = tests_passed + (new.passed != 0)
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_tests_delete AFTER DELETE ON test_results BEGIN
+            UPDATE dashboard SET 
+                tests_total = tests_total - 1,
+                tests_passed = tests_passed - (old.passed != 0)
+            WHERE id = 1;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS dashboard_tests_update AFTER UPDATE OF passed ON test_results BEGIN
+            UPDATE dashboard SET 
+                tests_passed = tests_passed + (new.passed != 0) - (old.passed != 0)
+            WHERE id = 1;
+        END
+        """,
+        "UPDATE dashboard SET tests_passed = (SELECT COUNT(*) FROM test_results WHERE passed) WHERE id = 1",
+    ]),
+    (13, "order reward notifications and outbox priority", [
+        # Начисления за заказы копятся здесь и уходят партнеру одним сообщением за проход spool
+        """
+        CREATE TABLE IF NOT EXISTS pending_order_rewards (
+            user_id INTEGER PRIMARY KEY,
+            orders INTEGER NOT NULL,
+            amount_kopecks INTEGER NOT NULL
+        )
+        """,
+        # 0 — срочные сообщения (админам, по заявкам), 1 — массовые уведомления о начислениях
+        "ALTER TABLE outbox ADD COLUMN priority INTEGER NOT NULL DEFAULT 0",
+        "DROP INDEX IF EXISTS idx_outbox_pending",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, priority, id)",
+    ]),
+]
+
+
+def get_schema_version(connection):
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    return connection.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def apply_migrations(connection):
+    """Применяет все недостающие миграции и возвращает итоговую версию схемы"""
+    current = get_schema_version(connection)
+
+    for version, description, statements in MIGRATIONS:
+        if version <= current:
+            continue
+
+        with connection:
+            # sqlite3 не открывает транзакцию перед DDL сам, поэтому явно
+            connection.execute("BEGIN")
+            for statement in statements:
+                connection.execute(statement)
+            connection.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+        current = version
+
+    return current
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramAPIError
+from aiogram.types import InlineKeyboardMarkup
+
+from metrics import TELEGRAM_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ограничитель частоты: не больше rate операций в секунду с запасом capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class Notifier:
+    """Рассылка уведомлений вне обработки апдейта.
+
+    send/send_many сразу возвращают управление хендлеру, а сообщения
+    уходят в фоновых задачах: параллельно, но не больше concurrency
+    одновременно, с учетом глобального лимита Telegram и лимита на чат.
+    При TelegramRetryAfter отправка повторяется после указанной паузы.
+    """
+
+    # После скольких чатов в словаре начинать выбрасывать простаивающие лимитеры
+    MAX_CHAT_BUCKETS = 1000
+
+    def __init__(self, bot, concurrency=8, global_rate=25, chat_rate=1, max_retries=3):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = {}
+        self._tasks = set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                for idle_chat_id in [c for c, b in self._chat_buckets.items() if b.idle]:
+                    del self._chat_buckets[idle_chat_id]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, 1)
+        return bucket
+
+    async def _request(self, chat_id, make_call):
+        """Выполняет запрос к чату с учетом лимитов и повторов, возвращает результат или None"""
+        for attempt in range(self.max_retries + 1):
+            # Лимит чата ждем до семафора: иначе очередь сообщений в один чат
+            # занимает все слоты, и остальные получатели ждут ее целиком
+            await self._chat_bucket(chat_id).acquire()
+            try:
+                async with self._semaphore:
+                    await self._global_bucket.acquire()
+                    return await make_call()
+            except TelegramRetryAfter as e:
+                TELEGRAM_RETRIES.inc('retry_after')
+                await asyncio.sleep(e.retry_after)
+            except TelegramNetworkError as e:
+                if attempt == self.max_retries:
+                    logger.warning("Failed to notify %s: %s", chat_id, e)
+                    return None
+                TELEGRAM_RETRIES.inc('network')
+                await asyncio.sleep(2 ** attempt)
+            except TelegramAPIError as e:
+                logger.warning("Failed to notify %s: %s", chat_id, e)
+                return None
+        logger.warning("Failed to notify %s: retries exhausted", chat_id)
+        return None
+
+    async def deliver(self, chat_id, text, **kwargs):
+        """Отправляет сообщение, возвращает Message или None"""
+        return await self._request(chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs))
+
+    def spawn(self, coro):
+        """Запускает корутину в фоне; close() дождется ее завершения"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def send(self, chat_id, text, **kwargs):
+        return self.spawn(self.deliver(chat_id, text, **kwargs))
+
+    def send_many(self, chat_ids, text, **kwargs):
+        return [self.send(chat_id, text, **kwargs) for chat_id in chat_ids]
+
+    def edit(self, chat_id, message_id, text, **kwargs):
+        """Редактирует ранее отправленное сообщение в фоне"""
+        return self.spawn(self._request(chat_id, lambda: self.bot.edit_message_text(
+            text, chat_id=chat_id, message_id=message_id, **kwargs
+        )))
+
+    async def close(self):
+        """Дожидается уже поставленных отправок"""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class OutboxWorker:
+    """Фоновая доставка сообщений из таблицы outbox.
+
+    Хендлеры пишут уведомление в outbox в той же транзакции, что и само
+    изменение баланса или заявки, а воркер пачками забирает сообщения,
+    отправляет их через Notifier и удаляет доставленные. У копий новой
+    заявки, разосланных админам с кнопками, при доставке запоминается
+    message_id, чтобы после обработки заявки обновить их. Неудачные
+    откладываются с экспоненциальной задержкой, поэтому после перезапуска
+    бота недоставленные сообщения не теряются.
+    """
+
+    def __init__(self, db, notifier, batch_size=50, interval=1.0, max_attempts=5, backoff=5.0):
+        self.db = db
+        self.notifier = notifier
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+    def _deliver(self, row):
+        kwargs = {}
+        if row['reply_markup']:
+            kwargs['reply_markup'] = InlineKeyboardMarkup.model_validate_json(row['reply_markup'])
+        return self.notifier.deliver(row['chat_id'], row['text'], **kwargs)
+
+    async def drain_once(self):
+        """Отправляет одну пачку, возвращает количество обработанных сообщений"""
+        batch = await self.db.get_outbox_batch(self.batch_size, time.time())
+        if not batch:
+            return 0
+
+        results = await asyncio.gather(*(self._deliver(row) for row in batch), return_exceptions=True)
+
+        now = time.time()
+        sent, failed = [], []
+        for row, result in zip(batch, results):
+            if result is None or isinstance(result, BaseException):
+                failed.append((row['id'], now + self.backoff * 2 ** row['attempts']))
+            else:
+                sent.append((row['id'], result.message_id))
+
+        await self.db.ack_outbox(sent, failed, self.max_attempts)
+        return len(batch)
+
+    async def run(self):
+        while True:
+            try:
+                processed = await self.drain_once()
+            except Exception:
+                logger.exception("Outbox worker error")
+                processed = 0
+            if processed < self.batch_size:
+                await asyncio.sleep(self.interval)
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def parse_spool_file(path):
+    """Читает JSONL-файл событий заказов.
+
+    Каждая строка — объект с полями order_id, promo_code (строка или число)
+    и необязательными amount (число) и created_at (строка). Строки с другими
+    типами пропускаются, чтобы одно кривое событие не сорвало вставку всей
+    пачки. Возвращает (список (order_id, promo_code, amount, ordered_at),
+    количество пропущенных строк).
+    """
+    events = []
+    skipped = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+                order_id, promo_code = event['order_id'], event['promo_code']
+                amount, created_at = event.get('amount'), event.get('created_at')
+            except (ValueError, KeyError, TypeError, AttributeError):
+                skipped += 1
+                continue
+            if not all(isinstance(value, str) or _is_number(value) for value in (order_id, promo_code)):
+                skipped += 1
+                continue
+            if not (amount is None or _is_number(amount)) or not (created_at is None or isinstance(created_at, str)):
+                skipped += 1
+                continue
+            if amount is not None:
+                # Целые больше 64 бит SQLite не примет, а колонка все равно REAL
+                try:
+                    amount = float(amount)
+                except OverflowError:
+                    skipped += 1
+                    continue
+            order_id, promo_code = str(order_id).strip(), str(promo_code).strip()
+            if not order_id or not promo_code:
+                skipped += 1
+                continue
+            events.append((order_id, promo_code, amount, created_at))
+    return events, skipped
+
+
+def order_notification(partner, orders, amount_kopecks):
+    return (
+        f"🎉 Новые заказы по вашему промокоду: {orders}\n\n"
+        f"💰 Начислено: +{amount_kopecks / 100:.2f} руб.\n"
+        f"👥 Всего рефералов: {partner['referrals']}\n"
+        f"💰 Баланс: {partner['balance']} руб."
+    )
+
+
+class OrderSpoolWorker:
+    """Автоматическое начисление за заказы по промокодам.
+
+    Платформа (или скрипт-выгрузчик) кладет события заказов в каталог
+    spool_dir файлами *.jsonl; чтобы воркер не прочитал недописанный файл,
+    писать нужно во временное имя и переименовывать в .jsonl в конце.
+    Воркер пачками по batch_size передает события в ingest_orders и
+    переносит обработанный файл в spool_dir/processed. Уведомления о
+    начислениях ставятся в конце прохода, по одному на партнера, сколько бы
+    файлов и пачек его ни затронули. Если бот упадет
+    посреди файла, при повторной обработке уже записанные заказы
+    отбросятся по order_id. Файл, обработка которого падает max_failures
+    раз подряд, переносится в spool_dir/failed и не мешает остальным.
+    """
+
+    def __init__(self, db, spool_dir, reward, batch_size=5000, interval=2.0, max_failures=3):
+        self.db = db
+        self.spool_dir = spool_dir
+        self.reward_kopecks = int(round(reward * 100))
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_failures = max_failures
+        self.processed_dir = os.path.join(spool_dir, 'processed')
+        self.failed_dir = os.path.join(spool_dir, 'failed')
+        # Число неудачных попыток по каждому файлу
+        self._failures = {}
+
+    def _pending_files(self):
+        if not os.path.isdir(self.spool_dir):
+            return []
+        return sorted(
+            os.path.join(self.spool_dir, name)
+            for name in os.listdir(self.spool_dir)
+            if name.endswith('.jsonl')
+        )
+
+    def _move(self, path, directory):
+        os.makedirs(directory, exist_ok=True)
+        os.replace(path, os.path.join(directory, os.path.basename(path)))
+
+    async def process_file(self, path):
+        """Обрабатывает один файл, возвращает сводку как у ingest_orders"""
+        events, skipped = await asyncio.to_thread(parse_spool_file, path)
+        total = {'received': 0, 'new': 0, 'duplicates': 0, 'credited': 0, 'skipped': skipped}
+
+        for start in range(0, len(events), self.batch_size):
+            result = await self.db.ingest_orders(events[start:start + self.batch_size], self.reward_kopecks)
+            for key in ('received', 'new', 'duplicates', 'credited'):
+                total[key] += result[key]
+
+        self._move(path, self.processed_dir)
+        return total
+
+    async def drain_once(self):
+        """Обрабатывает все файлы в spool, возвращает количество обработанных"""
+        processed = 0
+        for path in self._pending_files():
+            name = os.path.basename(path)
+            try:
+                total = await self.process_file(path)
+            except Exception:
+                failures = self._failures[path] = self._failures.get(path, 0) + 1
+                if failures < self.max_failures:
+                    logger.exception("Orders spool file failed (%s/%s): %s", failures, self.max_failures, name)
+                else:
+                    logger.exception("Orders spool file failed %s times, moved to failed: %s", failures, name)
+                    self._move(path, self.failed_dir)
+                    del self._failures[path]
+                continue
+            self._failures.pop(path, None)
+            processed += 1
+            logger.info("Orders spool file processed: %s %s", name, total)
+        # Начисления, накопленные и в прошлых проходах, если бот упал до уведомлений
+        notified = await self.db.flush_order_rewards(order_notification)
+        if notified:
+            logger.info("Order reward notifications queued: %s", notified)
+        return processed
+
+    async def run(self):
+        while True:
+            try:
+                await self.drain_once()
+            except Exception:
+                logger.exception("Orders spool error")
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,131 @@
+import random
+import re
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import QUIZ_VERSIONS, QUIZ_CURRENT_VERSION, QUIZ_SHUFFLE_VARIANTS, QUIZ_PASS_PERCENT
+
+# Буквенный префикс варианта ответа: "а) ", "б) " ...
+OPTION_PREFIX = re.compile(r'^[а-яa-z]\)\s*', re.IGNORECASE)
+OPTION_LETTERS = "абвгдежзик"
+
+
+class Question:
+    """Вопрос с заранее собранными клавиатурами для каждого порядка вариантов.
+
+    variants[k] — (markup, order), где order[i] — исходный номер варианта
+    ответа, показанного i-й кнопкой. Нулевой порядок — исходный.
+    """
+
+    def __init__(self, number, text, options, correct, orders):
+        self.number = number
+        self.text = text
+        self.correct = correct
+        self.variants = []
+        for order in orders:
+            buttons = [
+                [InlineKeyboardButton(
+                    text=f"{OPTION_LETTERS[i]}) {options[original]}",
+                    callback_data=f"answer_{number}_{i}"
+                )]
+                for i, original in enumerate(order)
+            ]
+            self.variants.append((InlineKeyboardMarkup(inline_keyboard=buttons), order))
+
+
+class Quiz:
+    """Тест, скомпилированный из списка вопросов в формате config.TEST_QUESTIONS.
+
+    Тексты и клавиатуры собираются один раз при импорте. Прогресс
+    пользователя — это номер версии, номер порядка вариантов, индекс
+    текущего вопроса и битовая маска правильных ответов, поэтому в FSM
+    хранится несколько чисел, а оценка считается по мере ответов.
+    """
+
+    def __init__(self, version, questions, shuffle_variants=1, pass_percent=80):
+        self.version = version
+        self.pass_percent = pass_percent
+        self.intro = None
+        if questions and questions[0].get('type') == 'name_input':
+            self.intro = questions[0]['question']
+            questions = questions[1:]
+
+        # Порядки вариантов фиксированы для версии, чтобы после перезапуска
+        # бота у пользователя, начавшего тест, кнопки не перемешались заново
+        rng = random.Random(version)
+        self.questions = []
+        for number, question in enumerate(questions):
+            options = [OPTION_PREFIX.sub('', option) for option in question['options']]
+            orders = [tuple(range(len(options)))]
+            for _ in range(shuffle_variants - 1):
+                order = list(range(len(options)))
+                rng.shuffle(order)
+                orders.append(tuple(order))
+            self.questions.append(Question(number, question['question'], options, question['correct'], orders))
+
+        self.total = len(self.questions)
+        self.shuffle_variants = shuffle_variants
+
+    def start(self, user_id):
+        """Начальный прогресс; порядок вариантов выбирается по пользователю"""
+        return {'quiz_version': self.version, 'quiz_variant': user_id % self.shuffle_variants,
+                'quiz_index': 0, 'quiz_mask': 0}
+
+    def render(self, progress):
+        """Текст и клавиатура текущего вопроса"""
+        question = self.questions[progress['quiz_index']]
+        markup, _ = question.variants[progress['quiz_variant']]
+        return f"Вопрос {question.number + 1}/{self.total}:\n\n{question.text}", markup
+
+    def answer(self, progress, callback_data):
+        """Засчитывает ответ и возвращает новый прогресс.
+
+        callback_data вида answer_{номер вопроса}_{номер кнопки}. Нажатие
+        кнопки уже пройденного вопроса (двойной клик, старое сообщение)
+        возвращает None.
+        """
+        try:
+            _, number, button = callback_data.split('_')
+            number, button = int(number), int(button)
+            question = self.questions[number]
+            _, order = question.variants[progress['quiz_variant']]
+            original = order[button]
+        except (ValueError, IndexError):
+            return None
+        if number != progress['quiz_index']:
+            return None
+
+        mask = progress['quiz_mask']
+        if original == question.correct:
+            mask |= 1 << number
+        return dict(progress, quiz_index=number + 1, quiz_mask=mask)
+
+    def finished(self, progress):
+        return progress['quiz_index'] >= self.total
+
+    def score(self, progress):
+        return bin(progress['quiz_mask']).count('1')
+
+    def passed(self, progress):
+        return self.score(progress) * 100 >= self.total * self.pass_percent
+
+
+# Скомпилированные версии теста; заполняются в warm_up() при старте бота
+QUIZZES = {}
+
+
+def get_quiz(version=None):
+    """Тест нужной версии; без версии — текущий для новых прохождений"""
+    version = version or QUIZ_CURRENT_VERSION
+    quiz = QUIZZES.get(version)
+    if quiz is None:
+        quiz = QUIZZES[version] = Quiz(
+            version, QUIZ_VERSIONS[version], QUIZ_SHUFFLE_VARIANTS, QUIZ_PASS_PERCENT
+        )
+    return quiz
+
+
+def warm_up():
+    """Компилирует все версии теста заранее, до первого апдейта"""
+    for version in QUIZ_VERSIONS:
+        get_quiz(version)
@@ -0,0 +1,68 @@
+import csv
+import io
+import json
+
+from database import to_kopecks
+
+
+class ReportError(Exception):
+    """Файл отчета не удалось разобрать"""
+
+
+def parse_report(content, filename):
+    """Разбирает отчет партнерской платформы об использовании промокодов.
+
+    Принимает CSV (с заголовком promo_code,orders,amount; разделитель
+    запятая или точка с запятой) или JSON-массив объектов с теми же
+    полями. Строки с одинаковым промокодом складываются. Возвращает
+    (список (promo_code, orders, amount_kopecks), количество пропущенных строк).
+    """
+    text = content.decode('utf-8-sig')
+
+    if filename.lower().endswith('.json'):
+        try:
+            records = json.loads(text)
+        except ValueError as e:
+            raise ReportError(f"некорректный JSON: {e}")
+        if not isinstance(records, list):
+            raise ReportError("ожидался JSON-массив объектов")
+    else:
+        dialect = csv.excel
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=',;')
+        except csv.Error:
+            pass
+        records = csv.DictReader(io.StringIO(text), dialect=dialect)
+        try:
+            fieldnames = records.fieldnames
+        except csv.Error as e:
+            raise ReportError(f"некорректный CSV: {e}")
+        if not fieldnames or 'promo_code' not in fieldnames:
+            raise ReportError("в заголовке CSV нет колонки promo_code")
+
+    try:
+        return _sum_records(records)
+    except csv.Error as e:
+        # Например, поле длиннее csv.field_size_limit()
+        raise ReportError(f"некорректный CSV: {e}")
+
+
+def _sum_records(records):
+    totals = {}
+    skipped = 0
+    for record in records:
+        try:
+            promo_code = str(record['promo_code']).strip()
+            orders = int(record.get('orders') or 0)
+            amount = to_kopecks(float(str(record.get('amount') or 0).replace(',', '.')))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            skipped += 1
+            continue
+        if not promo_code or (not orders and not amount):
+            skipped += 1
+            continue
+        total_orders, total_amount = totals.get(promo_code, (0, 0))
+        totals[promo_code] = (total_orders + orders, total_amount + amount)
+
+    rows = [(code, orders, amount) for code, (orders, amount) in totals.items()]
+    return rows, skipped
@@ -0,0 +1,118 @@
+"""Замер времени запуска бота.
+
+Каждый прогон — отдельный процесс, чтобы импорт был холодным. Фазы:
+импорт main, сборка бота и диспетчера, startup-хук (открытие базы с
+миграциями, прогрев клавиатур и теста, запуск фоновых задач) и остановка.
+Startup меряется на новой базе (все миграции) и на уже существующей.
+Telegram не нужен: startup-хук к Bot API не обращается.
+
+    python startup_bench.py --runs 5 --json startup.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ('import', 'build', 'startup', 'shutdown', 'total')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5, help='прогонов на каждый вариант базы')
+    parser.add_argument('--json', help='сохранить результат в файл')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def run_child():
+    """Один запуск в текущем процессе; печатает длительности фаз JSON-строкой"""
+    started_at = time.perf_counter()
+    import main
+    from metrics import HEALTH
+    imported_at = time.perf_counter()
+
+    async def start_and_stop():
+        bot = main.create_bot()
+        dp = main.build_dispatcher(bot)
+        built_at = time.perf_counter()
+        await dp.emit_startup(bot=bot, **dp.workflow_data)
+        assert HEALTH.ready
+        ready_at = time.perf_counter()
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+        await bot.session.close()
+        return built_at, ready_at, time.perf_counter()
+
+    built_at, ready_at, stopped_at = asyncio.run(start_and_stop())
+    print(json.dumps({
+        'import': imported_at - started_at,
+        'build': built_at - imported_at,
+        'startup': ready_at - built_at,
+        'shutdown': stopped_at - ready_at,
+        'total': ready_at - started_at,
+    }))
+
+
+def measure(db_path, fresh, runs):
+    env = dict(
+        os.environ,
+        # Токен нужен только правильного формата, запросов к API нет
+        BOT_TOKEN='42:STARTUP-BENCH',
+        DB_PATH=db_path,
+        METRICS_PORT='',
+        LOG_LEVEL='WARNING',
+        ORDERS_SPOOL_DIR=os.path.join(os.path.dirname(db_path), 'orders_spool'),
+    )
+    samples = []
+    for _ in range(runs):
+        if fresh:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', db_path],
+            env=env, check=True, capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+    return {
+        phase: {
+            'median_ms': round(statistics.median(s[phase] for s in samples) * 1000, 1),
+            'min_ms': round(min(s[phase] for s in samples) * 1000, 1),
+            'max_ms': round(max(s[phase] for s in samples) * 1000, 1),
+        }
+        for phase in PHASES
+    }
+
+
+def main():
+    args = parse_args()
+    if args.child:
+        run_child()
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'startup.db')
+        result = {
+            'runs': args.runs,
+            'fresh_db': measure(db_path, True, args.runs),
+            'existing_db': measure(db_path, False, args.runs),
+        }
+
+    for variant in ('fresh_db', 'existing_db'):
+        print(f"{'новая база' if variant == 'fresh_db' else 'существующая база'} "
+              f"({args.runs} прогонов), мс: медиана [мин–макс]")
+        for phase in PHASES:
+            stats = result[variant][phase]
+            print(f"  {phase:<10}{stats['median_ms']:>10} [{stats['min_ms']}–{stats['max_ms']}]")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
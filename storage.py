@@ -0,0 +1,111 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в bot.db вместо MemoryStorage.
+
+    Состояния переживают перезапуск бота. Все чтения и записи идут через
+    кэш в памяти: set_state/set_data только помечают запись грязной, а
+    фоновая задача run() раз в flush_interval секунд сбрасывает накопленные
+    изменения одной пачкой (write-behind). Сессии, которые не трогали
+    дольше ttl секунд, считаются брошенными и удаляются из кэша и базы.
+    """
+
+    def __init__(self, db, ttl=24 * 3600, flush_interval=1.0, cache_idle=300):
+        self.db = db
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # Через сколько секунд без обращений чистая запись выгружается из кэша
+        self.cache_idle = cache_idle
+        self._cache = {}
+        self._dirty = set()
+
+    @staticmethod
+    def _make_key(key):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    async def _get_record(self, key):
+        storage_key = self._make_key(key)
+        record = self._cache.get(storage_key)
+        now = time.time()
+
+        if record is None:
+            row = await self.db.load_fsm_record(storage_key)
+            # Пока шел запрос, запись могла появиться в кэше из параллельного апдейта
+            record = self._cache.get(storage_key)
+            if record is None:
+                if row and row['updated_at'] >= now - self.ttl:
+                    record = {'state': row['state'], 'data': json.loads(row['data']), 'updated_at': row['updated_at']}
+                else:
+                    record = {'state': None, 'data': {}, 'updated_at': now}
+                self._cache[storage_key] = record
+        elif record['updated_at'] < now - self.ttl:
+            record.update(state=None, data={})
+            self._dirty.add(storage_key)
+
+        record['touched_at'] = now
+        return storage_key, record
+
+    async def set_state(self, key, state=None):
+        storage_key, record = await self._get_record(key)
+        record['state'] = state.state if isinstance(state, State) else state
+        record['updated_at'] = time.time()
+        self._dirty.add(storage_key)
+
+    async def get_state(self, key):
+        _, record = await self._get_record(key)
+        return record['state']
+
+    async def set_data(self, key, data):
+        storage_key, record = await self._get_record(key)
+        record['data'] = data.copy()
+        record['updated_at'] = time.time()
+        self._dirty.add(storage_key)
+
+    async def get_data(self, key):
+        _, record = await self._get_record(key)
+        return record['data'].copy()
+
+    async def flush(self):
+        """Сбрасывает грязные записи в базу и выгружает давно не используемые"""
+        if self._dirty:
+            dirty, self._dirty = self._dirty, set()
+            records = [
+                (storage_key, record['state'], json.dumps(record['data'], ensure_ascii=False), record['updated_at'])
+                for storage_key, record in ((k, self._cache[k]) for k in dirty if k in self._cache)
+            ]
+            try:
+                await self.db.save_fsm_records(records)
+            except Exception:
+                self._dirty |= dirty
+                raise
+
+        now = time.time()
+        for storage_key, record in list(self._cache.items()):
+            if storage_key in self._dirty:
+                continue
+            if record['touched_at'] < now - self.cache_idle or record['updated_at'] < now - self.ttl:
+                del self._cache[storage_key]
+
+    async def run(self):
+        last_expire = 0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.time() - last_expire > self.ttl / 24:
+                    await self.db.expire_fsm_records(time.time() - self.ttl)
+                    last_expire = time.time()
+            except Exception:
+                logger.exception("FSM storage flush failed")
+
+    async def close(self):
+        await self.flush()
@@ -0,0 +1,45 @@
+"""Не-админ, нажавший админскую кнопку, получает отказ."""
+import asyncio
+
+import pytest
+from aiogram.types import CallbackQuery, User
+
+import keyboards
+from handlers.admin_handlers import denied_router
+
+ADMIN_KEYBOARDS = [
+    keyboards.get_admin_keyboard(),
+    keyboards.get_partner_actions_keyboard(1),
+    keyboards.get_withdrawal_actions_keyboard(1),
+    keyboards.get_pagination_keyboard('partners', 1, 2, True, True),
+    keyboards.get_pagination_keyboard('withdrawals', 1, 2, True, True),
+    keyboards.get_cancel_reject_keyboard(),
+]
+# Общие кнопки, которые есть и в админских клавиатурах
+USER_CALLBACKS = {'back_to_main'}
+
+ADMIN_CALLBACKS = sorted({
+    button.callback_data
+    for keyboard in ADMIN_KEYBOARDS
+    for row in keyboard.inline_keyboard
+    for button in row
+} - USER_CALLBACKS)
+
+
+def is_denied(data):
+    callback = CallbackQuery(
+        id='1', from_user=User(id=1, is_bot=False, first_name='User'), chat_instance='1', data=data
+    )
+    handler, = denied_router.callback_query.handlers
+    matched, _ = asyncio.run(handler.check(callback))
+    return matched
+
+
+@pytest.mark.parametrize('data', ADMIN_CALLBACKS)
+def test_admin_button_is_denied(data):
+    assert is_denied(data)
+
+
+@pytest.mark.parametrize('data', ['stats', 'withdraw', 'back_to_main', 'start_test', 'create_promo', 'answer_1_2'])
+def test_user_button_is_not_denied(data):
+    assert not is_denied(data)
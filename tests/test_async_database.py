@@ -0,0 +1,30 @@
+"""AsyncDatabase: открытие, закрытие и повторное открытие."""
+import asyncio
+
+import pytest
+
+from database import Database, AsyncDatabase
+
+
+def test_reopen_after_close(tmp_path):
+    path = str(tmp_path / 'async.db')
+
+    async def run():
+        db = AsyncDatabase(lambda: Database(path))
+        with pytest.raises(RuntimeError, match="not open yet"):
+            await db.count_partners()
+
+        await db.open()
+        await db.add_partner(1, 'user1', 'Partner 1')
+        assert await db.count_partners() == 1
+        db.close()
+
+        with pytest.raises(RuntimeError, match="not open yet"):
+            await db.count_partners()
+
+        await db.open()
+        await db.add_partner(2, 'user2', 'Partner 2')
+        assert await db.count_partners() == 2
+        db.close()
+
+    asyncio.run(run())
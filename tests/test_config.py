@@ -0,0 +1,37 @@
+"""Файл настроек settings.json."""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_config(tmp_path, settings, expression='None'):
+    """Импортирует config в отдельном процессе с заданным файлом настроек"""
+    path = tmp_path / 'settings.json'
+    path.write_text(json.dumps(settings), encoding='utf-8')
+    env = {k: v for k, v in os.environ.items() if k not in settings}
+    env['BOT_SETTINGS'] = str(path)
+    return subprocess.run(
+        [sys.executable, '-c', f'import config; print(repr({expression}))'],
+        env=env, cwd=ROOT, capture_output=True, text=True
+    )
+
+
+def test_known_settings_are_applied(tmp_path):
+    result = load_config(
+        tmp_path, {'DB_READERS': 8, 'QUIZ_VERSIONS': {'2': []}},
+        '(config.DB_READERS, config.QUIZ_VERSIONS)'
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '(8, {2: []})'
+
+
+@pytest.mark.parametrize('key', ['DB_PROFILES', 'os', 'json', 'DB_READRES'])
+def test_unknown_settings_are_rejected(tmp_path, key):
+    result = load_config(tmp_path, {key: 1})
+    assert result.returncode != 0
+    assert f'Unknown settings in {tmp_path / "settings.json"}: {key}' in result.stderr
@@ -0,0 +1,46 @@
+"""Агрегаты дашборда по результатам теста."""
+import sqlite3
+
+import migrations
+from database import Database
+
+
+def test_tests_passed_follows_stored_flag(tmp_path):
+    database = Database(str(tmp_path / 'dashboard.db'))
+    database.add_partner(1, 'user1', 'Partner 1')
+    # Порог теста 60%: 7 из 10 — пройден, хотя старое правило 80% сказало бы иначе
+    database.save_test_result(1, 7, 10, True)
+    database.save_test_result(1, 9, 10, False)
+    database.save_test_result(1, 10, 10, True)
+
+    dashboard = database.get_dashboard()
+    assert (dashboard['tests_total'], dashboard['tests_passed']) == (3, 2)
+    assert database.check_dashboard() == {}
+
+    with database.connection:
+        database.connection.execute("DELETE FROM test_results WHERE score = 7")
+    assert database.get_dashboard()['tests_passed'] == 1
+    assert database.check_dashboard() == {}
+    database.close()
+
+
+def test_pass_flag_backfilled_from_old_rule(tmp_path, monkeypatch):
+    path = str(tmp_path / 'old.db')
+    connection = sqlite3.connect(path)
+    monkeypatch.setattr(migrations, 'MIGRATIONS', [m for m in migrations.MIGRATIONS if m[0] < 12])
+    migrations.apply_migrations(connection)
+    with connection:
+        connection.execute("INSERT INTO partners (user_id, full_name) VALUES (1, 'Partner 1')")
+        connection.executemany(
+            "INSERT INTO test_results (user_id, score, total_questions) VALUES (1, ?, 10)",
+            [(7,), (8,), (10,)]
+        )
+    connection.close()
+    monkeypatch.undo()
+
+    database = Database(path)
+    passed = database.connection.execute("SELECT score, passed FROM test_results ORDER BY score").fetchall()
+    assert [tuple(row) for row in passed] == [(7, 0), (8, 1), (10, 1)]
+    assert database.get_dashboard()['tests_passed'] == 2
+    assert database.check_dashboard() == {}
+    database.close()
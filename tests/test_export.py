@@ -0,0 +1,45 @@
+"""Выгрузка CSV: память не зависит от размера таблицы."""
+import csv
+import gzip
+import tracemalloc
+
+import pytest
+
+from database import Database
+
+PARTNERS = 20000
+# Одна пачка из 1000 строк плюс буферы csv и gzip; fetchall всех строк — около 12 МБ
+PEAK_LIMIT = 4 * 2 ** 20
+
+
+@pytest.fixture(scope='module')
+def database(tmp_path_factory):
+    database = Database(str(tmp_path_factory.mktemp('export') / 'export.db'))
+    with database.connection:
+        database.connection.executemany("""
+            INSERT INTO partners (user_id, username, full_name, promo_code, is_active, balance)
+            VALUES (?, ?, ?, ?, TRUE, 1000)
+        """, [(i, f'user{i}', f'Partner {i} ' + 'x' * 100, f'PROMO{i}') for i in range(1, PARTNERS + 1)])
+        database.connection.executemany(
+            "INSERT INTO withdrawal_requests (user_id, amount, requisites) VALUES (?, 100, ?)",
+            [(i, '0000 0000 0000 0000') for i in range(1, PARTNERS + 1)]
+        )
+    yield database
+    database.close()
+
+
+@pytest.mark.parametrize('kind', ['partners', 'withdrawals'])
+def test_export_memory_is_bounded(database, tmp_path, kind):
+    path = str(tmp_path / f'{kind}.csv.gz')
+
+    tracemalloc.start()
+    try:
+        rows = database.export_csv(kind, path)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert rows == PARTNERS
+    assert peak < PEAK_LIMIT, f"export_csv peak {peak / 2 ** 20:.1f} MB"
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+        assert sum(1 for _ in csv.reader(f)) == PARTNERS + 1
@@ -0,0 +1,37 @@
+"""Метрики апдейтов."""
+import asyncio
+
+from aiogram import Bot
+
+import main
+from metrics import DB_QUERIES_PER_UPDATE, UpdateMetricsMiddleware, track_query
+from middlewares import PartnerMiddleware
+
+
+def test_query_counter_wraps_fsm_and_partner_lookup():
+    bot = Bot('42:METRICS-TEST')
+    dp = main.build_dispatcher(bot)
+    middlewares = list(dp.update.outer_middleware)
+    counter = next(i for i, m in enumerate(middlewares) if isinstance(m, UpdateMetricsMiddleware))
+    partner = next(i for i, m in enumerate(middlewares) if isinstance(m, PartnerMiddleware))
+    assert counter < middlewares.index(dp.fsm) < partner
+    asyncio.run(bot.session.close())
+
+
+def test_queries_counted_per_update():
+    def samples():
+        _, total, count = DB_QUERIES_PER_UPDATE.samples().get((), ([], 0.0, 0))
+        return total, count
+
+    async def handler(event, data):
+        track_query('load_fsm_record', 0)
+        track_query('load_partner', 0)
+        return 'handled'
+
+    before_total, before_count = samples()
+    assert asyncio.run(UpdateMetricsMiddleware()(handler, None, {})) == 'handled'
+    total, count = samples()
+    assert (total - before_total, count - before_count) == (2, 1)
+    # Вне апдейта запросы не считаются
+    track_query('checkpoint', 0)
+    assert samples() == (total, count)
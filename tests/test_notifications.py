@@ -0,0 +1,33 @@
+"""Notifier: лимиты на чат не задерживают других получателей."""
+import asyncio
+import time
+
+from notifications import Notifier
+
+
+class FakeBot:
+    def __init__(self):
+        self.delivered = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.delivered.setdefault(chat_id, []).append(time.monotonic())
+        return object()
+
+
+def test_busy_chat_does_not_block_other_chats():
+    async def run():
+        bot = FakeBot()
+        notifier = Notifier(bot, concurrency=8, global_rate=1000, chat_rate=1)
+        started_at = time.monotonic()
+        notifier.send_many([1] * 12, 'text')
+        await asyncio.sleep(0)
+        await notifier.deliver(2, 'text')
+        waited = time.monotonic() - started_at
+        for task in list(notifier._tasks):
+            task.cancel()
+        return bot, waited
+
+    bot, waited = asyncio.run(run())
+    # Раньше 12 сообщений в чат 1 занимали все 8 слотов, и чат 2 ждал около 4 с
+    assert waited < 0.5
+    assert len(bot.delivered[2]) == 1
@@ -0,0 +1,131 @@
+"""Начисление за заказы из spool-каталога."""
+import asyncio
+import json
+import os
+
+import pytest
+
+from database import Database, AsyncDatabase
+from orders import OrderSpoolWorker, parse_spool_file
+
+
+def write_spool(path, events):
+    with open(path, 'w', encoding='utf-8') as f:
+        for event in events:
+            f.write((event if isinstance(event, str) else json.dumps(event)) + '\n')
+
+
+def test_parse_skips_bad_types(tmp_path):
+    path = tmp_path / 'events.jsonl'
+    write_spool(path, [
+        {'order_id': 'o1', 'promo_code': 'PROMO1', 'amount': 100.5, 'created_at': '2024-01-01'},
+        {'order_id': 2, 'promo_code': 'PROMO1'},
+        {'order_id': 'o3', 'promo_code': 'PROMO1', 'amount': {'rub': 5}},
+        {'order_id': 'o4', 'promo_code': 'PROMO1', 'amount': '100'},
+        {'order_id': 'o5', 'promo_code': 'PROMO1', 'amount': True},
+        {'order_id': 'o6', 'promo_code': 'PROMO1', 'created_at': 1700000000},
+        {'order_id': {'id': 7}, 'promo_code': 'PROMO1'},
+        {'order_id': 'o8', 'promo_code': ['PROMO1']},
+        {'order_id': ' ', 'promo_code': 'PROMO1'},
+        {'order_id': 'o10', 'promo_code': 'PROMO1', 'amount': 10 ** 400},
+        ['o11', 'PROMO1'],
+        'not json',
+    ])
+
+    events, skipped = parse_spool_file(path)
+
+    assert events == [('o1', 'PROMO1', 100.5, '2024-01-01'), ('2', 'PROMO1', None, None)]
+    assert skipped == 10
+
+
+@pytest.fixture
+def spool(tmp_path):
+    directory = tmp_path / 'spool'
+    directory.mkdir()
+    return directory
+
+
+def test_bad_event_does_not_block_file(tmp_path, spool):
+    database = Database(str(tmp_path / 'orders.db'))
+    database.add_partner(1, 'user1', 'Partner 1')
+    database.set_promo_code(1, 'PROMO1')
+    write_spool(spool / 'a.jsonl', [
+        {'order_id': 'o1', 'promo_code': 'PROMO1'},
+        {'order_id': 'o2', 'promo_code': 'PROMO1', 'amount': {'rub': 5}},
+        {'order_id': 'o3', 'promo_code': 'PROMO1', 'amount': 10},
+    ])
+
+    async def run():
+        db = AsyncDatabase(lambda: database)
+        await db.open()
+        worker = OrderSpoolWorker(db, str(spool), reward=5)
+        return await worker.drain_once()
+
+    assert asyncio.run(run()) == 1
+    assert os.listdir(spool / 'processed') == ['a.jsonl']
+    assert database.get_partner(1)['referrals'] == 2
+    database.close()
+
+
+def test_one_notification_per_partner_per_pass(tmp_path, spool):
+    database = Database(str(tmp_path / 'orders.db'))
+    for user_id in (1, 2):
+        database.add_partner(user_id, f'user{user_id}', f'Partner {user_id}')
+        database.set_promo_code(user_id, f'PROMO{user_id}')
+    # Партнер 1 встречается в обоих файлах и в нескольких пачках каждого
+    write_spool(spool / 'a.jsonl', [{'order_id': f'a{i}', 'promo_code': 'PROMO1'} for i in range(5)])
+    write_spool(spool / 'b.jsonl', [
+        {'order_id': f'b{i}', 'promo_code': 'PROMO1' if i % 2 else 'PROMO2'} for i in range(4)
+    ])
+
+    async def run():
+        db = AsyncDatabase(lambda: database)
+        await db.open()
+        worker = OrderSpoolWorker(db, str(spool), reward=5, batch_size=2)
+        return await worker.drain_once()
+
+    assert asyncio.run(run()) == 2
+    outbox = database.connection.execute("SELECT chat_id, text FROM outbox ORDER BY chat_id").fetchall()
+    assert [row['chat_id'] for row in outbox] == [1, 2]
+    assert 'Новые заказы по вашему промокоду: 7' in outbox[0]['text']
+    assert 'Начислено: +35.00 руб.' in outbox[0]['text']
+    assert 'Новые заказы по вашему промокоду: 2' in outbox[1]['text']
+    assert database.connection.execute("SELECT COUNT(*) FROM pending_order_rewards").fetchone()[0] == 0
+    database.close()
+
+
+class FailingDatabase:
+    """ingest_orders падает на событиях из "отравленного" файла"""
+
+    def __init__(self):
+        self.ingested = []
+
+    async def ingest_orders(self, events, reward_kopecks):
+        if any(order_id.startswith('poison') for order_id, _, _, _ in events):
+            raise RuntimeError("database error")
+        self.ingested.extend(events)
+        return {'received': len(events), 'new': len(events), 'duplicates': 0, 'credited': 0}
+
+    async def flush_order_rewards(self, notify):
+        return 0
+
+
+def test_failing_file_is_moved_aside(spool):
+    write_spool(spool / 'a.jsonl', [{'order_id': 'poison1', 'promo_code': 'PROMO1'}])
+    write_spool(spool / 'b.jsonl', [{'order_id': 'o1', 'promo_code': 'PROMO1'}])
+    db = FailingDatabase()
+    worker = OrderSpoolWorker(db, str(spool), reward=5, max_failures=3)
+
+    # Второй файл обрабатывается, хотя первый по алфавиту падает
+    assert asyncio.run(worker.drain_once()) == 1
+    assert [event[0] for event in db.ingested] == ['o1']
+    assert os.listdir(spool / 'processed') == ['b.jsonl']
+
+    write_spool(spool / 'c.jsonl', [{'order_id': 'o2', 'promo_code': 'PROMO1'}])
+    assert asyncio.run(worker.drain_once()) == 1
+    assert os.path.exists(spool / 'a.jsonl')
+
+    assert asyncio.run(worker.drain_once()) == 0
+    assert not os.path.exists(spool / 'a.jsonl')
+    assert os.listdir(spool / 'failed') == ['a.jsonl']
+    assert asyncio.run(worker.drain_once()) == 0
@@ -0,0 +1,105 @@
+"""Доставка уведомлений через outbox: копии новой заявки у админов."""
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+from database import Database, AsyncDatabase
+from keyboards import get_withdrawal_actions_keyboard
+from notifications import OutboxWorker
+
+ADMIN_IDS = [100, 101]
+
+
+class FakeNotifier:
+    """Запоминает отправленное и отвечает сообщением с новым message_id"""
+
+    def __init__(self, fail_chats=()):
+        self.sent = []
+        self.fail_chats = set(fail_chats)
+        self._message_ids = itertools.count(1)
+
+    async def deliver(self, chat_id, text, **kwargs):
+        if chat_id in self.fail_chats:
+            return None
+        self.sent.append((chat_id, text, kwargs))
+        return SimpleNamespace(message_id=next(self._message_ids))
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / 'outbox.db'))
+    database.add_partner(1, 'user1', 'Partner 1')
+    database.update_partner_stats(1, balance_delta=5000, reason='manual_adjustment')
+    yield database
+    database.close()
+
+
+def notification(withdrawal):
+    keyboard = get_withdrawal_actions_keyboard(withdrawal['id'])
+    return f"Заявка #{withdrawal['id']}", keyboard.model_dump_json(exclude_none=True)
+
+
+def drain(database, notifier):
+    async def run():
+        db = AsyncDatabase(lambda: database)
+        await db.open()
+        return await OutboxWorker(db, notifier).drain_once()
+    return asyncio.run(run())
+
+
+def test_admin_copies_are_delivered_with_keyboard(database):
+    withdrawal = database.create_withdrawal_request(
+        1, 1000, 'card', None, admin_ids=ADMIN_IDS, notify=notification
+    )
+    notifier = FakeNotifier()
+
+    assert drain(database, notifier) == 2
+    assert [chat_id for chat_id, _, _ in notifier.sent] == ADMIN_IDS
+    for _, text, kwargs in notifier.sent:
+        assert text == f"Заявка #{withdrawal['id']}"
+        assert kwargs['reply_markup'] == get_withdrawal_actions_keyboard(withdrawal['id'])
+    assert sorted(database.pop_withdrawal_messages(withdrawal['id'])) == [(100, 1), (101, 2)]
+
+
+def test_failed_copy_stays_in_outbox(database):
+    withdrawal = database.create_withdrawal_request(
+        1, 1000, 'card', None, admin_ids=ADMIN_IDS, notify=notification
+    )
+
+    drain(database, FakeNotifier(fail_chats={101}))
+
+    assert database.pop_withdrawal_messages(withdrawal['id']) == [(100, 1)]
+    assert [row['chat_id'] for row in database.get_outbox_batch(10, float('inf'))] == [101]
+
+
+def test_no_alert_without_withdrawal(database):
+    assert database.create_withdrawal_request(
+        1, 10 ** 6, 'card', None, admin_ids=ADMIN_IDS, notify=notification
+    ) is None
+    assert database.get_outbox_batch(10, float('inf')) == []
+
+
+def test_processed_withdrawal_copy_is_not_remembered(database):
+    withdrawal = database.create_withdrawal_request(
+        1, 1000, 'card', None, admin_ids=ADMIN_IDS, notify=notification
+    )
+    database.reject_withdrawal(withdrawal['id'], 'reason')
+
+    drain(database, FakeNotifier())
+
+    assert database.pop_withdrawal_messages(withdrawal['id']) == []
+
+
+def test_admin_alert_goes_before_bulk_rewards(database):
+    database.set_promo_code(1, 'PROMO1')
+    database.ingest_orders([(f'o{i}', 'PROMO1', None, None) for i in range(3)], 500)
+    database.import_report([('PROMO1', 2, 1000)], 'hash', notify=lambda p, o, a: 'report')
+    database.flush_order_rewards(lambda p, o, a: 'orders')
+    database.create_withdrawal_request(1, 1000, 'card', None, admin_ids=ADMIN_IDS, notify=notification)
+
+    # Заявка создана последней, но копии админам не ждут уведомлений о начислениях
+    batch = database.get_outbox_batch(10, float('inf'))
+    assert [row['chat_id'] for row in batch] == ADMIN_IDS + [1, 1]
+    assert [row['text'] for row in batch[2:]] == ['report', 'orders']
@@ -0,0 +1,149 @@
+"""Планы запросов Database: каждый запрос должен идти по индексу.
+
+Каждый метод Database вызывается на мигрированной временной базе с
+небольшими данными, все выполненные им выражения перехватываются через
+trace callback и прогоняются через EXPLAIN QUERY PLAN. Полный проход по
+таблице (SCAN без индекса) допустим только там, где он задуман, — такие
+случаи перечислены в ALLOWED_SCANS.
+"""
+import time
+
+import pytest
+
+from database import Database
+
+# Методы без SQL, которые проверять не нужно
+NOT_QUERIES = {'close', 'migrate'}
+
+# Задуманные полные проходы: метод -> строки плана
+ALLOWED_SCANS = {
+    # Запрос короче 3 символов не ищется триграммами, только LIKE
+    'search_partners': {'SCAN partners'},
+    # Сверка с пересчетом с нуля — специально по всей таблице
+    'check_dashboard': {'SCAN partners', 'SCAN test_results'},
+    'rebuild_balances': {'SCAN p', 'SCAN balance_ledger USING INDEX idx_ledger_user_created'},
+    # Временная таблица отчета перебирается целиком, партнеры ищутся по индексу
+    'import_report': {'SCAN i'},
+    # Накопленные начисления выбираются целиком, партнеры ищутся по ключу
+    'flush_order_rewards': {'SCAN pending_order_rewards'},
+}
+
+CALLS = [
+    ('checkpoint', ()),
+    ('storage_status', ()),
+    ('add_partner', (10, 'new_user', 'New User')),
+    ('set_promo_code', (3, 'NEWCODE')),
+    ('get_partner', (1,)),
+    ('load_partner', (1,)),
+    ('get_partners_page', ()),
+    ('get_partners_page', (2, 'next')),
+    ('get_partners_page', (2, 'prev')),
+    ('count_partners', ()),
+    ('update_partner_stats', (1, 1, 500)),
+    ('set_partner_stats', (1, 5, 3000)),
+    ('save_test_result', (1, 9, 10, True)),
+    ('get_available_balance', (1,)),
+    ('create_withdrawal_request', (1, 1500, 'card', None, [100, 101], lambda w: ('text', None))),
+    ('get_pending_withdrawals_page', ()),
+    ('get_pending_withdrawals_page', (1, 'next')),
+    ('get_pending_withdrawals_page', (1, 'prev')),
+    ('count_pending_withdrawals', ()),
+    ('complete_withdrawal', (1,)),
+    ('reject_withdrawal', (2, 'reason')),
+    ('pop_withdrawal_messages', (1,)),
+    ('get_withdrawal_by_id', (1,)),
+    ('search_partners', ('1',)),
+    ('search_partners', ('@user1',)),
+    ('search_partners', ('us',)),
+    ('search_partners', ('Partner',)),
+    ('export_csv', ('partners', None)),
+    ('export_csv', ('withdrawals', None)),
+    ('get_dashboard', ()),
+    ('check_dashboard', ()),
+    ('get_balance_history', (1,)),
+    ('rebuild_balances', ()),
+    ('import_report', ([('PROMO1', 2, 100000), ('UNKNOWN', 1, 500)], 'hash')),
+    ('import_report', ([('PROMO1', 2, 100000)], 'hash2', None, None, lambda p, o, a: 'text')),
+    ('ingest_orders', ([('o1', 'PROMO1', 100, None), ('o2', 'UNKNOWN', None, None)], 50000)),
+    ('ingest_orders', ([('o3', 'PROMO2', 100, None)], 50000)),
+    ('flush_order_rewards', (lambda p, o, a: 'text',)),
+    ('get_outbox_batch', (10, time.time())),
+    ('ack_outbox', ([(1, 500)], [(2, time.time())], 5)),
+    ('load_fsm_record', ('key',)),
+    ('save_fsm_records', ([('key', 'state', '{}', 1.0), ('old', None, '{}', 1.0)],)),
+    ('expire_fsm_records', (time.time(),)),
+]
+
+SKIP_STATEMENTS = ('--', 'BEGIN', 'COMMIT', 'ROLLBACK', 'PRAGMA', 'CREATE', 'SAVEPOINT', 'RELEASE')
+
+# Обход таблицы целиком по индексу тоже полный проход, если он не ограничен LIMIT
+FULL_INDEX_SCANS = ('SCAN balance_ledger USING INDEX',)
+
+
+@pytest.fixture
+def db(tmp_path):
+    database = Database(str(tmp_path / 'plans.db'))
+    with database.connection:
+        database.connection.executemany(
+            "INSERT INTO partners (user_id, username, full_name, promo_code, is_active, balance) "
+            "VALUES (?, ?, ?, ?, TRUE, ?)",
+            [(i, f'user{i}', f'Partner {i}', f'PROMO{i}', 5000) for i in (1, 2)]
+        )
+        database.connection.execute(
+            "INSERT INTO partners (user_id, username, full_name) VALUES (3, 'user3', 'Partner 3')"
+        )
+        database.connection.executemany(
+            "INSERT INTO withdrawal_requests (user_id, amount, requisites) VALUES (?, ?, 'card')",
+            [(1, 1500), (2, 1500)]
+        )
+        database.connection.executemany(
+            "INSERT INTO outbox (chat_id, text, withdrawal_id) VALUES (?, 'text', ?)", [(100, 1), (2, None)]
+        )
+    yield database
+    database.close()
+
+
+def capture(db):
+    statements = []
+    connections = [db.connection] + list(db._reader_pool.queue)
+    for connection in connections:
+        connection.set_trace_callback(statements.append)
+    return statements, connections
+
+
+def full_scans(db, statements):
+    scans = set()
+    for statement in dict.fromkeys(s.strip() for s in statements):
+        # Служебные запросы FTS5 к своим таблицам ('main'.'partners_fts_...')
+        if not statement or statement.upper().startswith(SKIP_STATEMENTS) or "'main'." in statement:
+            continue
+        for row in db.connection.execute("EXPLAIN QUERY PLAN " + statement):
+            detail = row[3]
+            if detail == 'SCAN CONSTANT ROW' or 'VIRTUAL TABLE' in detail:
+                continue
+            if detail.startswith('SCAN ') and (
+                ' USING ' not in detail or detail.startswith(FULL_INDEX_SCANS)
+            ):
+                scans.add(detail)
+    return scans
+
+
+@pytest.mark.parametrize('name, args', CALLS, ids=[f'{name}-{i}' for i, (name, _) in enumerate(CALLS)])
+def test_query_uses_index(db, tmp_path, name, args):
+    if name == 'export_csv':
+        args = (args[0], str(tmp_path / 'export.csv.gz'))
+    statements, connections = capture(db)
+    getattr(db, name)(*args)
+    for connection in connections:
+        connection.set_trace_callback(None)
+
+    scans = full_scans(db, statements) - ALLOWED_SCANS.get(name, set())
+    assert not scans, f"{name} scans without an index: {sorted(scans)}"
+
+
+def test_every_query_method_is_checked():
+    methods = {
+        name for name, value in vars(Database).items()
+        if callable(value) and not name.startswith('_')
+    } - NOT_QUERIES
+    assert methods == {name for name, _ in CALLS}
@@ -0,0 +1,85 @@
+"""Импорт отчета партнерской платформы."""
+import asyncio
+import csv
+import io
+from types import SimpleNamespace
+
+import pytest
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.methods import GetFile
+
+from handlers.admin_handlers import process_report_file
+from reports import parse_report, ReportError
+
+
+def test_parse_csv_sums_rows():
+    content = "promo_code;orders;amount\nPROMO1;2;100,50\nPROMO1;1;0\nBAD;x;1\n".encode()
+    assert parse_report(content, 'report.csv') == ([('PROMO1', 3, 10050)], 1)
+
+
+def test_oversized_csv_field_is_report_error():
+    content = f"promo_code,orders,amount\nPROMO1,1,\"{'x' * (csv.field_size_limit() + 1)}\"\n".encode()
+    with pytest.raises(ReportError, match="некорректный CSV"):
+        parse_report(content, 'report.csv')
+
+
+class FakeMessage:
+    """Сообщение с документом; answer() возвращает сообщение-прогресс"""
+
+    def __init__(self, document=None):
+        self.document = document
+        self.from_user = SimpleNamespace(id=1)
+        self.answers = []
+        self.edits = []
+        self.progress = None
+
+    async def answer(self, text, **kwargs):
+        self.answers.append(text)
+        self.progress = FakeMessage()
+        return self.progress
+
+    async def edit_text(self, text, **kwargs):
+        self.edits.append(text)
+
+
+class FakeState:
+    cleared = False
+
+    async def clear(self):
+        self.cleared = True
+
+
+class FakeBot:
+    def __init__(self, content=None):
+        self.content = content
+
+    async def download(self, document):
+        if self.content is None:
+            raise TelegramBadRequest(GetFile(file_id='1'), "file is too big")
+        return io.BytesIO(self.content)
+
+
+def import_file(content, file_size=None, bot_content=None):
+    document = SimpleNamespace(file_name='report.csv', file_size=file_size or len(content or b''))
+    message, state = FakeMessage(document), FakeState()
+    asyncio.run(process_report_file(message, state, db=None, bot=FakeBot(bot_content)))
+    return message, state
+
+
+def test_too_big_file_is_not_downloaded():
+    message, state = import_file(None, file_size=30 * 1024 * 1024)
+    assert state.cleared
+    assert message.answers == ["❌ Файл больше 20 МБ, бот не может его скачать. Разбейте отчет на части."]
+
+
+def test_failed_download_clears_state():
+    message, state = import_file(None, file_size=1024)
+    assert state.cleared
+    assert message.progress.edits[-1].startswith("❌ Не удалось скачать файл")
+
+
+def test_unparsable_report_clears_state():
+    content = f"promo_code,orders\nPROMO1,\"{'x' * (csv.field_size_limit() + 1)}\"\n".encode()
+    message, state = import_file(content, bot_content=content)
+    assert state.cleared
+    assert message.progress.edits[-1].startswith("❌ Не удалось разобрать отчет: некорректный CSV")
@@ -0,0 +1,103 @@
+"""SQLiteStorage: write-behind кэш FSM поверх базы."""
+import asyncio
+import time
+
+import pytest
+from aiogram.fsm.storage.base import StorageKey
+
+from database import Database, AsyncDatabase
+from storage import SQLiteStorage
+
+KEY = StorageKey(bot_id=1, chat_id=10, user_id=10)
+OTHER_KEY = StorageKey(bot_id=1, chat_id=20, user_id=20)
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / 'fsm.db'))
+    yield database
+    database.close()
+
+
+def run(database, scenario):
+    async def main():
+        db = AsyncDatabase(lambda: database)
+        await db.open()
+        return await scenario(db)
+    return asyncio.run(main())
+
+
+class FailingSaves:
+    """Обертка над AsyncDatabase, у которой save_fsm_records падает первые failures раз"""
+
+    def __init__(self, db, failures=1):
+        self.db = db
+        self.failures = failures
+
+    async def save_fsm_records(self, records):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("disk I/O error")
+        return await self.db.save_fsm_records(records)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+def test_state_survives_flush_and_restart(database):
+    async def scenario(db):
+        storage = SQLiteStorage(db)
+        await storage.set_state(KEY, 'Form:name')
+        await storage.set_data(KEY, {'name': 'Иван', 'answers': [1, 2]})
+
+        # До сброса в базе ничего нет: запись только в кэше
+        assert await SQLiteStorage(db).get_state(KEY) is None
+        await storage.flush()
+
+        restarted = SQLiteStorage(db)
+        return await restarted.get_state(KEY), await restarted.get_data(KEY)
+
+    assert run(database, scenario) == ('Form:name', {'name': 'Иван', 'answers': [1, 2]})
+
+
+def test_expired_session_comes_back_empty(database):
+    async def scenario(db):
+        await db.save_fsm_records([
+            (SQLiteStorage._make_key(KEY), 'Form:name', '{"name": "old"}', time.time() - 120),
+            (SQLiteStorage._make_key(OTHER_KEY), 'Form:name', '{"name": "fresh"}', time.time()),
+        ])
+        storage = SQLiteStorage(db, ttl=60)
+        loaded = (await storage.get_state(KEY), await storage.get_data(KEY), await storage.get_data(OTHER_KEY))
+
+        # Сессия в кэше тоже истекает, если ее не трогали дольше ttl
+        storage._cache[SQLiteStorage._make_key(OTHER_KEY)]['updated_at'] = time.time() - 120
+        return loaded + (await storage.get_state(OTHER_KEY), await storage.get_data(OTHER_KEY))
+
+    assert run(database, scenario) == (None, {}, {'name': 'fresh'}, None, {})
+
+
+def test_failed_flush_keeps_keys_dirty(database):
+    async def scenario(db):
+        storage = SQLiteStorage(FailingSaves(db), cache_idle=0)
+        await storage.set_state(KEY, 'Form:name')
+        await storage.set_state(OTHER_KEY, 'Form:age')
+
+        with pytest.raises(RuntimeError):
+            await storage.flush()
+        # Грязные записи не выгружаются из кэша, даже если простаивают
+        still_cached = len(storage._cache)
+        dirty = set(storage._dirty)
+
+        await storage.flush()
+        restarted = SQLiteStorage(db)
+        return still_cached, dirty, storage._dirty, len(storage._cache), (
+            await restarted.get_state(KEY), await restarted.get_state(OTHER_KEY)
+        )
+
+    still_cached, dirty, dirty_after, cached_after, states = run(database, scenario)
+    assert still_cached == 2
+    assert dirty == {SQLiteStorage._make_key(KEY), SQLiteStorage._make_key(OTHER_KEY)}
+    assert dirty_after == set()
+    # После успешного сброса простаивающие чистые записи выгружены
+    assert cached_after == 0
+    assert states == ('Form:name', 'Form:age')
@@ -0,0 +1,15 @@
+"""Запуск в режиме webhook."""
+import pytest
+
+import webhook
+
+
+@pytest.mark.parametrize('secret', [None, '', 'CHANGE_ME', 'with spaces', 'x' * 257])
+def test_create_app_refuses_bad_secret(monkeypatch, secret):
+    monkeypatch.setattr(webhook, 'WEBHOOK_SECRET', secret)
+    with pytest.raises(RuntimeError):
+        webhook.create_app(bot=None)
+
+
+def test_check_secret_accepts_valid_secret():
+    webhook.check_secret('Abc_123-xyz')
@@ -0,0 +1,75 @@
+"""Одновременная обработка заявок на вывод несколькими админами."""
+import asyncio
+import random
+
+import pytest
+
+from database import Database, AsyncDatabase
+
+PARTNERS = 20
+WITHDRAWALS_PER_PARTNER = 10
+# Сколько раз нажимают кнопки каждой заявки (у каждого админа своя копия)
+CLICKS_PER_WITHDRAWAL = 4
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / 'withdrawals.db'))
+    for user_id in range(1, PARTNERS + 1):
+        database.add_partner(user_id, f'user{user_id}', f'Partner {user_id}')
+        database.update_partner_stats(user_id, balance_delta=100000, reason='manual_adjustment')
+        for _ in range(WITHDRAWALS_PER_PARTNER):
+            assert database.create_withdrawal_request(user_id, 1000, 'card', None)
+    yield database
+    database.close()
+
+
+async def click_everything(database):
+    db = AsyncDatabase(lambda: database)
+    await db.open()
+    rng = random.Random(1)
+    withdrawal_ids = [row[0] for row in database.connection.execute("SELECT id FROM withdrawal_requests")]
+
+    calls = []
+    for withdrawal_id in withdrawal_ids:
+        for admin_id in range(1, CLICKS_PER_WITHDRAWAL + 1):
+            if rng.random() < 0.5:
+                calls.append((withdrawal_id, 'completed', db.complete_withdrawal(
+                    withdrawal_id, notify=lambda w: 'done', admin_id=admin_id
+                )))
+            else:
+                calls.append((withdrawal_id, 'rejected', db.reject_withdrawal(
+                    withdrawal_id, 'reason', notify=lambda w: 'rejected', admin_id=admin_id
+                )))
+    rng.shuffle(calls)
+    results = await asyncio.gather(*(call for _, _, call in calls))
+    return [(withdrawal_id, status, result) for (withdrawal_id, status, _), result in zip(calls, results)]
+
+
+def test_concurrent_clicks_apply_once(database):
+    results = asyncio.run(click_everything(database))
+    assert len(results) == PARTNERS * WITHDRAWALS_PER_PARTNER * CLICKS_PER_WITHDRAWAL
+
+    applied = {}
+    for withdrawal_id, status, (withdrawal, was_applied) in results:
+        assert withdrawal is not None
+        if was_applied:
+            assert withdrawal_id not in applied, f"withdrawal {withdrawal_id} applied twice"
+            applied[withdrawal_id] = status
+        # Проигравшее нажатие видит итог того, кто успел первым
+        assert withdrawal['status'] != 'pending'
+
+    rows = database.connection.execute("SELECT id, status FROM withdrawal_requests").fetchall()
+    assert {row['id']: row['status'] for row in rows} == applied
+
+    completed = [i for i, status in applied.items() if status == 'completed']
+    ledger = database.connection.execute(
+        "SELECT withdrawal_id FROM balance_ledger WHERE reason = 'withdrawal'"
+    ).fetchall()
+    assert sorted(row[0] for row in ledger) == sorted(completed)
+    assert database.connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] == len(applied)
+
+    total = database.connection.execute("SELECT SUM(balance) FROM partners").fetchone()[0]
+    assert total == pytest.approx(PARTNERS * 100000 - len(completed) * 1000)
+    assert database.rebuild_balances() == []
+    assert database.check_dashboard() == {}
@@ -0,0 +1,75 @@
+"""Запуск бота в режиме webhook вместо long polling.
+
+Telegram присылает апдейты на WEBHOOK_BASE_URL + WEBHOOK_PATH, локальный
+aiohttp-сервер проверяет секретный токен и сразу отвечает 200, а сам апдейт
+обрабатывается диспетчером в фоновой задаче, поэтому медленный хендлер не
+задерживает прием следующих апдейтов.
+"""
+import logging
+import re
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from config import (
+    WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT,
+    LOG_LEVEL, LOG_FILE
+)
+from main import create_bot, build_dispatcher
+from metrics import HEALTH
+from logs import setup_logging
+
+logger = logging.getLogger(__name__)
+
+# Допустимый секрет по документации Bot API
+SECRET_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,256}')
+
+def check_secret(secret):
+    """Без настоящего секрета апдейты на публичный адрес мог бы прислать кто угодно"""
+    if not secret or secret == "CHANGE_ME":
+        raise RuntimeError("WEBHOOK_SECRET is not set, refusing to start in webhook mode")
+    if not SECRET_PATTERN.fullmatch(secret):
+        raise RuntimeError("WEBHOOK_SECRET may contain only A-Z, a-z, 0-9, _ and - (1-256 characters)")
+
+def create_app(bot, dp=None):
+    check_secret(WEBHOOK_SECRET)
+    if dp is None:
+        dp = build_dispatcher(bot)
+
+    async def set_webhook(bot: Bot):
+        await bot.set_webhook(
+            f"{WEBHOOK_BASE_URL}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+
+    dp.startup.register(set_webhook)
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        handle_in_background=True,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    # 503 до конца прогрева в startup-хуке диспетчера
+    app.router.add_get('/health', HEALTH.handle)
+    # Вызывает startup/shutdown диспетчера вместе с запуском и остановкой сервера
+    setup_application(app, dp, bot=bot)
+    return app
+
+def main():
+    bot = create_bot()
+    app = create_app(bot)
+
+    logger.info("Bot started in webhook mode!")
+    # run_app сам обрабатывает SIGINT/SIGTERM и корректно останавливает приложение
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, print=None)
+
+if __name__ == "__main__":
+    listener = setup_logging(LOG_LEVEL, LOG_FILE)
+    try:
+        main()
+    finally:
+        listener.stop()